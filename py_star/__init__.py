@@ -2,10 +2,25 @@
 
 agi     - python wrapper for agi
 agitb   - a module to assist in agi debugging, like cgitb
+calls   - a module for correlating manager events into calls
 config  - a module for parsing asterisk config files
+eventlog - a module for logging manager events durably
+fanout  - a module for distributing manager events to worker processes
+fleet   - a module for multiplexing many asterisk manager connections
+gateway - a module for streaming manager events over HTTP (SSE, WebSocket)
+hints   - a module for the live state of the hints (BLF and presence)
+kpi     - a module for rolling call KPIs (ASR, ACD, PDD)
 manager - a module for interacting with the asterisk manager interface
+proxy   - a module for sharing a manager connection with many clients
+queues  - a module for the live state of the call queues
+shmstate - a module for a channel table shared through memory
+snapshot - a module for warm starts from snapshots of the state
+topology - a module for the graph of connected channels and bridges
+userevent - a module for publishing and subscribing with user events
 
 """
 
-__all__ = ['agi', 'agitb', 'config', 'manager']
+__all__ = ['agi', 'agitb', 'calls', 'config', 'eventlog', 'fanout', 'fleet',
+           'gateway', 'hints', 'kpi', 'manager', 'proxy', 'queues',
+           'shmstate', 'snapshot', 'topology', 'userevent']
 __version__ = '0.1.2.dev1'
@@ -3,7 +3,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 from os import fork, kill, waitpid
 from signal import SIGTERM
 import socket
-from time import sleep
+import threading
 
 from . import compat_six as six
 
@@ -49,7 +49,9 @@ class Event(dict):
 
     def as_string(self, id):
         ret = []
-        if 'Response' in self:
+        # responses, and events listing the results of an action (those
+        # given a placeholder ActionID), carry the ActionID of the action
+        if 'Response' in self or 'ActionID' in self:
             self ['ActionID'] = [id]
         for k,v in sorted(self.items(), key=self.sort):
             if k == 'CONTENT':
@@ -106,33 +108,46 @@ class AsteriskEmu(object):
             Chatscript is a dict of command names to event list mapping.
             The event list contains events to send when the given
             command is recognized.
+            Each connection is served by a thread of its own, and
+            connections that logged in with "Events: off" are sent
+            only the responses (and the events listing their results).
         """
         while True:
             conn, addr = sock.accept()
-            f = conn.makefile('rwb')
-            conn.close()
-            f.write('Asterisk Call Manager/1.1\r\n'.encode('utf-8'))
-            f.flush()
-            cmd = lastid = ''
-            try:
-                for l in f:
-                    l = l.decode('utf-8')
-                    if l.startswith ('ActionID:'):
-                        lastid = l.split(':', 1)[1].strip()
-                    elif l.startswith ('Action:'):
-                        cmd = l.split(':', 1)[1].strip()
-                    elif not l.strip():
-                        for d in chatscript, self.default_events:
-                            if cmd in d:
-                                for event in d[cmd]:
-                                    f.write(event.as_string(id = lastid))
-                                    f.flush()
-                                    if cmd == 'Logoff':
-                                        f.close()
-                                break
-            except:
-                pass
-            sleep(10000) # wait for being killed
+            t = threading.Thread(target=self.converse, args=(conn, chatscript))
+            t.setDaemon(True)
+            t.start()
+
+    def converse(self, conn, chatscript):
+        f = conn.makefile('rwb')
+        conn.close()
+        f.write('Asterisk Call Manager/1.1\r\n'.encode('utf-8'))
+        f.flush()
+        cmd = lastid = ''
+        events = True
+        try:
+            for l in f:
+                l = l.decode('utf-8')
+                if l.startswith ('ActionID:'):
+                    lastid = l.split(':', 1)[1].strip()
+                elif l.startswith ('Action:'):
+                    cmd = l.split(':', 1)[1].strip()
+                elif l.startswith ('Events:'):
+                    events = l.split(':', 1)[1].strip() != 'off'
+                elif not l.strip():
+                    for d in chatscript, self.default_events:
+                        if cmd in d:
+                            for event in d[cmd]:
+                                if (not events and 'Response' not in event
+                                        and 'ActionID' not in event):
+                                    continue
+                                f.write(event.as_string(id = lastid))
+                                f.flush()
+                                if cmd == 'Logoff':
+                                    f.close()
+                            break
+        except:
+            pass
 
     def close(self):
         if self.childpid:
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Correlation of manager events into calls
+
+A :class:`CallTracker` groups the channel events received by a
+:class:`~py_star.manager.Manager` into calls (by ``Linkedid``), made of
+legs (one per channel), and hands each call over once all its channels are
+hung up.
+
+   import py_star.calls
+
+   def handle_call(call, tracker):
+      print ("Call %s: %s, %d legs, %.1f s" % (
+          call.linkedid, call.disposition, len(call.legs), call.duration))
+
+   tracker = py_star.calls.CallTracker(max_calls=10000, max_age=4 * 3600)
+   tracker.register_complete(handle_call)
+   tracker.attach(manager)
+
+Memory is bounded: when there are more than `max_calls` calls in progress,
+or a call has not had any event for `max_age` seconds (e.g. its ``Hangup``
+events were lost), it is evicted and handed to the callbacks registered
+with :meth:`CallTracker.register_evicted` instead.
+
+Times are those of the ``Timestamp`` header of the events if present
+(``timestampevents = yes`` in ``manager.conf``), or of their processing.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# disposition of unanswered calls by DialStatus, and by hangup cause
+_DIAL_STATUS_DISPOSITIONS = {
+    'BUSY': 'BUSY',
+    'NOANSWER': 'NO ANSWER',
+    'CANCEL': 'NO ANSWER',
+}
+_CAUSE_DISPOSITIONS = {
+    '17': 'BUSY',
+    '18': 'NO ANSWER',
+    '19': 'NO ANSWER',
+    '16': 'NO ANSWER',
+}
+
+# channel states (ChannelState header)
+_RINGING = '5'
+_UP = '6'
+
+
+def _event_time(event):
+    try:
+        return float(event.get_header('Timestamp'))
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class Leg(object):
+
+    """A channel taking part in a call."""
+
+    def __init__(self, uniqueid, channel, created):
+        self.uniqueid = uniqueid
+        self.channel = channel
+        self.caller_id_num = None
+        self.context = None
+        self.exten = None
+        self.created = created
+        self.dialed = None     # when it started to be dialed
+        self.ringing = None
+        self.answered = None
+        self.hungup = None
+        self.dial_status = None
+        self.cause = None
+        self.cause_txt = None
+
+    def __repr__(self):
+        return '<Leg %s %s>' % (self.uniqueid, self.channel)
+
+
+class Call(object):
+
+    """Channels related by their ``Linkedid``.
+
+    :attr:`complete` is whether all of its legs were hung up (``False`` for
+    evicted calls).
+
+    """
+
+    def __init__(self, linkedid, started):
+        self.linkedid = linkedid
+        self.legs = collections.OrderedDict()  # Uniqueid -> Leg
+        self.started = started
+        self.last_event = started
+        self.ended = None
+        self.complete = False
+
+    def __repr__(self):
+        return '<Call %s>' % self.linkedid
+
+    @property
+    def answered(self):
+        """When the first leg was answered (``None`` if none was)."""
+        times = [leg.answered for leg in self.legs.values() if leg.answered]
+        return min(times) if times else None
+
+    @property
+    def dialed(self):
+        """When the first leg started to be dialed (``None`` if none was)."""
+        times = [leg.dialed for leg in self.legs.values() if leg.dialed]
+        return min(times) if times else None
+
+    @property
+    def ringing(self):
+        """When the first dialed leg started ringing."""
+        times = [leg.ringing for leg in self.legs.values()
+                 if leg.ringing and leg.dialed]
+        return min(times) if times else None
+
+    @property
+    def duration(self):
+        """Seconds from the start to the end (or the last event)."""
+        return (self.ended or self.last_event) - self.started
+
+    @property
+    def billsec(self):
+        """Seconds from the answer to the end (0 if not answered)."""
+        answered = self.answered
+        if answered is None:
+            return 0
+        return (self.ended or self.last_event) - answered
+
+    @property
+    def post_dial_delay(self):
+        """Seconds from the first dial to ringing (or answer), or ``None``."""
+        dialed = self.dialed
+        alerted = self.ringing or self.answered
+        if dialed is None or alerted is None:
+            return None
+        return max(0, alerted - dialed)
+
+    @property
+    def disposition(self):
+        """'ANSWERED', 'BUSY', 'NO ANSWER' or 'FAILED', as in CDRs."""
+        if self.answered is not None:
+            return 'ANSWERED'
+        dialed = [leg for leg in self.legs.values() if leg.dial_status]
+        if dialed:
+            status = dialed[-1].dial_status
+            return _DIAL_STATUS_DISPOSITIONS.get(status, 'FAILED')
+        causes = [leg.cause for leg in self.legs.values() if leg.cause]
+        if causes:
+            return _CAUSE_DISPOSITIONS.get(causes[0], 'FAILED')
+        return 'FAILED'
+
+
+class CallTracker(object):
+
+    """Builds calls (:class:`Call`) from manager events.
+
+    See the module documentation.
+
+    """
+
+    def __init__(self, max_calls=10000, max_age=4 * 3600):
+        self.max_calls = max_calls
+        self.max_age = max_age
+        # Linkedid -> Call, the least recently active first
+        self.calls = collections.OrderedDict()
+        # Uniqueid -> Call
+        self._legs = {}
+        self._complete_callbacks = []
+        self._evicted_callbacks = []
+        self.handlers = {
+            'Newchannel': self._newchannel,
+            'Newstate': self._newstate,
+            'DialBegin': self._dial_begin,
+            'DialEnd': self._dial_end,
+            'Dial': self._dial,
+            'Hangup': self._hangup,
+        }
+
+    def register_complete(self, function):
+        """Register ``function(call, tracker)`` for calls that end."""
+        self._complete_callbacks.append(function)
+
+    def register_evicted(self, function):
+        """Register ``function(call, tracker)`` for calls evicted."""
+        self._evicted_callbacks.append(function)
+
+    def attach(self, manager):
+        """Track the calls of the events received by `manager`."""
+        for name in self.handlers:
+            manager.register_event(name, self.handle_event)
+
+    def detach(self, manager):
+        for name in self.handlers:
+            manager.unregister_event(name, self.handle_event)
+
+    def call_of(self, uniqueid):
+        """Return the call in progress of the channel `uniqueid`, or None."""
+        return self._legs.get(uniqueid)
+
+    def get_state(self):
+        """Return the calls in progress as plain data (see
+        :mod:`py_star.snapshot`)."""
+        state = []
+        for call in self.calls.values():
+            attributes = dict(call.__dict__)
+            attributes['legs'] = [dict(leg.__dict__)
+                                  for leg in call.legs.values()]
+            state.append(attributes)
+        return state
+
+    def set_state(self, state):
+        """Replace the calls in progress by those of :meth:`get_state`."""
+        self.calls.clear()
+        self._legs.clear()
+        for attributes in state:
+            call = Call.__new__(Call)
+            call.__dict__.update(attributes)
+            call.legs = collections.OrderedDict()
+            for leg_attributes in attributes['legs']:
+                leg = Leg.__new__(Leg)
+                leg.__dict__.update(leg_attributes)
+                call.legs[leg.uniqueid] = leg
+                self._legs[leg.uniqueid] = call
+            self.calls[call.linkedid] = call
+
+    def reconcile(self, uniqueids):
+        """Evict the calls none of whose channels are in `uniqueids`.
+
+        Those whose channels all hung up while the events were not
+        received. Channels of other calls that are not there any more are
+        considered hung up then.
+
+        """
+        now = time.time()
+        for call in list(self.calls.values()):
+            for leg in call.legs.values():
+                if leg.hungup is None and leg.uniqueid not in uniqueids:
+                    leg.hungup = now
+            if all(leg.hungup is not None for leg in call.legs.values()):
+                logger.debug("Evicting %r, gone meanwhile" % call)
+                self._remove(call)
+                self._notify(self._evicted_callbacks, call)
+
+    def handle_event(self, event, manager=None):
+        """Update the calls with an event (a manager callback)."""
+        handler = self.handlers.get(event.name)
+        if handler is None:
+            return
+        now = _event_time(event)
+        handler(event, now)
+        self._evict(now)
+
+    def _touch(self, call, now):
+        """Mark `call` as the most recently active."""
+        call.last_event = max(call.last_event, now)
+        del self.calls[call.linkedid]
+        self.calls[call.linkedid] = call
+
+    def _leg(self, event, now, uniqueid_header='Uniqueid',
+             channel_header='Channel'):
+        """Return the call and leg of an event, creating them if needed."""
+        uniqueid = event.get_header(uniqueid_header)
+        if not uniqueid:
+            return None, None
+        call = self._legs.get(uniqueid)
+        if call is None:
+            # the events of Asterisk < 12 have no Linkedid: channels are
+            # calls, merged when they dial each other
+            linkedid = event.get_header('Linkedid') or uniqueid
+            call = self.calls.get(linkedid)
+            if call is None:
+                call = self.calls[linkedid] = Call(linkedid, now)
+            leg = call.legs[uniqueid] = Leg(
+                uniqueid, event.get_header(channel_header), now)
+            self._legs[uniqueid] = call
+        self._touch(call, now)
+        return call, call.legs[uniqueid]
+
+    def _newchannel(self, event, now):
+        call, leg = self._leg(event, now)
+        if leg is not None:
+            leg.caller_id_num = event.get_header('CallerIDNum')
+            leg.context = event.get_header('Context')
+            leg.exten = event.get_header('Exten')
+            self._newstate(event, now)
+
+    def _newstate(self, event, now):
+        call, leg = self._leg(event, now)
+        if leg is None:
+            return
+        state = event.get_header('ChannelState')
+        if state == _RINGING and leg.ringing is None:
+            leg.ringing = now
+        elif state == _UP and leg.answered is None:
+            leg.answered = now
+
+    def _dial_begin(self, event, now):
+        call, leg = self._leg(event, now, 'DestUniqueid', 'DestChannel')
+        if leg is not None and leg.dialed is None:
+            leg.dialed = now
+
+    def _dial_end(self, event, now):
+        call, leg = self._leg(event, now, 'DestUniqueid', 'DestChannel')
+        if leg is not None:
+            leg.dial_status = event.get_header('DialStatus')
+
+    def _dial(self, event, now):
+        # Asterisk < 12: UniqueID (1.8) or SrcUniqueID (1.4) and Source
+        if event.get_header('UniqueID'):
+            uniqueid_header, channel_header = 'UniqueID', 'Channel'
+        else:
+            uniqueid_header, channel_header = 'SrcUniqueID', 'Source'
+        if event.get_header('SubEvent') == 'End':
+            call, leg = self._leg(event, now, uniqueid_header, channel_header)
+            if call is not None:
+                # the status is about the dialed channel, which is unknown
+                for leg in reversed(list(call.legs.values())):
+                    if leg.dialed and leg.dial_status is None:
+                        leg.dial_status = event.get_header('DialStatus')
+                        break
+            return
+        caller, caller_leg = self._leg(event, now, uniqueid_header,
+                                       channel_header)
+        if caller is None or not event.get_header('DestUniqueID'):
+            return
+        call, leg = self._leg(event, now, 'DestUniqueID', 'Destination')
+        if call is not caller:
+            # without Linkedid the dialed channel got a call of its own
+            self._merge(caller, call)
+        if leg.dialed is None:
+            leg.dialed = now
+
+    def _merge(self, call, other):
+        """Move the legs of `other` to `call`."""
+        del self.calls[other.linkedid]
+        for uniqueid, leg in other.legs.items():
+            call.legs[uniqueid] = leg
+            self._legs[uniqueid] = call
+        call.started = min(call.started, other.started)
+
+    def _hangup(self, event, now):
+        call, leg = self._leg(event, now)
+        if leg is None:
+            return
+        leg.hungup = now
+        leg.cause = event.get_header('Cause')
+        leg.cause_txt = event.get_header('Cause-txt')
+        if all(leg.hungup is not None for leg in call.legs.values()):
+            call.ended = now
+            call.complete = True
+            self._remove(call)
+            self._notify(self._complete_callbacks, call)
+
+    def _remove(self, call):
+        del self.calls[call.linkedid]
+        for uniqueid in call.legs:
+            self._legs.pop(uniqueid, None)
+
+    def _evict(self, now):
+        """Evict the calls over `max_calls`, and those inactive for long."""
+        while self.calls:
+            call = next(iter(self.calls.values()))
+            if (len(self.calls) <= self.max_calls and
+                    now - call.last_event < self.max_age):
+                break
+            logger.debug("Evicting %r" % call)
+            self._remove(call)
+            self._notify(self._evicted_callbacks, call)
+
+    def _notify(self, callbacks, call):
+        for callback in callbacks:
+            try:
+                callback(call, self)
+            except Exception:
+                logger.exception("Exception in callback for %r" % call)
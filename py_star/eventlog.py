@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Durable log of manager events
+
+An :class:`EventLog` appends the events received by a
+:class:`~py_star.manager.Manager` to segmented, append-only files, and
+consumers (:class:`EventLogConsumer`) read them back from a stored offset,
+at their own pace and even from other processes. A consumer that is restarted
+resumes where it left off, and a slow one does not hold events in memory.
+
+   import py_star.eventlog
+   import py_star.manager
+
+   # in the process connected to Asterisk
+   log = py_star.eventlog.EventLog('/var/spool/py-star/events')
+   log.attach(manager)
+
+   # in a consumer (same or another process)
+   consumer = py_star.eventlog.EventLogConsumer(
+       '/var/spool/py-star/events', 'billing')
+   while True:
+       events = consumer.poll(max_events=500)
+       for event in events:
+           print ("%d: %s" % (event.offset, event.name))
+       consumer.commit()
+       if not events:
+           time.sleep(1)
+
+Events are numbered from 0 (their *offset*). A segment file
+(``<offset of its first event>.log``) holds records made of a header (the
+size of the event text, its offset and the time it was received) and the
+event text. Its sparse index (``<offset of its first event>.idx``) holds
+the offset, position and time of a record every `index_interval` bytes.
+Offsets committed by consumers are stored in ``<consumer name>.offset``.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import bisect
+import errno
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .manager import _event_from_text, _event_text
+
+logger = logging.getLogger(__name__)
+
+# size of the event text, offset, time received
+_RECORD = struct.Struct('>IQd')
+# offset, position in the segment, time received
+_INDEX = struct.Struct('>QQd')
+
+
+def _log_path(directory, base):
+    return os.path.join(directory, '%020d.log' % base)
+
+
+def _index_path(directory, base):
+    return os.path.join(directory, '%020d.idx' % base)
+
+
+def _segment_bases(directory):
+    """Return the offsets of the first events of the segments, sorted."""
+    bases = []
+    for name in os.listdir(directory):
+        base, ext = os.path.splitext(name)
+        if ext == '.log' and base.isdigit():
+            bases.append(int(base))
+    return sorted(bases)
+
+
+def _read_index(directory, base):
+    """Return the (offset, position, time)s of the index of a segment."""
+    try:
+        with open(_index_path(directory, base), 'rb') as f:
+            data = f.read()
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return []
+    return [_INDEX.unpack_from(data, n)
+            for n in range(0, len(data) - _INDEX.size + 1, _INDEX.size)]
+
+
+def _records(buf, position, end):
+    """Yield the (position, offset, time, text)s of the complete records."""
+    while position + _RECORD.size <= end:
+        size, offset, received = _RECORD.unpack_from(buf, position)
+        start = position + _RECORD.size
+        if start + size > end:
+            break
+        yield position, offset, received, buf[start:start + size]
+        position = start + size
+
+
+class EventLog(object):
+
+    """Writer of an event log in `directory`.
+
+    :param segment_size: bytes after which a new segment is started
+    :param index_interval: bytes between the records in the index
+    :param max_segments: segments kept, older ones are removed (all are
+        kept by default)
+    :param sync: whether to ``fsync`` after each write, for durability in
+        case of a crash of the system (not only of the process)
+
+    A log must have only one writer at a time. When opened, an incomplete
+    record at the end of the log (after a crash) is discarded.
+
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 index_interval=4096, max_segments=None, sync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._log = self._index = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        bases = _segment_bases(directory)
+        if bases:
+            self._recover(bases[-1])
+        else:
+            self._open_segment(0)
+
+    def _recover(self, base):
+        """Open the last segment, dropping what follows its last record."""
+        index = _read_index(self.directory, base)
+        path = _log_path(self.directory, base)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # scan from the last indexed record within the file
+        entries = [entry for entry in index if entry[1] < len(data)]
+        position = entries[-1][1] if entries else 0
+        next_offset = entries[-1][0] if entries else base
+        end = position
+        for position, offset, received, text in _records(data, position,
+                                                         len(data)):
+            end = position + _RECORD.size + len(text)
+            next_offset = offset + 1
+
+        if end < len(data):
+            logger.warning("Discarding %d bytes at the end of %s" %
+                           (len(data) - end, path))
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        if len(entries) < len(index):
+            with open(_index_path(self.directory, base), 'wb') as f:
+                f.write(b''.join(_INDEX.pack(*entry) for entry in entries))
+
+        self._open_segment(base)
+        self.next_offset = next_offset
+        self._position = end
+        self._last_indexed = entries[-1][1] if entries else None
+
+    def _open_segment(self, base):
+        if self._log is not None:
+            self._log.close()
+            self._index.close()
+        self._log = open(_log_path(self.directory, base), 'ab')
+        self._index = open(_index_path(self.directory, base), 'ab')
+        self._base = self.next_offset = base
+        self._position = 0
+        self._last_indexed = None
+
+    def _roll(self):
+        """Start a new segment, removing the oldest ones if needed."""
+        self._open_segment(self.next_offset)
+        if self.max_segments:
+            for base in _segment_bases(self.directory)[:-self.max_segments]:
+                logger.info("Removing segment %d of the event log" % base)
+                os.remove(_log_path(self.directory, base))
+                try:
+                    os.remove(_index_path(self.directory, base))
+                except OSError:
+                    pass
+
+    def _write(self, records, index):
+        self._index.write(b''.join(index))
+        self._log.write(b''.join(records))
+        for f in (self._index, self._log):
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+
+    def append(self, event, received=None):
+        """Append an event, return its offset."""
+        return self.append_many([event], received)
+
+    def append_many(self, events, received=None):
+        """Append events with a single write, return the first offset.
+
+        `received` is the time the events were received (now by default).
+
+        """
+        if received is None:
+            received = time.time()
+        with self._lock:
+            first = self.next_offset
+            records = []
+            index = []
+            for event in events:
+                if self._position >= self.segment_size:
+                    self._write(records, index)
+                    records, index = [], []
+                    self._roll()
+                if (self._last_indexed is None or self._position -
+                        self._last_indexed >= self.index_interval):
+                    index.append(_INDEX.pack(self.next_offset, self._position,
+                                             received))
+                    self._last_indexed = self._position
+                text = _event_text(event).encode('utf-8')
+                records.append(_RECORD.pack(len(text), self.next_offset,
+                                            received))
+                records.append(text)
+                self._position += _RECORD.size + len(text)
+                self.next_offset += 1
+            self._write(records, index)
+        return first
+
+    def attach(self, manager, max_batch=100, max_latency=0.1):
+        """Append all the events received by `manager`.
+
+        Events are written in batches (see
+        :meth:`~py_star.manager.Manager.register_batch`).
+
+        """
+        manager.register_batch('*', self._append_batch, max_batch, max_latency)
+
+    def detach(self, manager):
+        """Stop appending the events received by `manager`."""
+        manager.unregister_batch('*', self._append_batch)
+
+    def _append_batch(self, events, manager):
+        self.append_many(events)
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._index.close()
+                self._log = self._index = None
+
+
+class EventLogReader(object):
+
+    """Reader of the event log in `directory`, from any offset.
+
+    The log can be read while being written (also by another process).
+    Segments are read through ``mmap``.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._map = None
+        self._base = None
+        # where the next sequential read starts: offset, position
+        self._cursor = (None, None)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def first_offset(self):
+        """Return the offset of the oldest event kept."""
+        bases = _segment_bases(self.directory)
+        return bases[0] if bases else 0
+
+    def offset_for_time(self, when):
+        """Return the offset of the first event received at `when` or later.
+
+        Only the times in the indices are considered, so the result can be
+        up to an index interval earlier.
+
+        """
+        result = self.first_offset()
+        for base in _segment_bases(self.directory):
+            index = _read_index(self.directory, base)
+            if not index or index[0][2] > when:
+                break
+            for offset, position, received in index:
+                if received > when:
+                    break
+                result = offset
+        return result
+
+    def _map_segment(self, base):
+        """Map the segment `base` (again if it has grown).
+
+        Return whether the mapping changed.
+
+        """
+        path = _log_path(self.directory, base)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        mapped = len(self._map) if self._map is not None else 0
+        if self._base == base and size == mapped:
+            return False
+        self.close()
+        self._base = base
+        if size:
+            with open(path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def _seek(self, offset):
+        """Map the segment of `offset`, return the position of its record."""
+        bases = _segment_bases(self.directory)
+        if not bases:
+            return None, None
+        if offset < bases[0]:
+            logger.warning("Events %d to %d are no longer in the log" %
+                           (offset, bases[0] - 1))
+            offset = bases[0]
+        base = bases[bisect.bisect_right(bases, offset) - 1]
+        self._map_segment(base)
+        index = _read_index(self.directory, base)
+        n = bisect.bisect_right([entry[0] for entry in index], offset)
+        position = index[n - 1][1] if n else 0
+        if self._map is None:
+            return offset, position
+        # skip the records before `offset`
+        for position, record_offset, received, text in _records(
+                self._map, position, len(self._map)):
+            if record_offset >= offset:
+                break
+        else:
+            position = len(self._map)
+        return offset, position
+
+    def read(self, offset, max_events=100):
+        """Return up to `max_events` events from `offset` on.
+
+        The events returned have their ``offset`` and ``received``
+        attributes set.
+
+        """
+        if self._cursor[0] == offset:
+            position = self._cursor[1]
+        else:
+            offset, position = self._seek(offset)
+            if offset is None:
+                return []
+
+        events = []
+        while len(events) < max_events:
+            if self._map is not None:
+                for position, record_offset, received, text in _records(
+                        self._map, position, len(self._map)):
+                    event = _event_from_text(text.decode('utf-8'))
+                    event.offset = record_offset
+                    event.received = received
+                    events.append(event)
+                    offset = record_offset + 1
+                    position += _RECORD.size + len(text)
+                    if len(events) == max_events:
+                        break
+                if len(events) == max_events:
+                    break
+            # end of the mapped data: the segment may have grown, or a
+            # new one may have been started
+            if self._map_segment(self._base):
+                continue
+            if (offset == self._base or
+                    offset not in _segment_bases(self.directory) or
+                    not self._map_segment(offset)):
+                # nothing more for now
+                break
+            position = 0
+
+        self._cursor = (offset, position)
+        return events
+
+
+class EventLogConsumer(EventLogReader):
+
+    """A reader that remembers where it left off, under the name `name`.
+
+    New consumers start from the oldest event kept.
+
+    """
+
+    def __init__(self, directory, name):
+        super(EventLogConsumer, self).__init__(directory)
+        self.name = name
+        self._offset_path = os.path.join(directory, '%s.offset' % name)
+        try:
+            with open(self._offset_path) as f:
+                self.offset = int(f.read())
+        except (IOError, ValueError):
+            self.offset = self.first_offset()
+        self.committed = self.offset
+
+    def poll(self, max_events=100):
+        """Return the next events (at most `max_events`).
+
+        See :meth:`EventLogReader.read`.
+
+        """
+        events = self.read(self.offset, max_events)
+        if events:
+            self.offset = events[-1].offset + 1
+        return events
+
+    def seek(self, offset):
+        """Continue reading from `offset`."""
+        self.offset = offset
+
+    def commit(self):
+        """Store the offset, so a new consumer called alike resumes here."""
+        if self.offset == self.committed:
+            return
+        tmp_path = self._offset_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('%d' % self.offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._offset_path)
+        self.committed = self.offset
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Distribution of manager events to worker processes
+
+Python callbacks run by :class:`~py_star.manager.Manager` are limited to a
+single core, while opening a manager connection per process loads
+Asterisk. An :class:`EventFanout` reads the events of a single connection
+and sends them, in batches, through pipes to worker processes, each of
+which dispatches them to its callbacks as a manager would.
+
+   import py_star.fanout
+   import py_star.manager
+
+   def handle_hangup(event, worker):
+      print ("Worker %d: hangup of %s" % (worker.index, event['Channel']))
+
+   def setup(worker):
+      # this runs in each worker process
+      worker.register_event('Hangup', handle_hangup)
+
+   manager = py_star.manager.Manager()
+   try:
+       manager.connect('host')
+       manager.login('user', 'secret')
+
+       fanout = py_star.fanout.EventFanout(manager, setup, workers=4)
+       fanout.start()
+       ...
+       fanout.close()
+   finally:
+      manager.close()
+
+With ``shard_header='Linkedid'`` (the default) all the events of a call go
+to the same worker, in order. Events without that header go to the worker
+of their ``Uniqueid``, and to any worker if they don't have one either.
+
+Workers only receive events: their callbacks are given the
+:class:`EventWorker`, which has no actions (``send_action``, ``hangup``...)
+as the pipes only go from the manager to the workers. Workers that must
+act on Asterisk open their own manager connection in `setup`, or hand the
+work back to the parent process by other means (e.g. a
+``multiprocessing`` queue read by a thread of the parent).
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import itertools
+import logging
+import multiprocessing
+import zlib
+
+from .manager import _event_from_text, _event_text
+
+logger = logging.getLogger(__name__)
+
+
+class EventWorker(object):
+
+    """The manager-like side of an :class:`EventFanout` in a worker process.
+
+    Callbacks are registered as with :class:`~py_star.manager.Manager`, and
+    called as ``function(event, worker)``. A worker cannot send actions
+    (see the module documentation).
+
+    """
+
+    def __init__(self, index, connection):
+        self.index = index
+        self._connection = connection
+        self._event_callbacks = {}
+
+    def register_event(self, event, function):
+        """
+        Register a callback for the specfied event.
+        If a callback function returns True, no more callbacks for that
+        event will be executed.
+        """
+        current_callbacks = self._event_callbacks.get(event, [])
+        current_callbacks.append(function)
+        self._event_callbacks[event] = current_callbacks
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        current_callbacks = self._event_callbacks.get(event, [])
+        current_callbacks.remove(function)
+        self._event_callbacks[event] = current_callbacks
+
+    def run(self):
+        """Dispatch the events received until the fan-out is closed."""
+        while True:
+            try:
+                batch = self._connection.recv()
+            except EOFError:
+                break
+            # `None` is the sentinel telling us to finish
+            if batch is None:
+                break
+            for text in batch:
+                self.dispatch(_event_from_text(text))
+
+    def dispatch(self, ev):
+        callbacks = (self._event_callbacks.get(ev.name, []) +
+                     self._event_callbacks.get('*', []))
+        for callback in callbacks:
+            try:
+                if callback(ev, self):
+                    break
+            except Exception:
+                logger.exception("Exception in callback for %s" % ev.name)
+
+
+def _worker_main(index, connection, setup):
+    worker = EventWorker(index, connection)
+    setup(worker)
+    worker.run()
+
+
+class EventFanout(object):
+
+    """Send the events of a manager to `workers` processes.
+
+    `setup` is called in each worker process with its
+    :class:`EventWorker`, to register callbacks. Events are sent in batches
+    of at most `max_batch` events, waiting at most `max_latency` seconds
+    (see :meth:`~py_star.manager.Manager.register_batch`).
+
+    Sending blocks the dispatch thread of the manager when a worker falls
+    behind (and the pipe is full), so slow workers end up slowing down the
+    callbacks of the manager. Workers that went away are restarted (and
+    counted in `restarts`), keeping their index and thus their share of
+    the events.
+
+    """
+
+    def __init__(self, manager, setup, workers=None, shard_header='Linkedid',
+                 max_batch=100, max_latency=0.05):
+        self.manager = manager
+        self.setup = setup
+        self.workers = workers or multiprocessing.cpu_count()
+        self.shard_header = shard_header
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.processes = []
+        self.restarts = 0
+        self._connections = []
+        self._round_robin = itertools.cycle(range(self.workers))
+
+    def start(self):
+        """Start the worker processes and begin sending them events."""
+        for index in range(self.workers):
+            process, connection = self._start_worker(index)
+            self.processes.append(process)
+            self._connections.append(connection)
+        self.manager.register_batch('*', self._send, self.max_batch,
+                                    self.max_latency)
+
+    def _start_worker(self, index):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_worker_main, args=(index, reader, self.setup),
+            name='EventWorker-%d' % index)
+        process.daemon = True
+        process.start()
+        reader.close()
+        return process, writer
+
+    def _restart_worker(self, index):
+        process = self.processes[index]
+        self._connections[index].close()
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        self.processes[index], self._connections[index] = (
+            self._start_worker(index))
+        self.restarts += 1
+
+    def close(self, timeout=5):
+        """Stop sending events and wait for the workers to finish."""
+        if not self.processes:
+            return
+        self.manager.unregister_batch('*', self._send)
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Terminating %s" % process.name)
+                process.terminate()
+        self.processes = []
+        self._connections = []
+
+    def worker_for(self, event):
+        """Return the index of the worker `event` goes to."""
+        key = None
+        if self.shard_header:
+            key = (event.get_header(self.shard_header) or
+                   event.get_header('Uniqueid'))
+        if not key:
+            return next(self._round_robin)
+        return zlib.crc32(key.encode('utf-8')) % self.workers
+
+    def _send(self, events, manager):
+        batches = [[] for connection in self._connections]
+        for event in events:
+            batches[self.worker_for(event)].append(_event_text(event))
+        for index, batch in enumerate(batches):
+            if not batch:
+                continue
+            try:
+                self._connections[index].send(batch)
+            except (IOError, OSError, EOFError) as err:
+                logger.error("Worker %d went away (%s), restarting it" %
+                             (index, err))
+                self._restart_worker(index)
+                try:
+                    self._connections[index].send(batch)
+                except (IOError, OSError, EOFError) as err:
+                    logger.error("Dropped %d events of worker %d: %s" %
+                                 (len(batch), index, err))
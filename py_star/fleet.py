@@ -0,0 +1,579 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Multiplexing of many Asterisk manager connections
+
+:class:`~py_star.manager.Manager` uses three threads and a few queues per
+connection, which does not scale to hundreds of Asterisk boxes. A
+:class:`ManagerFleet` keeps all its connections in a single I/O thread
+(polling non-blocking sockets) and dispatches the merged event stream from
+a single thread.
+
+   import py_star.fleet
+
+   def handle_event(event, fleet):
+      print ("%s: received event %s" % (event.node, event.name))
+
+   fleet = py_star.fleet.ManagerFleet()
+   try:
+       fleet.add_node('pbx1', 'pbx1.example.com', username='user', secret='secret')
+       fleet.add_node('pbx2', 'pbx2.example.com', username='user', secret='secret')
+       fleet.register_event('*', handle_event)
+
+       for node, error in fleet.connect().items():
+           if isinstance(error, Exception):
+               print ("Could not connect to %s: %s" % (node, error))
+
+       # run an action on all the nodes, waiting at most 5 seconds for each
+       for node, response in fleet.sippeers(timeout=5).items():
+           if isinstance(response, Exception):
+               print ("%s failed: %s" % (node, response))
+           else:
+               print ("%s has %d peers" % (node, len(response.events)))
+   finally:
+      fleet.close()
+
+Events are tagged with the name of the node they come from (``event.node``).
+Responses to actions whose results come as a list of events (those
+answered with an ``EventList: start`` header, like ``Sippeers``) are not
+resolved until the list is complete, and carry the list in
+``response.events``.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import errno
+import itertools
+import logging
+import math
+import os
+import select
+import socket
+import threading
+import time
+
+from . import compat_six as six
+from six.moves import queue
+
+from .manager import (
+    Event, Future, ManagerAuthException, ManagerException, ManagerMessage,
+    ManagerSocketException, ManagerTimeoutException, _MessageFramer,
+    _format_action,
+)
+
+logger = logging.getLogger(__name__)
+
+# time source for measuring intervals (Python 2 has no monotonic clock)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class _FleetNode(object):
+
+    """A connection of a :class:`ManagerFleet`."""
+
+    def __init__(self, name, host, port, username, secret):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+
+        self.sock = None
+        # when to give up connecting (`_monotonic` time), if connecting
+        self.deadline = None
+        self.title = None
+        self.version = None
+        self._framer = None
+        self._inbuf = b''
+        self._outbuf = b''
+
+        # ActionID -> future waiting for the response
+        self.pending = {}
+        # ActionID -> (future, response) waiting for the end of an event list
+        self.lists = {}
+
+    def is_connected(self):
+        return self.sock is not None
+
+    def connect(self, timeout):
+        """Start connecting to the (first) address of the host.
+
+        The connection is finished by :meth:`finish_connect` in the I/O
+        loop, within `timeout` seconds.
+
+        """
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        self._framer = _MessageFramer()
+        self._inbuf = self._outbuf = b''
+        self.deadline = _monotonic() + timeout
+        self.sock = sock
+
+    def is_connecting(self):
+        return self.deadline is not None
+
+    def finish_connect(self):
+        """Check the outcome of the connection, once the socket is ready.
+
+        Raise :exc:`socket.error` if it failed.
+
+        """
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        self.deadline = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_write(self):
+        return bool(self._outbuf) or self.is_connecting()
+
+    def write(self, data):
+        self._outbuf += data
+
+    def flush(self):
+        """Write as much of the output buffer as the socket accepts."""
+        try:
+            sent = self.sock.send(self._outbuf)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        self._outbuf = self._outbuf[sent:]
+
+    def read(self):
+        """Read from the socket, return the complete messages received.
+
+        Raise :exc:`EOFError` if the connection was closed by the other end.
+
+        """
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise
+        if not data:
+            raise EOFError()
+
+        messages = []
+        lines = (self._inbuf + data).split(b'\n')
+        # the last item is an incomplete line (or empty)
+        self._inbuf = lines.pop()
+        for line in lines:
+            message = self._framer.feed(line.decode('utf-8') + '\n')
+            if message:
+                messages.append(ManagerMessage(message))
+        if self._framer.title and not self.title:
+            self.title = self._framer.title
+            self.version = self._framer.version
+        return messages
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.deadline = None
+
+
+class ManagerFleet(object):
+
+    """Many manager interface connections sharing two threads.
+
+    One thread does the I/O of all the connections, the other one runs
+    the event callbacks. Actions are sent with :meth:`send_action` (a
+    single node) or :meth:`fan_out` (many nodes in parallel).
+
+    As in :class:`~py_star.manager.Manager`, errors happening in threads
+    are logged and a message is added to :attr:`errors_in_threads`.
+
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+
+        # ActionID generation (`next` on a count is atomic)
+        self.hostname = socket.gethostname()
+        self.pid = os.getpid()
+        self._seq = itertools.count()
+
+        self._event_queue = queue.Queue()
+        self.errors_in_threads = queue.Queue()
+        self._event_callbacks = {}
+
+        # used to wake up the I/O thread when there is something to write
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+        self.io_thread = threading.Thread(target=self.io_loop)
+        self.event_dispatch_thread = threading.Thread(target=self.event_dispatch)
+        self.io_thread.setDaemon(True)
+        self.event_dispatch_thread.setDaemon(True)
+
+        self._sentinel = object()
+
+    def __del__(self):
+        self.close()
+
+    def is_running(self):
+        """Return whether we are running or not."""
+        return self._running.isSet()
+
+    def add_node(self, name, host, port=5038, username=None, secret=None):
+        """Add an Asterisk box. It is connected to by :meth:`connect`."""
+        if name in self._nodes:
+            raise ManagerException('Node %s already added' % name)
+        assert isinstance(host, six.string_types)
+        self._nodes[name] = _FleetNode(name, host, int(port), username, secret)
+
+    def nodes(self):
+        """Return the names of the nodes."""
+        return list(self._nodes)
+
+    def node(self, name):
+        """Return the node called `name`."""
+        try:
+            return self._nodes[name]
+        except KeyError:
+            raise ManagerException('Unknown node %s' % name)
+
+    def connect(self, nodes=None, timeout=10):
+        """Connect to (and log in to) the nodes that are not connected.
+
+        The nodes are connected to in parallel, waiting at most `timeout`
+        seconds for each. Connection errors do not stop the others nodes
+        from connecting.
+
+        :return: dict mapping the names of the nodes to the response to
+            the login action, or to the exception raised
+
+        """
+        if nodes is None:
+            nodes = self.nodes()
+
+        results = {}
+        logins = {}
+        for name in nodes:
+            node = self.node(name)
+            if node.is_connected():
+                continue
+            future = Future()
+            try:
+                with self._lock:
+                    node.connect(timeout)
+                    # sent once connected
+                    self._queue_action(node, future, {
+                        'Action': 'Login',
+                        'Username': node.username,
+                        'Secret': node.secret,
+                    })
+            except socket.error as err:
+                results[name] = ManagerSocketException(*err.args)
+            else:
+                logins[name] = future
+
+        if not self.is_running():
+            self._running.set()
+            self.io_thread.start()
+            self.event_dispatch_thread.start()
+        self._wakeup()
+
+        for name, response in self._collect(logins, timeout).items():
+            if (not isinstance(response, Exception) and
+                    response.get_header('Response') == 'Error'):
+                response = ManagerAuthException(response.get_header('Message'))
+            results[name] = response
+        return results
+
+    def close(self):
+        """Log off and close all the connections, and stop the threads."""
+        if self._wakeup_r is None:
+            return
+        if not self.is_running():
+            self._close_wakeup()
+            return
+
+        connected = [name for name, node in self._nodes.items()
+                     if node.is_connected()]
+        self.fan_out({'Action': 'Logoff'}, nodes=connected, timeout=1)
+
+        self._running.clear()
+        self._wakeup()
+        if threading.currentThread() != self.io_thread:
+            self.io_thread.join()
+        self._event_queue.put(self._sentinel)
+        if threading.currentThread() != self.event_dispatch_thread:
+            self.event_dispatch_thread.join()
+
+        for node in self._nodes.values():
+            self._drop(node, 'Fleet closed')
+        self._close_wakeup()
+
+    def next_action_id(self):
+        """Return a new ActionID."""
+        return '%s-%04s-%08x' % (self.hostname, self.pid, next(self._seq))
+
+    def send_action(self, node, cdict=None, **kwargs):
+        """Send an action to `node`.
+
+        See :meth:`py_star.manager.Manager.send_action` about the
+        arguments.
+
+        :return: a :class:`~py_star.manager.Future` for the response
+
+        """
+        future = Future()
+        node = self.node(node)
+        with self._lock:
+            if not node.is_connected():
+                future.set_exception(ManagerException("Not connected"))
+                return future
+            self._queue_action(node, future, dict(cdict or {}, **kwargs))
+        self._wakeup()
+        return future
+
+    def _queue_action(self, node, future, cdict):
+        """Add an action to the output of `node`, the lock being held."""
+        cdict.setdefault('ActionID', self.next_action_id())
+        node.pending[cdict['ActionID']] = future
+        node.write(_format_action(cdict).encode('utf-8'))
+
+    def fan_out(self, cdict=None, nodes=None, timeout=None, **kwargs):
+        """Send an action to many nodes (all by default) in parallel.
+
+        Wait at most `timeout` seconds for the responses of each node
+        (as they are waited in parallel, that is also the total time).
+
+        :return: dict mapping the names of the nodes to their response,
+            or to the exception raised (:exc:`ManagerTimeoutException` if
+            the node did not answer in time)
+
+        """
+        if nodes is None:
+            nodes = self.nodes()
+        futures = dict((name, self.send_action(name, cdict, **kwargs))
+                       for name in nodes)
+        return self._collect(futures, timeout)
+
+    def _collect(self, futures, timeout):
+        """Wait for the results of a dict of futures."""
+        deadline = None if timeout is None else _monotonic() + timeout
+        results = {}
+        for name, future in futures.items():
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - _monotonic())
+            try:
+                results[name] = future.result(remaining)
+            except ManagerTimeoutException as err:
+                self._forget(self._nodes[name], future)
+                results[name] = err
+            except ManagerException as err:
+                results[name] = err
+        return results
+
+    def _forget(self, node, future):
+        """Stop waiting for the response related to `future`."""
+        with self._lock:
+            for table in (node.pending, node.lists):
+                for action_id, value in list(table.items()):
+                    if value is future or (isinstance(value, tuple) and
+                                           value[0] is future):
+                        del table[action_id]
+
+    def register_event(self, event, function):
+        """
+        Register a callback for the specfied event.
+        If a callback function returns True, no more callbacks for that
+        event will be executed.
+        """
+        self._event_callbacks.setdefault(event, []).append(function)
+
+    def unregister_event(self, event, function):
+        """
+        Unregister a callback for the specified event.
+        """
+        self._event_callbacks.get(event, []).remove(function)
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, b'x')
+
+    def _close_wakeup(self):
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._wakeup_r = self._wakeup_w = None
+
+    def _poll(self, nodes, timeout=None):
+        """Wait for I/O on the nodes (at most `timeout` seconds), return the
+        ready (fd, read, write)s."""
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self._wakeup_r, select.POLLIN)
+            for node in nodes:
+                mask = select.POLLIN
+                if node.wants_write():
+                    mask |= select.POLLOUT
+                poller.register(node.fileno(), mask)
+            error_mask = select.POLLIN | select.POLLHUP | select.POLLERR
+            return [(fd, bool(mask & error_mask), bool(mask & select.POLLOUT))
+                    for fd, mask in poller.poll(
+                        None if timeout is None
+                        else int(math.ceil(timeout * 1000)))]
+        rlist = [self._wakeup_r] + [node.fileno() for node in nodes]
+        wlist = [node.fileno() for node in nodes if node.wants_write()]
+        readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        return ([(fd, True, False) for fd in readable] +
+                [(fd, False, True) for fd in writable])
+
+    def io_loop(self):
+        """The method for the I/O thread (reading and writing sockets)."""
+        while self.is_running():
+            with self._lock:
+                nodes = dict((node.fileno(), node)
+                             for node in self._nodes.values()
+                             if node.is_connected())
+            deadlines = [node.deadline for node in nodes.values()
+                         if node.is_connecting()]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - _monotonic())
+            try:
+                ready = self._poll(nodes.values(), timeout)
+            except (select.error, socket.error) as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, readable, writable in ready:
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                    continue
+                node = nodes[fd]
+                if node.is_connecting():
+                    try:
+                        node.finish_connect()
+                    except socket.error as err:
+                        # reported by `connect` (the login fails)
+                        self._drop(node, err.args[1], err.args[0])
+                        continue
+                try:
+                    if writable:
+                        with self._lock:
+                            node.flush()
+                    if readable:
+                        for message in node.read():
+                            self._handle_message(node, message)
+                except (EOFError, socket.error) as err:
+                    if self.is_running():
+                        msg = "Connection to %s lost" % node.name
+                        logger.warning("%s: %r" % (msg, err))
+                        self.errors_in_threads.put(msg)
+                    self._drop(node, 'Connection Terminated')
+                except Exception:
+                    # e.g. what a node sent can't be decoded: only that
+                    # node is dropped, not the whole loop
+                    msg = "Error handling the connection to %s" % node.name
+                    logger.exception(msg)
+                    self.errors_in_threads.put(msg)
+                    self._drop(node, msg)
+
+            now = _monotonic()
+            for node in nodes.values():
+                if node.is_connecting() and node.deadline <= now:
+                    self._drop(node, 'Connection timed out', errno.ETIMEDOUT)
+
+    def _drop(self, node, reason, error=0):
+        """Close the connection of `node`, failing its pending actions."""
+        with self._lock:
+            node.close()
+            futures = list(node.pending.values())
+            futures.extend(future for future, _ in node.lists.values())
+            node.pending.clear()
+            node.lists.clear()
+        for future in futures:
+            future.set_exception(ManagerSocketException(error, reason))
+
+    def _handle_message(self, node, message):
+        action_id = message.get_header('ActionID')
+        if message.has_header('Event'):
+            event = Event(message)
+            event.node = node.name
+            with self._lock:
+                collecting = node.lists.get(action_id)
+                if collecting and event.get_header('EventList') == 'Complete':
+                    del node.lists[action_id]
+            if collecting:
+                future, response = collecting
+                if event.get_header('EventList') == 'Complete':
+                    future.set_result(response)
+                else:
+                    response.events.append(event)
+            self._event_queue.put(event)
+        elif message.has_header('Response'):
+            with self._lock:
+                future = node.pending.pop(action_id, None)
+                if (future is not None and
+                        message.get_header('EventList') == 'start'):
+                    message.events = []
+                    node.lists[action_id] = (future, message)
+                    future = None
+            if future is not None:
+                future.set_result(message)
+            elif action_id is not None and action_id not in node.lists:
+                logger.debug("Unexpected response from %s: %s" %
+                             (node.name, action_id))
+
+    def event_dispatch(self):
+        """This thread is responsible for dispatching events"""
+        while True:
+            ev = self._event_queue.get()
+            if ev is self._sentinel:
+                logger.info("Got sentinel object. Will break dispatch loop")
+                break
+
+            callbacks = (self._event_callbacks.get(ev.name, []) +
+                         self._event_callbacks.get('*', []))
+            for callback in callbacks:
+                try:
+                    if callback(ev, self):
+                        break
+                except Exception:
+                    msg = "Exception in callback for %s" % ev.name
+                    logger.exception(msg)
+                    self.errors_in_threads.put(msg)
+
+# Fleet actions
+
+    def ping(self, nodes=None, timeout=None):
+        """Send a ping action to the nodes.
+
+        :return: dict of responses (see :meth:`fan_out`)
+
+        """
+        return self.fan_out({'Action': 'Ping'}, nodes=nodes, timeout=timeout)
+
+    def sippeers(self, nodes=None, timeout=None):
+        """List the SIP peers of the nodes.
+
+        :return: dict of responses (see :meth:`fan_out`), the peers are the
+            ``PeerEntry`` events in ``response.events``
+
+        """
+        return self.fan_out({'Action': 'Sippeers'}, nodes=nodes,
+                            timeout=timeout)
+
+    def command(self, command, nodes=None, timeout=None):
+        """Execute a command on the nodes.
+
+        :return: dict of responses (see :meth:`fan_out`)
+
+        """
+        return self.fan_out({'Action': 'Command', 'Command': command},
+                            nodes=nodes, timeout=timeout)
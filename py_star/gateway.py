@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+HTTP gateway streaming manager events to browsers
+
+An :class:`EventGateway` serves the events received by a
+:class:`~py_star.manager.Manager` over HTTP, as server-sent events or
+through WebSockets, to any number of subscribers.
+
+   import py_star.gateway
+
+   gateway = py_star.gateway.EventGateway(manager, port=8088)
+   gateway.start()
+   ...
+   gateway.close()
+
+Subscribers choose the events they get with the query string of the URL:
+``events`` is a comma separated list of event names (all events if
+missing), and other parameters are headers the events must have, e.g.
+``/events?events=Hangup,Newchannel&Context=from-internal``. Events are
+sent as JSON objects of their headers, as ``data`` of server-sent events
+named after the events, or as WebSocket text messages.
+
+Each event is encoded once, whatever the number of subscribers. Events
+are queued for each subscriber, up to `max_queue`: those of subscribers
+that do not keep up are dropped (and counted in their ``dropped``
+attribute). Every subscriber is served by a thread of its own.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import base64
+import collections
+import hashlib
+import json
+import logging
+import socket
+import struct
+import threading
+
+from . import compat_six as six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qsl, urlparse
+
+logger = logging.getLogger(__name__)
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# frames sent to subscribers that have not been sent anything for a while,
+# to find out those that went away
+_SSE_KEEPALIVE = b': keepalive\n\n'
+_WEBSOCKET_PING = b'\x89\x00'
+
+
+# opcodes of WebSocket frames, with the final bit
+_WEBSOCKET_TEXT = 0x81
+_WEBSOCKET_CLOSE = 0x88
+_WEBSOCKET_PONG = 0x8A
+
+
+def _websocket_frame(payload, opcode=_WEBSOCKET_TEXT):
+    """Return a final, unmasked WebSocket frame of `payload`."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('>BBH', opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', opcode, 127, length)
+    return header + payload
+
+
+def _read_websocket_frame(rfile):
+    """Read a WebSocket frame from `rfile`.
+
+    :return: the opcode and the unmasked payload of the frame, or ``None``
+        at the end of the stream
+
+    """
+    header = rfile.read(2)
+    if len(header) < 2:
+        return None
+    first, second = struct.unpack('>BB', header)
+    length = second & 0x7f
+    if length == 126:
+        data = rfile.read(2)
+        if len(data) < 2:
+            return None
+        length, = struct.unpack('>H', data)
+    elif length == 127:
+        data = rfile.read(8)
+        if len(data) < 8:
+            return None
+        length, = struct.unpack('>Q', data)
+    mask = rfile.read(4) if second & 0x80 else b''
+    payload = rfile.read(length)
+    if len(payload) < length or len(mask) < (4 if second & 0x80 else 0):
+        return None
+    if mask:
+        mask = bytearray(mask)
+        payload = bytes(bytearray(b ^ mask[i % 4]
+                                  for i, b in enumerate(bytearray(payload))))
+    return first & 0x0f, payload
+
+
+class _EncodedEvent(object):
+
+    """An event with its encodings, computed at most once."""
+
+    __slots__ = ('event', '_json', '_sse', '_websocket')
+
+    def __init__(self, event):
+        self.event = event
+        self._json = self._sse = self._websocket = None
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.event.headers,
+                                    sort_keys=True).encode('utf-8')
+        return self._json
+
+    def sse(self):
+        if self._sse is None:
+            self._sse = (('event: %s\ndata: ' % self.event.name).encode(
+                'utf-8') + self.json() + b'\n\n')
+        return self._sse
+
+    def websocket(self):
+        if self._websocket is None:
+            self._websocket = _websocket_frame(self.json())
+        return self._websocket
+
+
+class _Subscriber(object):
+
+    """A connection getting events, with its queue."""
+
+    def __init__(self, names, match, websocket, max_queue):
+        self.names = names  # None for all events
+        self.match = match
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._out = collections.deque()
+        self._control = []  # WebSocket control frames to send first
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def wants(self, event):
+        for header, value in self.match.items():
+            if event.get_header(header) != value:
+                return False
+        return True
+
+    def send(self, encoded):
+        with self._condition:
+            if len(self._out) >= self.max_queue:
+                if not self.dropped:
+                    logger.warning("Subscriber does not keep up, "
+                                   "dropping events")
+                self.dropped += 1
+                return
+            self._out.append(encoded)
+            self._condition.notify()
+
+    def send_control(self, frame):
+        """Send the WebSocket control `frame` before the events queued."""
+        with self._condition:
+            self._control.append(frame)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def run(self, wfile, keepalive):
+        """Write the events queued to `wfile` until closed."""
+        while True:
+            with self._condition:
+                if not self._out and not self._control and not self._closed:
+                    self._condition.wait(keepalive)
+                control, self._control = self._control, []
+                if self._closed and not control:
+                    return
+                encoded = [] if self._closed else list(self._out)
+                self._out.clear()
+            if self.websocket:
+                data = b''.join(control) + b''.join(
+                    e.websocket() for e in encoded)
+            else:
+                data = b''.join(e.sse() for e in encoded)
+            if not data:
+                data = _WEBSOCKET_PING if self.websocket else _SSE_KEEPALIVE
+            wfile.write(data)
+            wfile.flush()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # WebSocket handshakes are answered in HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        gateway = self.server.gateway
+        url = urlparse(self.path)
+        if url.path != gateway.path:
+            self.send_error(404)
+            return
+        match = dict(parse_qsl(url.query))
+        names = match.pop('events', None)
+        names = set(names.split(',')) if names else None
+
+        websocket = self.headers.get('Upgrade', '').lower() == 'websocket'
+        if websocket:
+            key = self.headers.get('Sec-WebSocket-Key')
+            if not key:
+                self.send_error(400)
+                return
+            accept = base64.b64encode(hashlib.sha1(
+                (key + _WEBSOCKET_GUID).encode('ascii')).digest())
+            self.send_response(101, 'Switching Protocols')
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', accept.decode('ascii'))
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+        # the events are streamed until either side closes the connection
+        self.close_connection = True
+
+        subscriber = _Subscriber(names, match, websocket, gateway.max_queue)
+        gateway._subscribe(subscriber)
+        try:
+            self.end_headers()
+            self.wfile.flush()
+            if websocket:
+                reader = threading.Thread(target=self._read_websocket,
+                                          args=(subscriber,),
+                                          name='EventGateway reader')
+                reader.setDaemon(True)
+                reader.start()
+            subscriber.run(self.wfile, gateway.keepalive)
+        except socket.error:
+            logger.debug("Subscriber %s went away" % self.address_string())
+        finally:
+            gateway._unsubscribe(subscriber)
+
+    def _read_websocket(self, subscriber):
+        """Answer the control frames of the client, until it goes away."""
+        try:
+            while True:
+                frame = _read_websocket_frame(self.rfile)
+                if frame is None:
+                    logger.debug("Subscriber %s went away" %
+                                 self.address_string())
+                    break
+                opcode, payload = frame
+                if opcode == 0x8:
+                    # echo the status code, if any
+                    subscriber.send_control(
+                        _websocket_frame(payload[:2], _WEBSOCKET_CLOSE))
+                    break
+                elif opcode == 0x9:
+                    subscriber.send_control(
+                        _websocket_frame(payload, _WEBSOCKET_PONG))
+                # messages and pongs are ignored
+        except (socket.error, ValueError):
+            logger.debug("Subscriber %s went away" % self.address_string())
+        finally:
+            subscriber.close()
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class EventGateway(object):
+
+    """Serve the events of `manager` over HTTP on `host` and `port`.
+
+    :param path: path of the URL of the events
+    :param max_queue: events queued for a subscriber, beyond which they
+        are dropped
+    :param keepalive: seconds without events after which something is
+        sent anyway, to notice subscribers that went away
+
+    See the module documentation.
+
+    """
+
+    def __init__(self, manager, host='127.0.0.1', port=8088, path='/events',
+                 max_queue=1000, keepalive=15):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_queue = max_queue
+        self.keepalive = keepalive
+        self.address = None
+        self._server = None
+        self._lock = threading.Lock()
+        # event name (None for all) -> subscribers
+        self._subscribers = {}
+
+    def start(self):
+        """Start serving, in a thread of its own."""
+        self._server = _HTTPServer((self.host, self.port), _RequestHandler)
+        self._server.gateway = self
+        self.address = self._server.server_address
+        self.manager.register_event('*', self._dispatch)
+        t = threading.Thread(target=self._server.serve_forever,
+                             name='EventGateway')
+        t.setDaemon(True)
+        t.start()
+
+    def close(self):
+        """Stop serving and disconnect the subscribers."""
+        if self._server is None:
+            return
+        self.manager.unregister_event('*', self._dispatch)
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        for subscriber in self.subscribers():
+            subscriber.close()
+
+    def subscribers(self):
+        """Return the subscribers connected."""
+        with self._lock:
+            return list(set(s for subscribers in self._subscribers.values()
+                            for s in subscribers))
+
+    def _subscribe(self, subscriber):
+        with self._lock:
+            for name in subscriber.names or (None,):
+                subscribers = self._subscribers.get(name, ())
+                self._subscribers[name] = subscribers + (subscriber,)
+
+    def _unsubscribe(self, subscriber):
+        with self._lock:
+            for name in subscriber.names or (None,):
+                subscribers = tuple(s for s in self._subscribers.get(name, ())
+                                    if s is not subscriber)
+                if subscribers:
+                    self._subscribers[name] = subscribers
+                else:
+                    self._subscribers.pop(name, None)
+
+    def _dispatch(self, event, manager):
+        # the tuples of subscribers are replaced, never changed
+        subscribers = (self._subscribers.get(event.name, ()) +
+                       self._subscribers.get(None, ()))
+        if not subscribers:
+            return
+        encoded = _EncodedEvent(event)
+        for subscriber in subscribers:
+            if subscriber.wants(event):
+                subscriber.send(encoded)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Table of the states of the hints (BLF and presence)
+
+A :class:`HintTable` loads the state of all the hints once
+(``ExtensionStateList``) and then keeps it up to date from the
+``ExtensionStatus``, ``PresenceStatus``, ``PresenceStateChange`` and
+``DeviceStateChange`` events, so the state of an extension is a local
+lookup instead of an ``ExtensionState`` action.
+
+   import py_star.hints
+
+   def handle_change(hint, table):
+      print ("%s@%s is %s" % (hint.exten, hint.context, hint.status_text))
+
+   hints = py_star.hints.HintTable()
+   hints.attach(manager)
+   hints.seed(manager)
+
+   hints.subscribe([('100', 'default'), ('101', 'default')], handle_change)
+   print (hints.state('100', 'default').status)
+
+``ExtensionStateList`` requires Asterisk 13 or later, hints are otherwise
+only known once their state changes.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import threading
+
+from .manager import ManagerException, ManagerTimeoutException
+
+logger = logging.getLogger(__name__)
+
+# statuses of hints that no longer exist
+_REMOVED_STATUSES = frozenset((-1, -2))
+
+
+def _int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class Hint(object):
+
+    """The state of the hint of an extension.
+
+    :attr:`status` is the extension state as a number (0 idle, 1 in use,
+    2 busy, 4 unavailable, 8 ringing, 16 on hold, or combinations).
+    :attr:`devices` and :attr:`presentity` are parsed from :attr:`hint`.
+
+    """
+
+    def __init__(self, exten, context):
+        self.exten = exten
+        self.context = context
+        self.hint = None
+        self.devices = ()
+        self.presentity = None
+        self.status = None
+        self.status_text = None
+        self.presence = None
+        self.presence_subtype = None
+        self.presence_message = None
+
+    def __repr__(self):
+        return '<Hint %s@%s>' % (self.exten, self.context)
+
+    def _set_hint(self, hint):
+        self.hint = hint
+        devices, sep, presentity = hint.partition(',')
+        self.devices = tuple(d for d in devices.split('&') if d)
+        self.presentity = presentity or None
+
+    def as_dict(self):
+        """Return the state as a dict (e.g. to be encoded in JSON)."""
+        return {
+            'exten': self.exten,
+            'context': self.context,
+            'hint': self.hint,
+            'status': self.status,
+            'status_text': self.status_text,
+            'presence': self.presence,
+            'presence_subtype': self.presence_subtype,
+            'presence_message': self.presence_message,
+        }
+
+
+class Subscription(object):
+
+    """Callback for changes of a set of extensions (see
+    :meth:`HintTable.subscribe`)."""
+
+    def __init__(self, keys, function):
+        self.keys = frozenset(keys)
+        self.function = function
+
+
+class HintTable(object):
+
+    """The hints (:class:`Hint`) by ``(exten, context)``, kept up to date.
+
+    See the module documentation. The table can be read from any thread.
+
+    """
+
+    def __init__(self):
+        self.hints = {}
+        self.device_states = {}  # device -> state, e.g. 'NOT_INUSE'
+        self._lock = threading.Lock()
+        # (exten, context) -> subscriptions
+        self._subscriptions = {}
+        # presentity -> keys of the hints with that presentity
+        self._presentities = {}
+        self._seeding = {}  # ActionID -> threading.Event
+        # devices whose state listed differed from the one known
+        self._changed_devices = set()
+        self.handlers = {
+            'ExtensionStatus': self._extension_status,
+            'PresenceStatus': self._presence_status,
+            'PresenceStateChange': self._presence_state_change,
+            'DeviceStateChange': self._device_state_change,
+            'ExtensionStateListComplete': self._list_complete,
+        }
+
+    def attach(self, manager):
+        """Keep up to date with the events received by `manager`."""
+        for name in self.handlers:
+            manager.register_event(name, self.handle_event)
+
+    def detach(self, manager):
+        for name in self.handlers:
+            manager.unregister_event(name, self.handle_event)
+
+    def seed(self, manager, timeout=10):
+        """Load the state of all the hints with ExtensionStateList.
+
+        The table must be attached to `manager` first, and this must not
+        be called from a callback, as the state is loaded from the events
+        received, by the dispatch thread.
+
+        :raises ManagerTimeoutException: if the list is not received in
+            `timeout` seconds
+
+        """
+        self._seed(manager, timeout)
+
+    def resync(self, manager, timeout=10):
+        """Load again the state of the hints whose devices changed state.
+
+        For warm starts (see :mod:`py_star.snapshot`): the devices are
+        those of a ``DeviceStateList`` received since the state was
+        loaded, whose state is not the one known. Only their hints are
+        asked for (``ExtensionState``), or all of them if that is most of
+        the hints. Hints added or removed meanwhile are otherwise only
+        known by their next events.
+
+        """
+        with self._lock:
+            changed = self._changed_devices
+            self._changed_devices = set()
+            keys = [key for key, hint in self.hints.items()
+                    if changed.intersection(hint.devices)]
+        if not keys:
+            return
+        if len(keys) > len(self.hints) // 2:
+            self._seed(manager, timeout)
+            return
+        futures = manager.send_actions([
+            {'Action': 'ExtensionState', 'Exten': exten, 'Context': context}
+            for exten, context in keys])
+        for future in futures:
+            response = future.result(timeout)
+            if response.get_header('Response') == 'Success':
+                self._update(self._extension_status, response)
+
+    def _seed(self, manager, timeout):
+        action_id = manager.next_action_id()
+        complete = self._seeding[action_id] = threading.Event()
+        try:
+            response = manager.send_action(
+                {'Action': 'ExtensionStateList', 'ActionID': action_id})
+            if response.get_header('Response') != 'Success':
+                raise ManagerException(response.get_header('Message'))
+            if not complete.wait(timeout):
+                raise ManagerTimeoutException(
+                    'ExtensionStateList not complete in %s seconds' % timeout)
+        finally:
+            self._seeding.pop(action_id, None)
+
+    def state(self, exten, context):
+        """Return the :class:`Hint` of an extension, or None."""
+        return self.hints.get((exten, context))
+
+    def subscribe(self, extensions, function):
+        """Call ``function(hint, table)`` when an extension changes state.
+
+        `extensions` are ``(exten, context)`` pairs. The callbacks are
+        called by the dispatch thread of the manager, and are indexed by
+        extension, so that subscriptions to many extensions are cheap.
+
+        :return: the subscription, for :meth:`unsubscribe`
+
+        """
+        subscription = Subscription(extensions, function)
+        with self._lock:
+            for key in subscription.keys:
+                self._subscriptions.setdefault(key, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscriptions = self._subscriptions.get(key, [])
+                if subscription in subscriptions:
+                    subscriptions.remove(subscription)
+                if not subscriptions:
+                    self._subscriptions.pop(key, None)
+
+    def snapshot(self):
+        """Return the state of all the hints as a list of dicts."""
+        with self._lock:
+            hints = list(self.hints.values())
+            return [hint.as_dict() for hint in hints]
+
+    def get_state(self):
+        """Return the hints as plain data (see :mod:`py_star.snapshot`)."""
+        with self._lock:
+            return {
+                'hints': [dict(hint.__dict__, devices=list(hint.devices))
+                          for hint in self.hints.values()],
+                'device_states': dict(self.device_states),
+            }
+
+    def set_state(self, state):
+        """Replace the hints by those of :meth:`get_state`."""
+        with self._lock:
+            self.hints.clear()
+            self._presentities.clear()
+            for attributes in state['hints']:
+                hint = Hint.__new__(Hint)
+                hint.__dict__.update(attributes)
+                hint.devices = tuple(hint.devices)
+                key = (hint.exten, hint.context)
+                self.hints[key] = hint
+                if hint.presentity:
+                    self._presentities.setdefault(hint.presentity,
+                                                  set()).add(key)
+            self.device_states = dict(state['device_states'])
+
+    def handle_event(self, event, manager=None):
+        """Update the table with an event (a manager callback)."""
+        handler = self.handlers.get(event.name)
+        if handler is not None:
+            self._update(handler, event)
+
+    def _update(self, handler, message):
+        """Update the table with `handler` and notify the subscribers."""
+        with self._lock:
+            changed = handler(message) or ()
+            notifications = [
+                (subscription, hint) for hint in changed
+                for subscription in self._subscriptions.get(
+                    (hint.exten, hint.context), ())]
+        for subscription, hint in notifications:
+            try:
+                subscription.function(hint, self)
+            except Exception:
+                logger.exception("Exception in callback for %r" % hint)
+
+    def _hint(self, event):
+        """Return the hint of an event, creating it if needed."""
+        key = (event.get_header('Exten'), event.get_header('Context'))
+        hint = self.hints.get(key)
+        if hint is None:
+            hint = self.hints[key] = Hint(*key)
+        value = event.get_header('Hint')
+        if value is not None and value != hint.hint:
+            if hint.presentity:
+                self._presentities[hint.presentity].discard(key)
+            hint._set_hint(value)
+            if hint.presentity:
+                self._presentities.setdefault(hint.presentity, set()).add(key)
+        return hint
+
+    def _remove(self, hint):
+        key = (hint.exten, hint.context)
+        del self.hints[key]
+        if hint.presentity:
+            keys = self._presentities[hint.presentity]
+            keys.discard(key)
+            if not keys:
+                del self._presentities[hint.presentity]
+
+    def _extension_status(self, event):
+        if not event.get_header('Exten'):
+            return
+        hint = self._hint(event)
+        hint.status = _int(event.get_header('Status'))
+        hint.status_text = event.get_header('StatusText')
+        if hint.status in _REMOVED_STATUSES:
+            self._remove(hint)
+        return [hint]
+
+    def _presence_status(self, event):
+        if not event.get_header('Exten'):
+            return
+        hint = self._hint(event)
+        self._set_presence(hint, event)
+        return [hint]
+
+    def _set_presence(self, hint, event):
+        hint.presence = event.get_header('Status')
+        hint.presence_subtype = event.get_header('Subtype')
+        hint.presence_message = event.get_header('Message')
+
+    def _presence_state_change(self, event):
+        keys = self._presentities.get(event.get_header('Presentity'), ())
+        hints = [self.hints[key] for key in keys]
+        for hint in hints:
+            self._set_presence(hint, event)
+        return hints
+
+    def _device_state_change(self, event):
+        # the state of the hints follows in ExtensionStatus events, but
+        # not for the devices listed by DeviceStateList (see `resync`)
+        device = event.get_header('Device')
+        state = event.get_header('State')
+        if (event.get_header('ActionID') and
+                self.device_states.get(device) != state):
+            self._changed_devices.add(device)
+        self.device_states[device] = state
+
+    def _list_complete(self, event):
+        complete = self._seeding.get(event.get_header('ActionID'))
+        if complete is not None:
+            complete.set()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Rolling call KPIs
+
+A :class:`CallStats` keeps the outcome of the calls of a time window and
+computes KPIs over them: answer-seizure ratio (ASR), average call duration
+(ACD), post-dial delay (PDD) and percentiles. Calls are not kept one by
+one: counts, sums and histograms of the durations and post-dial delays are
+kept per `bucket` seconds and per group as calls are added, so queries
+cost the number of buckets of the window, whatever the number of calls.
+
+   import py_star.calls
+   import py_star.kpi
+
+   stats = py_star.kpi.CallStats(window=3600, dimensions=('trunk', 'queue'))
+
+   def handle_call(call, tracker):
+      stats.add_call(call, trunk=trunk_of(call), queue=queue_of(call))
+
+   tracker = py_star.calls.CallTracker()
+   tracker.register_complete(handle_call)
+   tracker.attach(manager)
+
+   # every few seconds
+   print (stats.summary(trunk='carrier-1', window=300))
+   print (stats.percentile('pdd', 95, queue='support'))
+
+Windows are made of whole buckets: from the first bucket starting in the
+window to the bucket of its end. Calls may be added in any order; those
+that ended before the window of the store are ignored. Percentiles are
+those of the histograms, whose bins are :data:`HISTOGRAM_GROWTH` times
+wider than the previous ones; within a bin, values are taken to be their
+mean.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import math
+import threading
+import time
+
+# the values of which percentiles are computed
+COLUMNS = ('duration', 'pdd')
+
+# ratio of the upper to the lower bound of the bins of the histograms, and
+# thus the relative error of the percentiles at most
+HISTOGRAM_GROWTH = 1.01
+
+_LOG_GROWTH = math.log(HISTOGRAM_GROWTH)
+# bin of zero (and less)
+_ZERO_BIN = -2 ** 31
+
+
+def _bin(value):
+    if value <= 0:
+        return _ZERO_BIN
+    return int(math.floor(math.log(value) / _LOG_GROWTH))
+
+
+def _percentile(histogram, q):
+    """Linear interpolation between the closest ranks, as numpy's default,
+    over a histogram mapping bins to ``[count, total]``."""
+    bins = sorted(histogram.items())
+    count = sum(entry[0] for _, entry in bins)
+    if not count:
+        return None
+    rank = (count - 1) * q / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, count - 1)
+    values = []
+    seen = 0
+    for _, (bin_count, total) in bins:
+        while len(values) < 2 and [low, high][len(values)] < seen + bin_count:
+            values.append(total / bin_count)
+        if len(values) == 2:
+            break
+        seen += bin_count
+    return values[0] + (values[1] - values[0]) * (rank - low)
+
+
+def _count(histogram, value):
+    entry = histogram.get(_bin(value))
+    if entry is None:
+        histogram[_bin(value)] = [1, value]
+    else:
+        entry[0] += 1
+        entry[1] += value
+
+
+class _Sums(object):
+
+    """Running counts, sums and histograms of calls."""
+
+    __slots__ = ('calls', 'answered', 'duration', 'pdd', 'pdd_calls',
+                 'histograms')
+
+    def __init__(self):
+        self.calls = self.answered = self.pdd_calls = 0
+        self.duration = self.pdd = 0.0
+        self.histograms = dict((name, {}) for name in COLUMNS)
+
+    def add(self, answered, duration, pdd):
+        self.calls += 1
+        if answered:
+            self.answered += 1
+            self.duration += duration
+            _count(self.histograms['duration'], duration)
+        if pdd is not None:
+            self.pdd_calls += 1
+            self.pdd += pdd
+            _count(self.histograms['pdd'], pdd)
+
+    def merge(self, other):
+        """Add the counts and sums of `other` (not its histograms)."""
+        self.calls += other.calls
+        self.answered += other.answered
+        self.duration += other.duration
+        self.pdd_calls += other.pdd_calls
+        self.pdd += other.pdd
+
+
+class CallStats(object):
+
+    """Call outcomes of the last `window` seconds, by buckets of `bucket`
+    seconds.
+
+    `dimensions` are the names of what calls can be grouped by (e.g. trunk
+    and queue). Their values are stored as small integers.
+
+    """
+
+    def __init__(self, window=3600, dimensions=(), bucket=60):
+        self.window = window
+        self.dimensions = tuple(dimensions)
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        # value -> id for each dimension, id 0 is "no value"
+        self._ids = dict((d, {None: 0}) for d in self.dimensions)
+        # index of the bucket -> ids of the groups of the calls -> _Sums
+        self._buckets = {}
+        self._last = None  # end of the latest call
+
+    def __len__(self):
+        with self._lock:
+            return sum(sums.calls for buckets in self._buckets.values()
+                       for sums in buckets.values())
+
+    def _first_bucket(self, now, window):
+        """Return the index of the first bucket starting in the `window`
+        seconds before `now`."""
+        return int(math.ceil((now - window) / float(self.bucket)))
+
+    def add(self, when, answered, duration=0.0, pdd=None, **groups):
+        """Add the outcome of a call which ended at `when`.
+
+        :return: whether the call was added, ``False`` if it ended before
+            the window
+
+        """
+        index = int(math.floor(when / float(self.bucket)))
+        with self._lock:
+            last = when if self._last is None else max(self._last, when)
+            first = self._first_bucket(last, self.window)
+            if index < first:
+                return False
+            key = []
+            for dimension in self.dimensions:
+                ids = self._ids[dimension]
+                value = groups.get(dimension)
+                group_id = ids.get(value)
+                if group_id is None:
+                    group_id = ids[value] = len(ids)
+                key.append(group_id)
+            buckets = self._buckets.get(index)
+            if buckets is None:
+                buckets = self._buckets[index] = {}
+            key = tuple(key)
+            sums = buckets.get(key)
+            if sums is None:
+                sums = buckets[key] = _Sums()
+            sums.add(answered, duration if answered else 0.0, pdd)
+            if last != self._last:
+                self._last = last
+                for old in [i for i in self._buckets if i < first]:
+                    del self._buckets[old]
+        return True
+
+    def add_call(self, call, **groups):
+        """Add a :class:`~py_star.calls.Call` (see :meth:`add`)."""
+        return self.add(call.ended or call.last_event,
+                        call.answered is not None, call.billsec,
+                        call.post_dial_delay, **groups)
+
+    def _select(self, window, now, groups):
+        """Return the :class:`_Sums` of the groups in the window.
+
+        Must be called with the lock held.
+
+        """
+        if now is None:
+            now = time.time()
+        first = self._first_bucket(now, min(window or self.window,
+                                            self.window))
+        last = int(math.floor(now / float(self.bucket)))
+        group_ids = []
+        for dimension, value in groups.items():
+            group_id = self._ids[dimension].get(value)
+            if group_id is None:
+                # no call of that group
+                return []
+            group_ids.append((self.dimensions.index(dimension), group_id))
+        return [sums for index, buckets in self._buckets.items()
+                if first <= index <= last
+                for key, sums in buckets.items()
+                if all(key[position] == group_id
+                       for position, group_id in group_ids)]
+
+    def _totals(self, window, now, groups):
+        """Return the :class:`_Sums` of the calls selected."""
+        totals = _Sums()
+        with self._lock:
+            for sums in self._select(window, now, groups):
+                totals.merge(sums)
+        return totals
+
+    def count(self, window=None, now=None, **groups):
+        """Return the number of calls (in the last `window` seconds)."""
+        return self._totals(window, now, groups).calls
+
+    def asr(self, window=None, now=None, **groups):
+        """Return the ratio of answered calls (``None`` if no calls)."""
+        totals = self._totals(window, now, groups)
+        if not totals.calls:
+            return None
+        return float(totals.answered) / totals.calls
+
+    def acd(self, window=None, now=None, **groups):
+        """Return the average duration of the answered calls."""
+        totals = self._totals(window, now, groups)
+        if not totals.answered:
+            return None
+        return totals.duration / totals.answered
+
+    def pdd(self, window=None, now=None, **groups):
+        """Return the average post-dial delay."""
+        totals = self._totals(window, now, groups)
+        if not totals.pdd_calls:
+            return None
+        return totals.pdd / totals.pdd_calls
+
+    def percentile(self, name, q, window=None, now=None, **groups):
+        """Return the `q`-th percentile of `name` (one of
+        :data:`COLUMNS`).
+
+        Durations are only those of answered calls.
+
+        """
+        histogram = {}
+        with self._lock:
+            for sums in self._select(window, now, groups):
+                for bin_, (count, total) in sums.histograms[name].items():
+                    entry = histogram.get(bin_)
+                    if entry is None:
+                        histogram[bin_] = [count, total]
+                    else:
+                        entry[0] += count
+                        entry[1] += total
+        return _percentile(histogram, q)
+
+    def summary(self, window=None, now=None, **groups):
+        """Return a dict with the calls count and all the KPIs."""
+        totals = self._totals(window, now, groups)
+        return {
+            'calls': totals.calls,
+            'asr': (float(totals.answered) / totals.calls
+                    if totals.calls else None),
+            'acd': (totals.duration / totals.answered
+                    if totals.answered else None),
+            'pdd': totals.pdd / totals.pdd_calls if totals.pdd_calls else None,
+        }
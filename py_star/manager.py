@@ -53,11 +53,19 @@ and submit patches.
 """
 from __future__ import absolute_import, print_function, unicode_literals
 
+import bisect
+import collections
+import cProfile
+import heapq
+import itertools
 import logging
 import os
+import pstats
 import socket
 import sys
 import threading
+import time
+import traceback
 
 from . import compat_six as six
 from six.moves import queue
@@ -66,6 +74,125 @@ logger = logging.getLogger(__name__)
 
 EOL = '\r\n'
 
+# read-only actions whose concurrent identical requests share one round trip
+# (see `Manager.coalesce_actions`)
+COALESCE_ACTIONS = frozenset([
+    'ExtensionState',
+    'MailboxCount',
+    'MailboxStatus',
+    'SIPshowpeer',
+])
+
+# seconds the responses of read-only actions are cached when the cache is
+# enabled (see `Manager.enable_cache`)
+CACHE_TTLS = {
+    'ExtensionState': 30,
+    'MailboxCount': 60,
+    'MailboxStatus': 60,
+    'SIPshowpeer': 30,
+}
+
+# actions of people waiting for them, never held back by the window of
+# actions in flight (see `Manager.enable_window`)
+INTERACTIVE_ACTIONS = frozenset([
+    'Atxfer',
+    'Bridge',
+    'Hangup',
+    'Login',
+    'Logoff',
+    'Ping',
+    'PlayDTMF',
+    'Redirect',
+])
+
+# headers preferred for indexing those waiting for events, most selective
+# first (see `Manager.wait_for_event`)
+WAITER_KEY_HEADERS = (
+    'ActionID',
+    'Uniqueid',
+    'Linkedid',
+    'Channel',
+    'BridgeUniqueid',
+    'Queue',
+    'Exten',
+    'Mailbox',
+    'Peer',
+    'UserEvent',
+)
+
+# priority classes of events, the others are NORMAL; under overload LOW
+# events are sampled, then NORMAL ones dropped, but HIGH ones are always
+# delivered (see `Manager.enable_shedding`)
+HIGH = 'high'
+NORMAL = 'normal'
+LOW = 'low'
+EVENT_PRIORITIES = {
+    'Hangup': HIGH,
+    'OriginateResponse': HIGH,
+    'DialEnd': HIGH,
+    'BridgeEnter': HIGH,
+    'BridgeLeave': HIGH,
+    'FullyBooted': HIGH,
+    'Shutdown': HIGH,
+    'Reload': HIGH,
+    'VarSet': LOW,
+    'Newexten': LOW,
+    'RTCPSent': LOW,
+    'RTCPReceived': LOW,
+    'AGIExec': LOW,
+    'AGIExecStart': LOW,
+    'AGIExecEnd': LOW,
+    'DTMF': LOW,
+    'DTMFBegin': LOW,
+    'DTMFEnd': LOW,
+    'NewCallerid': LOW,
+    'NewConnectedLine': LOW,
+    'Cdr': LOW,
+    'CEL': LOW,
+}
+
+# priority lanes of actions, the others are NORMAL; queued HIGH actions are
+# sent before NORMAL ones, and those before LOW ones (see
+# `Manager.enable_scheduler`); Asterisk ignores the case of action names,
+# which are thus lowercase
+ACTION_PRIORITIES = {
+    'absolutetimeout': HIGH,
+    'atxfer': HIGH,
+    'bridge': HIGH,
+    'hangup': HIGH,
+    'playdtmf': HIGH,
+    'redirect': HIGH,
+    'command': LOW,
+    'coreshowchannels': LOW,
+    'devicestatelist': LOW,
+    'extensionstatelist': LOW,
+    'iaxpeers': LOW,
+    'pjsipshowendpoints': LOW,
+    'queuestatus': LOW,
+    'showdialplan': LOW,
+    'sippeers': LOW,
+    'sipshowregistry': LOW,
+    'status': LOW,
+}
+
+# rate limits of the lanes of actions: (actions per second, burst)
+ACTION_RATES = {
+    LOW: (50, 10),
+}
+
+# upper bounds (in seconds) of the buckets of the histograms of the lag of
+# events, the last bucket has none (see `Manager.enable_lag_stats`)
+LAG_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+               0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+# stages of the handling of events whose lag is measured: from Asterisk
+# (the `Timestamp` header) to the socket, from the socket to the parsed
+# event, from the parsed event to its dispatch, and its callbacks
+LAG_STAGES = ('asterisk', 'parse', 'dispatch', 'callback')
+
+# time source for measuring intervals (Python 2 has no monotonic clock)
+_monotonic = getattr(time, 'monotonic', time.time)
+
 
 class _Message(object):
 
@@ -95,11 +222,13 @@ class ManagerMessage(_Message):
 
     """A manager interface message"""
 
-    def __init__(self, response):
+    def __init__(self, response, received=None):
         super(ManagerMessage, self).__init__()
 
         # the raw response, straight from the horse's mouth:
         self.response = response
+        # when it was read (`_monotonic` time), if it was
+        self.received = received
         self.data = ''
         self.multiheaders = {}
 
@@ -164,6 +293,8 @@ class Event(_Message):
 
         # store all of the event data
         self.message = message
+        self.received = message.received
+        self.queued = None  # when queued for dispatching, if measured
         self.data = message.data
         self.headers = message.headers
         self.multiheaders = message.multiheaders
@@ -182,6 +313,863 @@ class Event(_Message):
         return self.headers.get('ActionID', 0000)
 
 
+def _format_action(cdict):
+    """Return the text of the action described by `cdict`.
+
+    See :meth:`Manager.send_action` about list values.
+
+    """
+    clist = []
+    for key, value in cdict.items():
+        if isinstance(value, list):
+            clist.extend('%s: %s' % (key, item) for item in value)
+        else:
+            clist.append('%s: %s' % (key, value))
+    clist.append(EOL)
+    return EOL.join(clist)
+
+
+class ActionTemplate(object):
+
+    """An action compiled once, to be sent many times with other values.
+
+       originate = ActionTemplate('Originate', ['Channel', 'Exten',
+                                                'Context', 'Priority'])
+       future = manager.send_template_async(originate, 'SIP/100', '200',
+                                            'default', '1')
+
+    The values are given in the order of `headers`, and the ActionID is
+    added.
+
+    """
+
+    def __init__(self, action, headers):
+        self.action = action
+        self.headers = tuple(headers)
+        lines = ['Action: %s' % action]
+        lines.extend('%s: %%s' % header.replace('%', '%%')
+                     for header in self.headers)
+        lines.append('ActionID: %s')
+        self._format = EOL.join(lines) + EOL + EOL
+
+    def __repr__(self):
+        return '<ActionTemplate %s>' % self.action
+
+    def render(self, action_id, values):
+        """Return the bytes of the action with `values`."""
+        if len(values) != len(self.headers):
+            raise ValueError('%s takes %d values, not %d' % (
+                self.action, len(self.headers), len(values)))
+        return (self._format % (tuple(values) + (action_id,))).encode(
+            'utf-8')
+
+
+# actions of `Manager.get_vars` and `Manager.set_vars`
+_GETVAR = ActionTemplate('Getvar', ['Channel', 'Variable'])
+_SETVAR = ActionTemplate('Setvar', ['Channel', 'Variable', 'Value'])
+
+
+def _event_text(event):
+    """Return the text of `event`, as received from Asterisk."""
+    return ''.join(event.message.response)
+
+
+def _event_from_text(text):
+    """Return the event whose text is `text` (see `_event_text`)."""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return Event(ManagerMessage(lines))
+
+
+class _MessageFramer(object):
+
+    """Assemble the lines read from a manager connection into messages.
+
+    Besides splitting the stream on empty lines, it recognizes the
+    greeting line (storing :attr:`title` and :attr:`version`) and keeps
+    the state needed for commands whose output contains empty lines.
+
+    """
+
+    def __init__(self):
+        self.title = None
+        self.version = None
+        self.lines = []
+        self.multiline = False
+        self.wait_for_marker = False
+
+    def feed(self, line):
+        """Add a decoded line, return the message lines once complete.
+
+        Return ``None`` while the message is not complete yet.
+
+        """
+        lines = self.lines
+        # check to see if this is the greeting line
+        if not self.title and '/' in line and ':' not in line:
+            self.title = line.split('/')[0].strip()
+            self.version = line.split('/')[1].strip()
+            # fake message header
+            lines.append('Response: Generated Header\r\n')
+            lines.append(line)
+            logger.debug("Fake message header for the greeting line")
+            return self.flush()
+        # If the line is EOL marker we have a complete message.
+        # Some commands are broken and contain a \n\r\n
+        # sequence, in the case wait_for_marker is set, we
+        # have such a command where the data ends with the
+        # marker --END COMMAND--, so we ignore embedded
+        # newlines until we see that marker
+        if line == EOL and not self.wait_for_marker:
+            self.multiline = False
+            if lines:
+                return self.flush()
+            # ignore empty lines at start
+            return None
+        lines.append(line)
+        # line not ending in \r\n or without ':' isn't a
+        # valid header and starts multiline response
+        if not line.endswith('\r\n') or ':' not in line:
+            self.multiline = True
+        # Response: Follows indicates we should wait for end
+        # marker --END COMMAND--
+        if (not self.multiline and line.startswith('Response') and
+                line.split(':', 1)[1].strip() == 'Follows'):
+            self.wait_for_marker = True
+        # same when seeing end of multiline response
+        if self.multiline and line.startswith('--END COMMAND--'):
+            self.wait_for_marker = False
+            self.multiline = False
+        return None
+
+    def flush(self):
+        """Return the lines collected so far and start a new message."""
+        lines, self.lines = self.lines, []
+        return lines
+
+
+class Future(object):
+
+    """The result of an operation that completes in another thread.
+
+    A small subset of the interface of :class:`concurrent.futures.Future`,
+    which is not available in Python 2.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Return whether the result (or an exception) has been set."""
+        return self._done
+
+    def result(self, timeout=None):
+        """Return the result, waiting at most `timeout` seconds for it.
+
+        Raise :exc:`ManagerTimeoutException` if it is not ready in time,
+        or the exception the operation failed with.
+
+        """
+        if self.exception(timeout) is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Like :meth:`result` but return the exception (or ``None``)."""
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise ManagerTimeoutException('Timed out waiting for result')
+            return self._exception
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` when done (right away if already done)."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        with self._condition:
+            if self._done:
+                return
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Exception in future callback")
+
+
+def _mailbox_key(mailbox):
+    """Mailboxes are in the 'default' context unless said otherwise."""
+    if mailbox and '@' not in mailbox:
+        mailbox += '@default'
+    return (mailbox,)
+
+
+def _peer_key(peer):
+    """Peers in events are named after their channel technology."""
+    return (peer.split('/', 1)[-1],)
+
+
+class _ActionCache(object):
+
+    """LRU cache for the responses of read-only actions.
+
+    Entries expire after a per-action TTL, and are invalidated as soon as an
+    event reports a change of what they are about (see
+    :meth:`Manager.enable_cache`).
+
+    """
+
+    # action -> (headers of the action identifying what it is about,
+    #            function building the key from their values)
+    key_headers = {
+        'ExtensionState': (('Exten', 'Context'), lambda e, c: (e, c)),
+        'MailboxCount': (('Mailbox',), _mailbox_key),
+        'MailboxStatus': (('Mailbox',), _mailbox_key),
+        'SIPshowpeer': (('Peer',), lambda p: (p,)),
+    }
+
+    # event -> (actions whose responses are invalidated,
+    #           headers of the event identifying what it is about,
+    #           function building the key from their values)
+    invalidations = {
+        'ExtensionStatus': (('ExtensionState',), ('Exten', 'Context'),
+                            lambda e, c: (e, c)),
+        'MessageWaiting': (('MailboxCount', 'MailboxStatus'), ('Mailbox',),
+                           _mailbox_key),
+        'PeerStatus': (('SIPshowpeer',), ('Peer',), _peer_key),
+    }
+
+    def __init__(self, ttls, maxsize):
+        self.ttls = dict(ttls)
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (expiry, response)
+        self._pending = {}  # key -> token of the request filling the entry
+        self._lock = threading.Lock()
+
+    def key(self, cdict):
+        """Return the cache key of an action, ``None`` if not cacheable."""
+        action = cdict.get('Action')
+        if action not in self.ttls or action not in self.key_headers:
+            return None
+        headers, key = self.key_headers[action]
+        if len(cdict) != len(headers) + 1:
+            # other headers may change the response
+            return None
+        try:
+            return (action,) + key(*[cdict[h] for h in headers])
+        except KeyError:
+            return None
+
+    def get(self, key):
+        """Return the cached response, or a token to pass to :meth:`put`."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > _monotonic():
+                # most recently used go last
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1], None
+            self.misses += 1
+            token = self._pending[key] = object()
+            return None, token
+
+    def put(self, key, token, response):
+        """Cache a response unless invalidated since it was requested."""
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return
+            del self._pending[key]
+            self._entries[key] = (_monotonic() + self.ttls[key[0]], response)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def release(self, key, token):
+        """Forget the request of `token`, whatever its outcome."""
+        with self._lock:
+            if self._pending.get(key) is token:
+                del self._pending[key]
+
+    def invalidate(self, event):
+        """Drop the responses `event` reports a change of."""
+        try:
+            actions, headers, key = self.invalidations[event.name]
+        except KeyError:
+            return
+        values = [event.get_header(h) for h in headers]
+        if None in values:
+            return
+        key = key(*values)
+        with self._lock:
+            for action in actions:
+                self._entries.pop((action,) + key, None)
+                self._pending.pop((action,) + key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class _LagHistogram(object):
+
+    """Counts of lags by bucket (see :data:`LAG_BUCKETS`)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(LAG_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lag):
+        lag = max(0.0, lag)
+        self.counts[bisect.bisect_left(LAG_BUCKETS, lag)] += 1
+        self.count += 1
+        self.total += lag
+        if lag > self.max:
+            self.max = lag
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket of the lag below which are
+        `fraction` of the lags."""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(LAG_BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def info(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count,
+                'max': self.max, 'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9), 'p99': self.percentile(0.99),
+                'buckets': list(zip(LAG_BUCKETS + (None,), self.counts))}
+
+
+class _LagStats(object):
+
+    """Histograms of the lag of events at each stage (see
+    :data:`LAG_STAGES`).
+
+    The ``asterisk`` and ``parse`` stages are recorded by the thread reading
+    messages, the others by the dispatch thread.
+
+    """
+
+    def __init__(self):
+        self.histograms = dict((stage, _LagHistogram())
+                               for stage in LAG_STAGES)
+
+    def queued(self, event):
+        """Record the lag of an event about to be queued for dispatching."""
+        now = _monotonic()
+        event.queued = now
+        if event.received is None:
+            return
+        self.histograms['parse'].record(now - event.received)
+        try:
+            timestamp = float(event.headers['Timestamp'])
+        except (KeyError, ValueError):
+            return
+        # the wall clock time it was read at
+        received = time.time() - (now - event.received)
+        self.histograms['asterisk'].record(received - timestamp)
+
+    def info(self):
+        return dict((stage, histogram.info())
+                    for stage, histogram in self.histograms.items())
+
+
+def _callback_name(callback):
+    """Return the name of a callback, with its class if a method."""
+    name = getattr(callback, '__name__', None)
+    if name is None:
+        return repr(callback)
+    owner = getattr(callback, '__self__', None)
+    if owner is not None:
+        return '%s.%s' % (type(owner).__name__, name)
+    return '%s.%s' % (getattr(callback, '__module__', None), name)
+
+
+class _CallbackProfiler(object):
+
+    """Times the event callbacks, and watches for slow ones.
+
+    The watchdog thread logs the stack of the dispatch thread when a
+    callback runs for more than `budget` seconds.
+
+    """
+
+    def __init__(self, manager, budget, profile):
+        self.manager = manager
+        self.budget = budget
+        self.profile = cProfile.Profile() if profile else None
+        # (event name, callback name) -> [calls, total, max]
+        self.times = {}
+        self.slow = 0
+        self._current = None  # (callback, event, started)
+        self._closed = threading.Event()
+        if budget is not None:
+            t = threading.Thread(target=self._watch, name='CallbackWatchdog')
+            t.setDaemon(True)
+            t.start()
+
+    def call(self, callback, event):
+        """Call `callback` with `event`, timing it."""
+        started = _monotonic()
+        self._current = (callback, event, started)
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            return callback(event, self.manager)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            self._current = None
+            elapsed = _monotonic() - started
+            key = (event.name, callback)
+            times = self.times.get(key)
+            if times is None:
+                times = self.times[key] = [0, 0.0, 0.0]
+            times[0] += 1
+            times[1] += elapsed
+            if elapsed > times[2]:
+                times[2] = elapsed
+
+    def _watch(self):
+        reported = None
+        while not self._closed.wait(self.budget / 2.0):
+            current = self._current
+            if current is None or current is reported:
+                continue
+            callback, event, started = current
+            elapsed = _monotonic() - started
+            if elapsed < self.budget:
+                continue
+            reported = current
+            self.slow += 1
+            frame = sys._current_frames().get(
+                self.manager.event_dispatch_thread.ident)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            logger.warning("Callback %s running for %.3f s on %s event:\n%s"
+                           % (_callback_name(callback), elapsed, event.name,
+                              stack))
+
+    def close(self):
+        self._closed.set()
+
+    def info(self):
+        callbacks = [
+            {'event': name, 'callback': _callback_name(callback),
+             'calls': calls, 'total': total, 'max': longest}
+            for (name, callback), (calls, total, longest)
+            in list(self.times.items())]
+        callbacks.sort(key=lambda entry: entry['total'], reverse=True)
+        return {'callbacks': callbacks, 'slow': self.slow}
+
+
+class _EventShedder(object):
+
+    """Decides which events to drop when the dispatch queue is overloaded.
+
+    The overload level is that of the queue depth, or of the lag of the
+    events (from their ``Timestamp`` header) if limits are given for it.
+
+    """
+
+    def __init__(self, priorities, soft_limit, hard_limit, sample,
+                 soft_lag, hard_lag):
+        self.priorities = dict(priorities)
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.sample = sample
+        self.soft_lag = soft_lag
+        self.hard_lag = hard_lag
+        self.level = 0  # 0: no overload, 1: soft limit, 2: hard limit
+        self.shed = collections.Counter()  # event name -> events dropped
+        self._seen = collections.Counter()  # LOW event name -> events
+        self._lock = threading.Lock()
+
+    def _level(self, event, depth):
+        level = 2 if depth >= self.hard_limit else (
+            1 if depth >= self.soft_limit else 0)
+        if level < 2 and self.soft_lag is not None:
+            try:
+                lag = time.time() - float(event.get_header('Timestamp'))
+            except (TypeError, ValueError):
+                return level
+            if self.hard_lag is not None and lag >= self.hard_lag:
+                return 2
+            if lag >= self.soft_lag:
+                return max(level, 1)
+        return level
+
+    def admit(self, event, depth):
+        """Return whether to queue `event`, with `depth` events queued."""
+        level = self._level(event, depth)
+        with self._lock:
+            if level != self.level:
+                if level > self.level:
+                    logger.warning("Event queue overloaded (%d events), "
+                                   "shedding events" % depth)
+                else:
+                    logger.info("Event queue load down (%d events)" % depth)
+                self.level = level
+            if not level or 'ActionID' in event.headers:
+                # events listing the results of actions are always wanted
+                return True
+            priority = self.priorities.get(event.name, NORMAL)
+            if priority == HIGH:
+                return True
+            if priority == LOW and level == 1:
+                seen = self._seen[event.name]
+                self._seen[event.name] += 1
+                if seen % self.sample == 0:
+                    return True
+            elif priority == NORMAL and level == 1:
+                return True
+            self.shed[event.name] += 1
+            return False
+
+    def info(self):
+        with self._lock:
+            return {'level': self.level, 'shed': dict(self.shed),
+                    'total': sum(self.shed.values())}
+
+
+class _ActionWindow(object):
+
+    """Limits the actions in flight, the limit adapting to their latency.
+
+    Additive increase, multiplicative decrease: the window grows by one
+    action per round trip while the latency stays within `tolerance` times
+    the base latency (the lowest of the last `period` responses), and is
+    halved, at most once per round trip, when it does not, as Asterisk is
+    then queueing the actions instead of handling more of them.
+
+    """
+
+    def __init__(self, initial, min_size, max_size, tolerance, period,
+                 interactive):
+        self.size = float(initial)
+        self.min_size = float(min_size)
+        self.max_size = float(max_size)
+        self.tolerance = tolerance
+        self.period = period
+        self.interactive = frozenset(interactive)
+        self.inflight = 0
+        self.base = None  # lowest latency of the previous period
+        self.latency = None  # moving average
+        self.decreases = 0
+        self._period_min = None
+        self._responses = 0
+        self._sent = 0
+        self._decreased_at = 0  # `_sent` when last decreased
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, wait=True):
+        """Take a place in the window, waiting for one unless not `wait`.
+
+        :return: a token for :meth:`release`
+
+        """
+        with self._condition:
+            while (wait and not self._closed and
+                   self.inflight >= int(self.size)):
+                self._condition.wait()
+            self.inflight += 1
+            self._sent += 1
+            return self._sent
+
+    def release(self, token, latency=None):
+        """Give back the place of an action, answered after `latency`
+        seconds (``None`` if it failed)."""
+        with self._condition:
+            self.inflight -= 1
+            if latency is not None:
+                self._sample(token, latency)
+            self._condition.notify_all()
+
+    def full(self):
+        return self.inflight >= int(self.size)
+
+    def close(self):
+        """Let those waiting for a place go."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _sample(self, token, latency):
+        self.latency = latency if self.latency is None else (
+            0.875 * self.latency + 0.125 * latency)
+        if self._period_min is None or latency < self._period_min:
+            self._period_min = latency
+        self._responses += 1
+        if self.base is None or self._responses >= self.period:
+            # follow Asterisk getting slower or faster for good
+            self.base = self._period_min
+            self._period_min = None
+            self._responses = 0
+        if latency > self.base * self.tolerance:
+            if token > self._decreased_at:
+                # the first late action sent after the previous decrease
+                self._decreased_at = self._sent
+                self.size = max(self.min_size, self.size / 2.0)
+                self.decreases += 1
+                logger.debug("Action latency %.3f s, window down to %d" %
+                             (latency, self.size))
+        elif self.inflight + 1 >= int(self.size):
+            # only grow while the window is used
+            self.size = min(self.max_size, self.size + 1.0 / self.size)
+
+    def info(self):
+        with self._condition:
+            return {'size': int(self.size), 'inflight': self.inflight,
+                    'base_latency': self.base, 'latency': self.latency,
+                    'decreases': self.decreases}
+
+
+class _TokenBucket(object):
+
+    """Allows `rate` actions per second, and bursts of `burst` actions."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._last = _monotonic()
+
+    def delay(self):
+        """Return the seconds before an action is allowed (0 if it is)."""
+        now = _monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _ActionScheduler(object):
+
+    """Sends the actions queued in priority lanes, from a thread of its
+    own.
+
+    Each lane is emptied before the next one is looked at, as long as its
+    rate limit allows. The actions that can be sent right away are written
+    together, up to `batch` of them.
+
+    """
+
+    batch = 64
+
+    def __init__(self, manager, priorities, rates):
+        self.manager = manager
+        self.priorities = dict((action.lower(), lane)
+                               for action, lane in priorities.items())
+        self._lanes = collections.OrderedDict(
+            (lane, collections.deque()) for lane in (HIGH, NORMAL, LOW))
+        self._buckets = dict((lane, _TokenBucket(rate, burst))
+                             for lane, (rate, burst) in rates.items())
+        self._sent = collections.Counter()  # lane -> actions sent
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='ActionScheduler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def put(self, pendings):
+        """Queue actions (:class:`_PendingAction` objects)."""
+        with self._condition:
+            for pending in pendings:
+                lane = self.priorities.get((pending.action or '').lower(),
+                                           NORMAL)
+                self._lanes[lane].append(pending)
+            self._condition.notify()
+
+    def close(self):
+        """Stop once the actions queued are sent."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _next(self):
+        """Return the next actions to send, ``None`` when closed."""
+        with self._condition:
+            while True:
+                pendings = []
+                timeout = None
+                for lane, queued in self._lanes.items():
+                    bucket = self._buckets.get(lane)
+                    while queued and len(pendings) < self.batch:
+                        delay = 0 if bucket is None or self._closed else (
+                            bucket.delay())
+                        if delay:
+                            timeout = delay if timeout is None else min(
+                                timeout, delay)
+                            break
+                        if bucket is not None:
+                            bucket.take()
+                        self._sent[lane] += 1
+                        pendings.append(queued.popleft())
+                    if len(pendings) >= self.batch:
+                        break
+                if pendings:
+                    return pendings
+                if self._closed and timeout is None:
+                    return None
+                self._condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            pendings = self._next()
+            if pendings is None:
+                break
+            self.manager._send_scheduled(pendings)
+
+    def info(self):
+        with self._condition:
+            return {'queued': dict((lane, len(queued)) for lane, queued
+                                   in self._lanes.items()),
+                    'sent': dict(self._sent)}
+
+
+class _PendingAction(object):
+
+    """An action ready to be written, with the future of its response."""
+
+    __slots__ = ('action', 'action_id', 'data', 'future', 'sent')
+
+    def __init__(self, action, action_id, data, future):
+        self.action = action
+        self.action_id = action_id
+        self.data = data
+        self.future = future
+        self.sent = None  # when written
+
+    def latency(self):
+        """Return the seconds the response took, ``None`` if it failed."""
+        if self.sent is None or self.future.exception() is not None:
+            return None
+        return _monotonic() - self.sent
+
+
+class EventWaiter(Future):
+
+    """Future for an event, returned by :meth:`Manager.wait_for_event`.
+
+    Waiting for the result with no timeout waits until the timeout given
+    to :meth:`Manager.wait_for_event`, after which the waiter is cancelled.
+
+    """
+
+    def __init__(self, manager, name, match, header, timeout):
+        super(EventWaiter, self).__init__()
+        self.name = name
+        self.match = match
+        # the waiter is indexed by the value of this header (or None)
+        self.header = header
+        self.key = (name, header, match.get(header))
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = _monotonic() + timeout
+        self._manager = manager
+
+    def matches(self, event):
+        """Return whether `event` is the one waited for."""
+        for header, value in self.match.items():
+            if event.get_header(header) != value:
+                return False
+        return True
+
+    def exception(self, timeout=None):
+        if timeout is None and self.deadline is not None:
+            timeout = max(0, self.deadline - _monotonic())
+        try:
+            return super(EventWaiter, self).exception(timeout)
+        except ManagerTimeoutException:
+            if self.deadline is not None and _monotonic() >= self.deadline:
+                self.cancel()
+            raise
+
+    def cancel(self, exception=None):
+        """Stop waiting, return whether the event was still waited for.
+
+        The result becomes `exception`, a :exc:`ManagerTimeoutException`
+        by default.
+
+        """
+        if not self._manager._remove_waiter(self):
+            return False
+        if exception is None:
+            exception = ManagerTimeoutException(
+                'Timed out waiting for event %s' % self.name)
+        self.set_exception(exception)
+        return True
+
+
+class _EventBatch(object):
+
+    """Events collected for a batch callback (see Manager.register_batch)."""
+
+    def __init__(self, function, max_size, max_latency):
+        self.function = function
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.events = []
+        self.deadline = None
+
+    def add(self, event):
+        """Add an event, return whether the batch is full."""
+        if not self.events:
+            self.deadline = _monotonic() + self.max_latency
+        self.events.append(event)
+        return len(self.events) >= self.max_size
+
+    def flush(self, manager):
+        """Deliver the events collected, if any."""
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        self.deadline = None
+        self.function(events, manager)
+
+
 class Manager(object):
 
     """Manager interface.
@@ -210,18 +1198,61 @@ class Manager(object):
 
         # our queues
         self._message_queue = queue.Queue()
+        # only for the greeting, see `connect`
         self._response_queue = queue.Queue()
+        self._greeting_expected = True
         self._event_queue = queue.Queue()
         self.errors_in_threads = queue.Queue()
 
         # callbacks for events
         self._event_callbacks = {}
+        # callbacks for batches of events: event -> list of `_EventBatch`es
+        self._event_batches = {}
+
+        # those who are waiting for a response: ActionID -> future
+        self._response_waiters = collections.OrderedDict()
+        self._response_lock = threading.Lock()
+
+        # requests being coalesced: action key -> future of the response
+        self.coalesce_actions = set(COALESCE_ACTIONS)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # those who are waiting for events: (event name, header, value) ->
+        # list of `EventWaiter`s; event name -> {header: waiter count}; heap
+        # of (deadline, waiter)s (see `wait_for_event`)
+        self._waiters = {}
+        self._waiter_headers = {}
+        self._waiter_deadlines = []
+        self._waiters_lock = threading.Lock()
+
+        # opt-in cache of read-only actions (see `enable_cache`)
+        self._cache = None
+
+        # opt-in dropping of events under overload (see `enable_shedding`)
+        self._shedder = None
+
+        # opt-in limit of the actions in flight (see `enable_window`)
+        self._window = None
+
+        # opt-in priority lanes of actions (see `enable_scheduler`)
+        self._scheduler = None
 
-        self._response_waiters = []  # those who are waiting for a response
+        # opt-in measurement of the lag of events (see `enable_lag_stats`)
+        self._lag = None
 
-        # sequence stuff
-        self._seqlock = threading.Lock()
-        self._seq = 0
+        # opt-in timing of the callbacks (see `enable_profiling`)
+        self._profiler = None
+
+        # connection receiving the events, if separate (see `connect`)
+        self._event_connection = None
+
+        # serializes writes to the socket
+        self._write_lock = threading.Lock()
+
+        # sequence stuff (`next` on a count is atomic)
+        self._seq = itertools.count()
+        self._action_id_prefix = '%s-%04s-' % (self.hostname, self.pid)
 
         # some threads
         self.message_thread = threading.Thread(target=self.message_loop)
@@ -253,12 +1284,16 @@ class Manager(object):
 
     def next_seq(self):
         """Return the next number in the sequence, this is used for ActionID"""
-        self._seqlock.acquire()
-        try:
-            return self._seq
-        finally:
-            self._seq += 1
-            self._seqlock.release()
+        return next(self._seq)
+
+    def next_action_id(self):
+        """Return a new ActionID.
+
+        Useful to tell apart the events listing the results of an action,
+        which carry its ActionID.
+
+        """
+        return '%s%08x' % (self._action_id_prefix, next(self._seq))
 
     def send_action(self, cdict=None, **kwargs):
         """
@@ -276,6 +1311,11 @@ class Manager(object):
         Action: Originate
         Variable: var1=value
         Variable: var2=value
+
+        Identical concurrent requests of the (read-only) actions in
+        :attr:`coalesce_actions` share a single round trip, and therefore
+        the same response object, unless an ActionID is given. The same
+        goes for responses served from the cache (see :meth:`enable_cache`).
         """
         cdict = cdict or {}
 
@@ -285,108 +1325,505 @@ class Manager(object):
         # fill in our args
         cdict.update(kwargs)
 
-        # set the action id
-        if 'ActionID' not in cdict:
-            cdict['ActionID'] = '%s-%04s-%08x' % (
-                self.hostname, self.pid, self.next_seq())
-        clist = []
-
-        # generate the command
-        for key, value in cdict.items():
-            if isinstance(value, list):
-                for item in value:
-                    item = tuple([key, item])
-                    clist.append('%s: %s' % item)
+        cache = self._cache
+        key = None
+        if cache is not None and 'ActionID' not in cdict:
+            key = cache.key(cdict)
+            if key is not None:
+                response, token = cache.get(key)
+                if response is not None:
+                    return response
+
+        try:
+            if (cdict.get('Action') in self.coalesce_actions and
+                    'ActionID' not in cdict):
+                response = self._send_coalesced(cdict)
             else:
-                item = tuple([key, value])
-                clist.append('%s: %s' % item)
-        clist.append(EOL)
-        command = EOL.join(clist)
+                response = self._send_action(cdict)
+            if (key is not None and
+                    response.get_header('Response') == 'Success'):
+                cache.put(key, token, response)
+        finally:
+            if key is not None:
+                cache.release(key, token)
+        return response
+
+    def enable_cache(self, ttls=None, maxsize=1024):
+        """Cache the responses of read-only actions.
+
+        :param ttls: dict mapping actions to the seconds their responses
+            are cached for, defaults to :data:`CACHE_TTLS` (only actions
+            in there can be cached)
+        :param maxsize: number of responses kept, the least recently used
+            are evicted first
+
+        Cached responses are dropped as soon as an event reports a change
+        of what they are about (``MessageWaiting`` for mailboxes,
+        ``ExtensionStatus`` for extensions and ``PeerStatus`` for peers),
+        so they are only stale if such events are not received (check the
+        ``eventfilter`` and the read permissions of the manager user).
+
+        """
+        ttls = CACHE_TTLS if ttls is None else ttls
+        self._cache = _ActionCache(ttls, maxsize)
+
+    def disable_cache(self):
+        """Stop caching responses (see :meth:`enable_cache`)."""
+        self._cache = None
+
+    def cache_info(self):
+        """Return a dict of statistics of the cache, ``None`` if disabled."""
+        cache = self._cache
+        return None if cache is None else cache.info()
+
+    def enable_shedding(self, soft_limit=1000, hard_limit=10000, sample=10,
+                        priorities=None, soft_lag=None, hard_lag=None):
+        """Drop events of low priority when they can't be dispatched fast
+        enough.
+
+        :param soft_limit: events waiting to be dispatched from which only
+            one in `sample` :data:`LOW` priority events is kept
+        :param hard_limit: events waiting from which only :data:`HIGH`
+            priority events are kept
+        :param priorities: dict mapping event names to their priority,
+            defaults to :data:`EVENT_PRIORITIES`
+        :param soft_lag: the soft limit as the seconds events are late
+            according to their ``Timestamp`` header (needs
+            ``timestampevents = yes`` in ``manager.conf``)
+        :param hard_lag: the hard limit, likewise
+
+        Events listing the results of an action (with an ActionID) are
+        never dropped, nor are events withheld from :meth:`wait_for_event`
+        or from the invalidation of the cache. See :meth:`shedding_info`
+        for what was dropped.
+
+        """
+        priorities = EVENT_PRIORITIES if priorities is None else priorities
+        self._shedder = _EventShedder(priorities, soft_limit, hard_limit,
+                                      sample, soft_lag, hard_lag)
+
+    def disable_shedding(self):
+        """Stop dropping events (see :meth:`enable_shedding`)."""
+        self._shedder = None
+
+    def shedding_info(self):
+        """Return a dict of the events dropped, ``None`` if disabled.
+
+        ``shed`` maps event names to the number of events dropped,
+        ``total`` is their sum and ``level`` the current overload level
+        (0 none, 1 over the soft limit, 2 over the hard limit).
+
+        """
+        shedder = self._shedder
+        return None if shedder is None else shedder.info()
+
+    def enable_lag_stats(self):
+        """Measure the lag of the events at each stage of their handling.
+
+        Histograms are kept of the seconds between the time Asterisk
+        sent an event (its ``Timestamp`` header, which needs
+        ``timestampevents = yes`` in ``manager.conf``) and the time it was
+        read from the socket, then until it was parsed, then until it was
+        dispatched (the time it waited in the dispatch queue), and of the
+        time taken by its callbacks (see :data:`LAG_STAGES`). The
+        ``asterisk`` stage includes the network, and the difference
+        between the clocks of the hosts.
+
+        Statistics start again if already enabled. See :meth:`lag_stats`.
+
+        """
+        self._lag = _LagStats()
+
+    def disable_lag_stats(self):
+        """Stop measuring the lag of events (see :meth:`enable_lag_stats`)."""
+        self._lag = None
+
+    def lag_stats(self):
+        """Return the histograms of the lag of events, ``None`` if disabled.
+
+        A dict mapping the stages to dicts of the ``count`` of events,
+        and, if any, their ``mean`` and ``max`` lag, its percentiles
+        ``p50``, ``p90`` and ``p99`` (the bounds of their buckets), and
+        the ``buckets`` themselves, as ``(upper bound, count)`` pairs.
+
+        """
+        lag = self._lag
+        return None if lag is None else lag.info()
+
+    def enable_profiling(self, budget=None, profile=False):
+        """Time the event callbacks, to find those slowing down dispatch.
+
+        :param budget: seconds beyond which a callback is slow: the stack
+            of the dispatch thread is then logged, while it runs
+        :param profile: also profile the callbacks with :mod:`cProfile`
+            (see :meth:`profile_stats`), which slows them down
+
+        Profiling starts again if already enabled. See
+        :meth:`profiling_info` for the time taken by each callback.
+
+        """
+        self.disable_profiling()
+        self._profiler = _CallbackProfiler(self, budget, profile)
+
+    def disable_profiling(self):
+        """Stop timing callbacks (see :meth:`enable_profiling`)."""
+        profiler = self._profiler
+        self._profiler = None
+        if profiler is not None:
+            profiler.close()
+
+    def profiling_info(self):
+        """Return the time taken by the callbacks, ``None`` if disabled.
+
+        A dict of the ``callbacks``, as dicts of the ``event`` name, the
+        ``callback`` name, and its ``calls``, ``total`` and ``max`` time
+        in seconds, the slowest in total first, and of the number of
+        ``slow`` callbacks logged.
 
-        # lock the socket and send our command
+        """
+        profiler = self._profiler
+        return None if profiler is None else profiler.info()
+
+    def profile_stats(self):
+        """Return the :class:`pstats.Stats` of the callbacks, ``None``
+        unless profiled (see :meth:`enable_profiling`) or if none were
+        called yet."""
+        profiler = self._profiler
+        if profiler is None or profiler.profile is None:
+            return None
         try:
-            self._sock.write(command.encode('utf-8'))
-            self._sock.flush()
-            logger.debug("Wrote to socket file this command:\n%s" % command)
-        except socket.error as err:
-            errno, reason = err
-            raise ManagerSocketException(errno, reason)
+            return pstats.Stats(profiler.profile)
+        except TypeError:
+            # nothing profiled (Python 2)
+            return None
+
+    def enable_window(self, initial=4, min_size=1, max_size=256,
+                      tolerance=2.0, period=256, interactive=None):
+        """Limit the actions in flight to a window adapting to their
+        latency.
+
+        Actions sent beyond the window wait for responses to come first,
+        so that bulk jobs pipelining many actions get all the throughput
+        Asterisk has, without it queueing them and making every action
+        slow.
+
+        :param initial: initial size of the window
+        :param min_size: smallest size of the window
+        :param max_size: largest size of the window
+        :param tolerance: the latency, relative to the lowest recently
+            seen, beyond which the window shrinks
+        :param period: responses after which the lowest latency is
+            measured again
+        :param interactive: actions sent right away, though counted in
+            flight, defaults to :data:`INTERACTIVE_ACTIONS`
+
+        Actions sent from done callbacks of futures (see
+        :meth:`send_action_async`) do not wait either. See
+        :meth:`window_info` for the state of the window.
 
-        self._response_waiters.insert(0, 1)
-        response = self._response_queue.get()
-        self._response_waiters.pop(0)
+        """
+        interactive = (INTERACTIVE_ACTIONS if interactive is None
+                       else interactive)
+        self._window = _ActionWindow(initial, min_size, max_size, tolerance,
+                                     period, interactive)
+
+    def disable_window(self):
+        """Stop limiting the actions in flight (see :meth:`enable_window`)."""
+        window = self._window
+        self._window = None
+        if window is not None:
+            window.close()
+
+    def window_info(self):
+        """Return a dict of the state of the window, ``None`` if disabled.
+
+        ``size`` is the size of the window, ``inflight`` the actions in
+        flight, ``base_latency`` and ``latency`` the lowest and the average
+        latencies in seconds, and ``decreases`` the times the window
+        shrank.
 
-        # if we got the sentinel value as a response we are done
-        if response is self._sentinel:
-            raise ManagerSocketException(0, 'Connection Terminated')
+        """
+        window = self._window
+        return None if window is None else window.info()
+
+    def enable_scheduler(self, priorities=None, rates=None):
+        """Send the actions by priority, with rate limits.
+
+        Actions are queued in lanes of priority :data:`HIGH`,
+        :data:`NORMAL` and :data:`LOW`, and sent by a thread of the
+        scheduler: those of a lane are sent before those of the lanes of
+        lower priority, as long as its rate limit allows. Urgent actions
+        (e.g. ``Hangup``) are thus not stuck behind a bulk job, nor can a
+        bulk job take the whole connection.
+
+        :param priorities: dict mapping actions (whatever their case) to
+            their lane, defaults to :data:`ACTION_PRIORITIES`
+        :param rates: dict mapping lanes to their rate limits, as
+            ``(actions per second, burst)``, defaults to
+            :data:`ACTION_RATES`
+
+        See :meth:`scheduler_info` for what is queued.
+
+        """
+        priorities = ACTION_PRIORITIES if priorities is None else priorities
+        rates = ACTION_RATES if rates is None else rates
+        self.disable_scheduler()
+        self._scheduler = _ActionScheduler(self, priorities, rates)
+
+    def disable_scheduler(self):
+        """Send the actions right away (see :meth:`enable_scheduler`).
+
+        Those queued are still sent, regardless of the rate limits.
+
+        """
+        scheduler = self._scheduler
+        self._scheduler = None
+        if scheduler is not None:
+            scheduler.close()
 
+    def scheduler_info(self):
+        """Return a dict of the actions queued and sent by lane, ``None``
+        if disabled."""
+        scheduler = self._scheduler
+        return None if scheduler is None else scheduler.info()
+
+    def _send_coalesced(self, cdict):
+        """Send an action unless an identical one is in flight.
+
+        In that case wait for the response to that one.
+
+        """
+        key = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in cdict.items()))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            logger.debug("Coalescing %s with the one in flight" %
+                         cdict['Action'])
+            return future.result()
+
+        try:
+            response = self._send_action(cdict)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+        future.set_result(response)
         return response
 
+    def send_action_async(self, cdict):
+        """Send an action without waiting for its response.
+
+        :return: a :class:`Future` of the response, which fails with
+            :exc:`ManagerSocketException` if the connection is terminated
+
+        Responses are neither coalesced nor cached (see
+        :meth:`send_action`). Done callbacks of the future are run by the
+        thread reading messages, so they must be quick.
+
+        This waits while the window of actions in flight is full, if
+        enabled (see :meth:`enable_window`). If the scheduler is enabled
+        (see :meth:`enable_scheduler`), the action is queued, and the
+        future fails instead of this raising if it can't be sent.
+
+        """
+        if not self.is_connected():
+            raise ManagerException("Not connected")
+        pending = self._prepare(cdict)
+        self._submit([pending])
+        return pending.future
+
+    def send_template_async(self, template, *values):
+        """Send an :class:`ActionTemplate` with `values`.
+
+        Like :meth:`send_action_async`, without building and formatting a
+        dict of the action.
+
+        """
+        if not self.is_connected():
+            raise ManagerException("Not connected")
+        pending = self._prepare(None, template, values)
+        self._submit([pending])
+        return pending.future
+
+    def send_actions(self, actions):
+        """Send actions back to back, written together to the socket.
+
+        :param actions: dicts of actions, as given to :meth:`send_action`,
+            or ``(template, values)`` pairs of an :class:`ActionTemplate`
+            and its values
+        :return: the list of the futures of the responses (see
+            :meth:`send_action_async`)
+
+        Actions are written as they fit in the window of actions in
+        flight, if enabled (see :meth:`enable_window`).
+
+        """
+        if not self.is_connected():
+            raise ManagerException("Not connected")
+        futures = []
+        pendings = []
+        for action in actions:
+            window = self._window
+            if pendings and window is not None and window.full():
+                # write those before waiting for a place
+                self._submit(pendings)
+                pendings = []
+            if isinstance(action, tuple):
+                pending = self._prepare(None, *action)
+            else:
+                pending = self._prepare(action)
+            pendings.append(pending)
+            futures.append(pending.future)
+        if pendings:
+            self._submit(pendings)
+        return futures
+
+    def _prepare(self, cdict, template=None, values=None):
+        """Return an action (a dict, or a template and its values) ready to
+        be written, its future waiting for the response."""
+        action = template.action if cdict is None else cdict.get('Action')
+        window = self._window
+        if window is not None:
+            token = window.acquire(
+                wait=action not in window.interactive and
+                threading.current_thread() is not self.message_thread)
+            if not self.is_connected():
+                window.release(token)
+                raise ManagerException("Not connected")
+
+        if cdict is None:
+            action_id = self.next_action_id()
+            data = template.render(action_id, values)
+        else:
+            # set the action id
+            if 'ActionID' not in cdict:
+                cdict['ActionID'] = self.next_action_id()
+            action_id = cdict['ActionID']
+            data = _format_action(cdict).encode('utf-8')
+        pending = _PendingAction(action, action_id, data, Future())
+
+        # register as a waiter before sending, the response may be fast
+        with self._response_lock:
+            self._response_waiters[action_id] = pending.future
+        if window is not None:
+            pending.future.add_done_callback(
+                lambda future: window.release(token, pending.latency()))
+        return pending
+
+    def _submit(self, pendings):
+        """Write actions, or queue them in the scheduler if enabled."""
+        scheduler = self._scheduler
+        if scheduler is None:
+            self._write(pendings)
+        else:
+            scheduler.put(pendings)
+
+    def _write(self, pendings):
+        """Write actions to the socket in one go, failing their futures
+        and raising :exc:`ManagerSocketException` if they can't be."""
+        # those failed while queued, the connection was closed
+        pendings = [p for p in pendings if not p.future.done()]
+        if not pendings:
+            return
+        data = b''.join(p.data for p in pendings)
+        # lock the socket and send our commands
+        try:
+            with self._write_lock:
+                sent = _monotonic()
+                for pending in pendings:
+                    pending.sent = sent
+                self._sock.write(data)
+                self._sock.flush()
+        except socket.error as err:
+            with self._response_lock:
+                for pending in pendings:
+                    self._response_waiters.pop(pending.action_id, None)
+            errno, reason = err
+            exception = ManagerSocketException(errno, reason)
+            for pending in pendings:
+                pending.future.set_exception(exception)
+            raise exception
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Wrote to socket file this command:\n%s" %
+                         data.decode('utf-8'))
+
+    def _send_scheduled(self, pendings):
+        """Write actions queued by the scheduler, failing their futures if
+        they can't be."""
+        try:
+            self._write(pendings)
+        except ManagerSocketException:
+            pass
+        except Exception:
+            # e.g. closed meanwhile
+            logger.exception("Exception sending actions")
+            for pending in pendings:
+                pending.future.set_exception(
+                    ManagerSocketException(0, 'Connection Terminated'))
+
+    def _send_action(self, cdict):
+        """Send an action and wait for its response."""
+        # raises `ManagerSocketException` if the connection is terminated
+        return self.send_action_async(cdict).result()
+
+    def _response_received(self, message):
+        """Hand a response to whoever is waiting for it."""
+        action_id = message.get_header('ActionID')
+        with self._response_lock:
+            future = self._response_waiters.pop(action_id, None)
+            if (future is None and action_id is None and
+                    self._response_waiters):
+                # some commands answer without the ActionID, assume the
+                # response is for the oldest waiter
+                future = self._response_waiters.popitem(last=False)[1]
+        if future is not None:
+            future.set_result(message)
+        elif self._greeting_expected:
+            # the greeting, see `connect`
+            self._greeting_expected = False
+            self._response_queue.put(message)
+        else:
+            # e.g. that of an action given up on, nobody would read it
+            logger.debug("Dropped a response to no action: %s" % action_id)
+
+    def _fail_response_waiters(self):
+        """Notify those waiting for a response that there won't be any."""
+        with self._response_lock:
+            futures = list(self._response_waiters.values())
+            self._response_waiters.clear()
+        for future in futures:
+            future.set_exception(
+                ManagerSocketException(0, 'Connection Terminated'))
+
     def _receive_data(self):
         """
         Read the response from a command.
         """
 
-        multiline = False
-        wait_for_marker = False
-        eolcount = 0
+        framer = _MessageFramer()
         # loop while we are sill running and connected
         while self.is_running() and self.is_connected():
             try:
                 lines = []
                 for line in self._sock:
-                    line = line.decode('utf-8')
-                    # check to see if this is the greeting line
-                    if not self.title and '/' in line and ':' not in line:
-                        # store the title of the manager we are connecting to:
-                        self.title = line.split('/')[0].strip()
-                        # store the version of the manager we are connecting to:
-                        self.version = line.split('/')[1].strip()
-                        # fake message header
-                        lines.append('Response: Generated Header\r\n')
-                        lines.append(line)
-                        logger.debug("Fake message header. Will exit the "
-                                     "socket file iteration loop")
+                    lines = framer.feed(line.decode('utf-8'))
+                    if lines:
+                        received = _monotonic()
+                        logger.debug("Have %s lines. Will exit the socket "
+                                     "file iteration loop" % len(lines))
                         break
-                    # If the line is EOL marker we have a complete message.
-                    # Some commands are broken and contain a \n\r\n
-                    # sequence, in the case wait_for_marker is set, we
-                    # have such a command where the data ends with the
-                    # marker --END COMMAND--, so we ignore embedded
-                    # newlines until we see that marker
-                    if line == EOL and not wait_for_marker:
-                        multiline = False
-
-                        # we split the break conditions because they are of very
-                        # different nature and we'd like more fine-grained logs
-                        if lines:
-                            logger.debug("Have %s lines. Will exit the socket "
-                                         "file iteration loop" % len(lines))
-                            break
-                        if not self.is_connected():
-                            logger.warning("Not connected. Will exit the "
-                                           "socket file iteration loop")
-                            break
-
-                        # ignore empty lines at start
-                        continue
-                    lines.append(line)
-                    # line not ending in \r\n or without ':' isn't a
-                    # valid header and starts multiline response
-                    if not line.endswith('\r\n') or ':' not in line:
-                        multiline = True
-                    # Response: Follows indicates we should wait for end
-                    # marker --END COMMAND--
-                    if (not multiline and line.startswith('Response') and
-                            line.split(':', 1)[1].strip() == 'Follows'):
-                        wait_for_marker = True
-                    # same when seeing end of multiline response
-                    if multiline and line.startswith('--END COMMAND--'):
-                        wait_for_marker = False
-                        multiline = False
                     if not self.is_connected():
                         logger.info("Not connected. Will exit the "
                                     "socket file iteration loop")
+                        lines = framer.flush()
+                        received = _monotonic()
                         break
                 else:
                     # EOF during reading
@@ -394,11 +1831,16 @@ class Manager(object):
                     self._sock.close()
                     logger.info("Closed socket file")
                     self._connected.clear()
+                if framer.title and not self.title:
+                    # store the title and version of the manager we are
+                    # connecting to (taken from the greeting line)
+                    self.title = framer.title
+                    self.version = framer.version
                 # if we have a message append it to our queue
                 # else notify `message_loop` that it has to finish
                 if lines:
                     if self.is_connected():
-                        self._message_queue.put(lines)
+                        self._message_queue.put((lines, received))
                     else:
                         msg = "Received lines but are not connected"
                         logger.warning(msg)
@@ -419,6 +1861,109 @@ class Manager(object):
                 self._message_queue.put(self._sentinel)
                 self.errors_in_threads.put(msg)
 
+    def wait_for_event(self, name, timeout=None, **header_match):
+        """Return a future for the next event `name` with the given headers.
+
+        E.g. ``manager.wait_for_event('Hangup', 30, Uniqueid=uid).result()``
+        returns the ``Hangup`` event of that channel, or raises
+        :exc:`ManagerTimeoutException` if it is not received in 30 seconds.
+
+        Only events received after this call are considered, so call it
+        before sending the action that leads to the event. The future is
+        resolved by the thread reading messages (before the event is
+        dispatched to the callbacks), which is also where its done
+        callbacks run, so they must be quick.
+
+        Waiters are indexed by event name and the value of one of their
+        headers (the first one in :data:`WAITER_KEY_HEADERS` if any), so
+        they cost little to events that do not match them.
+
+        """
+        header = None
+        for candidate in WAITER_KEY_HEADERS:
+            if candidate in header_match:
+                header = candidate
+                break
+        else:
+            if header_match:
+                header = sorted(header_match)[0]
+
+        waiter = EventWaiter(self, name, header_match, header, timeout)
+        with self._waiters_lock:
+            self._waiters.setdefault(waiter.key, []).append(waiter)
+            headers = self._waiter_headers.setdefault(name, {})
+            headers[header] = headers.get(header, 0) + 1
+            if waiter.deadline is not None:
+                heapq.heappush(self._waiter_deadlines,
+                               (waiter.deadline, id(waiter), waiter))
+        return waiter
+
+    def _remove_waiter(self, waiter):
+        with self._waiters_lock:
+            return self._remove_waiter_locked(waiter)
+
+    def _remove_waiter_locked(self, waiter):
+        waiters = self._waiters.get(waiter.key, [])
+        if waiter not in waiters:
+            return False
+        waiters.remove(waiter)
+        if not waiters:
+            del self._waiters[waiter.key]
+        headers = self._waiter_headers[waiter.name]
+        headers[waiter.header] -= 1
+        if not headers[waiter.header]:
+            del headers[waiter.header]
+            if not headers:
+                del self._waiter_headers[waiter.name]
+        return True
+
+    def _resolve_waiters(self, event):
+        """Hand `event` to those waiting for it, expire those timed out."""
+        matched = []
+        expired = []
+        with self._waiters_lock:
+            for header in self._waiter_headers.get(event.name, ()):
+                value = None if header is None else event.get_header(header)
+                for waiter in self._waiters.get((event.name, header, value), ()):
+                    if waiter.matches(event):
+                        matched.append(waiter)
+            for waiter in matched:
+                self._remove_waiter_locked(waiter)
+
+            deadlines = self._waiter_deadlines
+            now = _monotonic()
+            while deadlines and deadlines[0][0] <= now:
+                waiter = heapq.heappop(deadlines)[2]
+                if not waiter.done():
+                    expired.append(waiter)
+
+        for waiter in matched:
+            waiter.set_result(event)
+        for waiter in expired:
+            waiter.cancel()
+
+    def _fail_event_waiters(self):
+        """Notify those waiting for events that there won't be any."""
+        with self._waiters_lock:
+            waiters = [w for ws in self._waiters.values() for w in ws]
+        for waiter in waiters:
+            waiter.cancel(ManagerSocketException(0, 'Connection Terminated'))
+
+    def _event_connection_lost(self):
+        """Drop the connection, as its event connection was lost."""
+        self._fail_event_waiters()
+        if not self.is_connected():
+            return
+        # the receiving thread then finds the connection closed, and
+        # notifies the others as when the connection is lost
+        sock = self._sock
+        # the socket under the file of `connect`, in Python 2 or 3
+        raw = getattr(sock, '_sock', None) or sock.reader.raw._sock
+        try:
+            raw.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
     def register_event(self, event, function):
         """
         Register a callback for the specfied event.
@@ -440,6 +1985,50 @@ class Manager(object):
         current_callbacks.remove(function)
         self._event_callbacks[event] = current_callbacks
 
+    def register_batch(self, event, function, max_size=100, max_latency=0.5):
+        """
+        Register a callback for batches of the specified event.
+
+        The callback is called as ``function(events, manager)`` with the list
+        of events received, once there are `max_size` of them or the first
+        one has waited `max_latency` seconds (at the latest when the
+        connection is closed). It is called from the dispatch thread, after
+        the callbacks registered with :meth:`register_event` (which do not
+        stop events from being batched).
+        """
+        batch = _EventBatch(function, max_size, max_latency)
+        self._event_batches[event] = self._event_batches.get(event, []) + [batch]
+
+    def unregister_batch(self, event, function):
+        """
+        Unregister a batch callback, the pending events are discarded.
+        """
+        batches = self._event_batches.get(event, [])
+        for batch in batches:
+            if batch.function == function:
+                break
+        else:
+            raise ValueError('%r is not registered for %s' % (function, event))
+        self._event_batches[event] = [b for b in batches if b is not batch]
+
+    def _flush_batches(self, force=False):
+        """Deliver the batches that are due, all if `force`.
+
+        :return: the seconds until the next batch is due, or ``None``
+
+        """
+        now = _monotonic()
+        timeout = None
+        for batches in list(self._event_batches.values()):
+            for batch in batches:
+                if batch.deadline is None:
+                    continue
+                if force or batch.deadline <= now:
+                    batch.flush(self)
+                elif timeout is None or batch.deadline - now < timeout:
+                    timeout = batch.deadline - now
+        return timeout
+
     def message_loop(self):
         """
         The method for the event thread.
@@ -455,32 +2044,34 @@ class Manager(object):
         try:
             # loop getting messages from the queue
             while self.is_running():
-                # get/wait for messages
+                # get/wait for messages, with the time they were read
                 data = self._message_queue.get()
 
                 # if we got the sentinel value as our message we are done
-                # (have to notify `_event_queue` once, and `_response_queue`
-                #  as many times as the length of `_response_waiters`)
+                # (have to notify `_event_queue`, `_response_queue` and
+                #  the futures in `_response_waiters`)
                 if data is self._sentinel:
                     logger.info("Got sentinel object. Will notify the other "
                                 "queues and then break this loop")
                     # notify `event_dispatch` that it has to finish
                     self._event_queue.put(self._sentinel)
-                    for waiter in self._response_waiters:
-                        self._response_queue.put(self._sentinel)
+                    self._response_queue.put(self._sentinel)
+                    self._fail_response_waiters()
+                    self._fail_event_waiters()
                     break
 
                 # parse the data
-                message = ManagerMessage(data)
+                lines, received = data
+                message = ManagerMessage(lines, received)
 
                 # check if this is an event message
                 if message.has_header('Event'):
-                    self._event_queue.put(Event(message))
+                    self._event_received(Event(message))
                 # check if this is a response
                 elif message.has_header('Response'):
-                    self._response_queue.put(message)
+                    self._response_received(message)
                 else:
-                    # notify `_response_queue`'s consumer (`send_action`)
+                    # notify `_response_queue`'s consumer (`connect`)
                     # that it has to finish
                     msg = "No clue what we got\n%s" % message.data
                     logger.error(msg)
@@ -494,17 +2085,39 @@ class Manager(object):
             logger.debug("Waiting for our data-receiving thread to exit")
             t.join()
 
+    def _event_received(self, event):
+        """Handle an event, before it is queued for dispatching."""
+        cache = self._cache
+        if cache is not None:
+            cache.invalidate(event)
+        if self._waiter_headers or self._waiter_deadlines:
+            self._resolve_waiters(event)
+        shedder = self._shedder
+        if shedder is not None and not shedder.admit(
+                event, self._event_queue.qsize()):
+            return
+        lag = self._lag
+        if lag is not None:
+            lag.queued(event)
+        self._event_queue.put(event)
+
     def event_dispatch(self):
         """This thread is responsible for dispatching events"""
 
         # loop dispatching events
+        timeout = None
         while self.is_running():
-            # get/wait for an event
-            ev = self._event_queue.get()
+            # get/wait for an event, or until a batch of events is due
+            try:
+                ev = self._event_queue.get(timeout=timeout)
+            except queue.Empty:
+                timeout = self._flush_batches()
+                continue
 
             # if we got the sentinel value as an event we are done
             if ev is self._sentinel:
                 logger.info("Got sentinel object. Will break dispatch loop")
+                self._flush_batches(force=True)
                 break
 
             # dispatch our events
@@ -513,13 +2126,41 @@ class Manager(object):
             callbacks = (self._event_callbacks.get(ev.name, []) +
                          self._event_callbacks.get('*', []))
 
+            lag = self._lag
+            if lag is not None and ev.queued is not None:
+                started = _monotonic()
+                lag.histograms['dispatch'].record(started - ev.queued)
+
             # now execute the functions  
+            profiler = self._profiler
             for callback in callbacks:
-                if callback(ev, self):
+                if profiler is not None:
+                    if profiler.call(callback, ev):
+                        break
+                elif callback(ev, self):
                     break
 
-    def connect(self, host, port=5038):
-        """Connect to the manager interface"""
+            if lag is not None and ev.queued is not None:
+                lag.histograms['callback'].record(_monotonic() - started)
+
+            # and collect the event for the batch callbacks
+            if self._event_batches:
+                for batch in (self._event_batches.get(ev.name, []) +
+                              self._event_batches.get('*', [])):
+                    if batch.add(ev):
+                        batch.flush(self)
+                timeout = self._flush_batches()
+
+    def connect(self, host, port=5038, separate_events=False):
+        """Connect to the manager interface
+
+        With `separate_events`, a second connection is opened to receive
+        the events, and this one is logged in with ``Events: off``, so
+        that responses do not wait behind bursts of events. Events are
+        then handled as if received on this connection (callbacks are
+        called with this manager), and :meth:`login` and :meth:`close`
+        apply to both connections.
+        """
 
         if self.is_connected():
             raise ManagerException('Already connected to manager')
@@ -556,11 +2197,25 @@ class Manager(object):
         if response is self._sentinel:
             raise ManagerSocketException(0, "Connection Terminated")
 
+        if separate_events:
+            self._event_connection = _EventConnection(self)
+            try:
+                self._event_connection.connect(host, port)
+            except ManagerException:
+                self._event_connection = None
+                self.close()
+                raise
+
         return response
 
     def close(self):
         """Shutdown the connection to the manager"""
 
+        if self._event_connection is not None:
+            logger.debug("Closing the event connection")
+            self._event_connection.close()
+            self._event_connection = None
+
         # if we are still running, logout
         if self.is_running() and self.is_connected():
             logger.debug("Logoff before closing (we are running and connected)")
@@ -596,11 +2251,17 @@ class Manager(object):
             'Username': username,
             'Secret': secret,
         }
+        if self._event_connection is not None:
+            # events are received by the event connection
+            cdict['Events'] = 'off'
         response = self.send_action(cdict)
 
         if response.get_header('Response') == 'Error':
             raise ManagerAuthException(response.get_header('Message'))
 
+        if self._event_connection is not None:
+            self._event_connection.login(username, secret)
+
         return response
 
     def ping(self):
@@ -760,6 +2421,54 @@ class Manager(object):
         }
         return self.send_action(cdict)
 
+    def get_vars(self, channel, names, timeout=None):
+        """Get channel variables, all requested at once.
+
+        The ``Getvar`` actions are written together and their responses
+        awaited together, so this takes about one round trip whatever the
+        number of variables.
+
+        :param names: names of the variables (or of functions, e.g.
+            ``CALLERID(num)``)
+        :param timeout: seconds to wait for all the responses
+        :return: dict mapping the names to the values
+        :raises ManagerException: if a variable can't be read (e.g. the
+            channel does not exist)
+
+        """
+        names = list(names)
+        futures = self.send_actions([(_GETVAR, (channel, name))
+                                     for name in names])
+        responses = self._wait_all(futures, timeout)
+        return dict((name, response.get_header('Value'))
+                    for name, response in zip(names, responses))
+
+    def set_vars(self, channel, mapping, timeout=None):
+        """Set channel variables, all at once (see :meth:`get_vars`).
+
+        :param mapping: dict mapping the names of the variables to their
+            values
+        :raises ManagerException: if a variable can't be set
+
+        """
+        futures = self.send_actions([(_SETVAR, (channel, name, value))
+                                     for name, value in mapping.items()])
+        self._wait_all(futures, timeout)
+
+    def _wait_all(self, futures, timeout):
+        """Return the responses of `futures`, waited at most `timeout`
+        seconds in all, raising ManagerException for the first error."""
+        deadline = None if timeout is None else _monotonic() + timeout
+        responses = []
+        for future in futures:
+            responses.append(future.result(
+                None if deadline is None
+                else max(0, deadline - _monotonic())))
+        for response in responses:
+            if response.get_header('Response') != 'Success':
+                raise ManagerException(response.get_header('Message'))
+        return responses
+
     def mailbox_count(self, mailbox):
         cdict = {
             'Action': 'MailboxCount',
@@ -779,6 +2488,39 @@ class Manager(object):
         return self.send_action(cdict)
 
 
+class _EventConnection(Manager):
+
+    """The connection receiving the events of a :class:`Manager` opened
+    with ``separate_events``.
+
+    Its events are handed to that manager, as if received by it.
+
+    """
+
+    def __init__(self, manager):
+        super(_EventConnection, self).__init__()
+        self._manager = manager
+        self.errors_in_threads = manager.errors_in_threads
+        self._closing = False
+
+    def _event_received(self, event):
+        self._manager._event_received(event)
+
+    def _fail_event_waiters(self):
+        # called once the connection is gone: unless closed by the manager,
+        # it would not receive events any more, and is dropped too
+        if self._closing:
+            return
+        msg = "Event connection lost"
+        logger.error(msg)
+        self.errors_in_threads.put(msg)
+        self._manager._event_connection_lost()
+
+    def close(self):
+        self._closing = True
+        super(_EventConnection, self).close()
+
+
 class ManagerException(Exception):
     pass
 
@@ -789,3 +2531,7 @@ class ManagerSocketException(ManagerException):
 
 class ManagerAuthException(ManagerException):
     pass
+
+
+class ManagerTimeoutException(ManagerException):
+    pass
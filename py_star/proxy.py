@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Manager interface proxy
+
+An :class:`AMIProxy` shares the connection of a
+:class:`~py_star.manager.Manager` with many clients, which connect to it
+as they would to Asterisk: Asterisk serializes its events once, for the
+proxy, instead of once per client.
+
+   import py_star.manager
+   import py_star.proxy
+
+   manager = py_star.manager.Manager()
+   manager.connect('host')
+   manager.login('user', 'secret')
+
+   proxy = py_star.proxy.AMIProxy(manager, port=5039,
+                                  users={'wallboard': 'secret'})
+   proxy.start()
+   ...
+   proxy.close()
+
+Clients log in with the users given to the proxy (any user is accepted
+if none are), and their actions are sent to Asterisk with their ActionID
+rewritten, to tell apart the responses (and the events listing their
+results) of each client. Each client has its own event filters, set with
+the ``Filter`` action (a regular expression matched against the text of
+events, excluding events if it starts with ``!``, as ``eventfilter`` in
+``manager.conf``) or turned off with ``Events: off`` when logging in or
+the ``Events`` action.
+
+Events are queued for each client, up to `max_queue`: a client that does
+not keep up loses events (they are counted in its ``dropped`` attribute)
+but does not slow down Asterisk nor the other clients. Responses are never
+dropped.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import hmac
+import itertools
+import logging
+import re
+import socket
+import threading
+
+from .manager import EOL, _event_text, _format_action
+
+logger = logging.getLogger(__name__)
+
+# ActionIDs of the actions of the clients: PREFIX<client number>-<kind>...
+# with kind 'a' followed by the ActionID of the client, or 'n' followed by
+# a number if the client gave none
+_PREFIX = 'proxy'
+
+
+def _constant_time_compare(a, b):
+    """Compare two byte strings in a time independent of where they
+    differ (``hmac.compare_digest`` is only in Python 2.7.7 and later)."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+_compare_digest = getattr(hmac, 'compare_digest', _constant_time_compare)
+
+
+def _response(action_id, **headers):
+    """Return the text of a response given by the proxy itself."""
+    cdict = collections.OrderedDict()
+    cdict['Response'] = headers.pop('Response', 'Success')
+    if action_id is not None:
+        cdict['ActionID'] = action_id
+    cdict.update(sorted(headers.items()))
+    return _format_action(cdict)
+
+
+def _replace_action_id(lines, action_id):
+    """Return the text of a message with its ActionID replaced."""
+    out = []
+    replaced = False
+    for line in lines:
+        if not replaced and line.startswith('ActionID:'):
+            replaced = True
+            if action_id is not None:
+                out.append('ActionID: %s\r\n' % action_id)
+            continue
+        out.append(line)
+    out.append(EOL)
+    return ''.join(out)
+
+
+class _ProxyClient(object):
+
+    """A client of the proxy, served by a reading and a writing thread."""
+
+    def __init__(self, proxy, sock, address, number):
+        self.proxy = proxy
+        self.address = address
+        self.number = number
+        self.prefix = '%s%d-' % (_PREFIX, number)
+        self.username = None
+        self.events = True
+        self.filters = []  # (include, compiled regular expression)
+        self.dropped = 0
+        self._sock = sock
+        self._sequence = itertools.count()
+        self._out = collections.deque()
+        self._condition = threading.Condition()
+        self._closing = False  # close once what is queued is sent
+        self._closed = False
+
+    def __repr__(self):
+        return '<Client %d %s:%s>' % ((self.number,) + tuple(self.address[:2]))
+
+    def start(self):
+        for target in (self._read, self._write):
+            t = threading.Thread(target=target,
+                                 name='%r %s' % (self, target.__name__))
+            t.setDaemon(True)
+            t.start()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.proxy._remove(self)
+
+    def send(self, text, droppable=False):
+        """Queue `text` to be sent, unless the queue is full and it is
+        `droppable`."""
+        with self._condition:
+            if self._closed:
+                return
+            if droppable and len(self._out) >= self.proxy.max_queue:
+                if not self.dropped:
+                    logger.warning("%r does not keep up, dropping events" %
+                                   self)
+                self.dropped += 1
+                return
+            self._out.append(text)
+            self._condition.notify()
+
+    def _write(self):
+        try:
+            while True:
+                with self._condition:
+                    while not (self._out or self._closing or self._closed):
+                        self._condition.wait()
+                    if self._closed or not self._out:
+                        break
+                    texts = list(self._out)
+                    self._out.clear()
+                self._sock.sendall(''.join(texts).encode('utf-8'))
+        except socket.error:
+            logger.info("%r disconnected" % self)
+        finally:
+            self.close()
+            self._sock.close()
+
+    def _read(self):
+        self.send('Asterisk Call Manager/%s\r\n' % (
+            self.proxy.manager.version or '1.1'))
+        f = self._sock.makefile('rb')
+        headers = []
+        try:
+            for line in f:
+                line = line.decode('utf-8')
+                if line.strip():
+                    key, sep, value = line.partition(':')
+                    headers.append((key.strip(), value.strip()))
+                elif headers:
+                    self._handle(headers)
+                    headers = []
+                if self._closing or self._closed:
+                    break
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            # the writing thread closes once it has sent what is queued
+            with self._condition:
+                self._closing = True
+                self._condition.notify()
+
+    def _handle(self, headers):
+        """Handle an action (a list of headers)."""
+        cdict = {}
+        for key, value in headers:
+            if key in cdict:
+                if not isinstance(cdict[key], list):
+                    cdict[key] = [cdict[key]]
+                cdict[key].append(value)
+            else:
+                cdict[key] = value
+        action = cdict.get('Action', '').lower()
+        action_id = cdict.pop('ActionID', None)
+
+        if action == 'login':
+            self._login(cdict, action_id)
+        elif action == 'logoff':
+            self.send(_response(action_id, Response='Goodbye',
+                                Message='Thanks for all the fish.'))
+            with self._condition:
+                self._closing = True
+                self._condition.notify()
+        elif self.username is None:
+            self.send(_response(action_id, Response='Error',
+                                Message='Permission denied'))
+        elif action == 'events':
+            self.events = cdict.get('EventMask', 'on').lower() != 'off'
+            self.send(_response(action_id, Events='On' if self.events
+                                else 'Off'))
+        elif action == 'filter':
+            self._filter(cdict, action_id)
+        else:
+            self._forward(cdict, action_id)
+
+    def _login(self, cdict, action_id):
+        users = self.proxy.users
+        username = cdict.get('Username')
+        secret = cdict.get('Secret')
+        if users is not None and (
+                username not in users or secret is None or
+                not _compare_digest(users[username].encode('utf-8'),
+                                    secret.encode('utf-8'))):
+            logger.warning("%r failed to log in as %s" % (self, username))
+            self.send(_response(action_id, Response='Error',
+                                Message='Authentication failed'))
+            return
+        self.username = username
+        self.events = cdict.get('Events', 'on').lower() != 'off'
+        self.send(_response(action_id, Message='Authentication accepted'))
+
+    def _filter(self, cdict, action_id):
+        expression = cdict.get('Filter', '')
+        if cdict.get('Operation', 'Add').lower() != 'add' or not expression:
+            self.send(_response(action_id, Response='Error',
+                                Message='Unknown operation'))
+            return
+        include = not expression.startswith('!')
+        try:
+            regex = re.compile(expression if include else expression[1:])
+        except re.error:
+            self.send(_response(action_id, Response='Error',
+                                Message='Filter could not be added'))
+            return
+        self.filters.append((include, regex))
+        self.send(_response(action_id, Message='Filter Added Successfully'))
+
+    def _forward(self, cdict, action_id):
+        """Send an action to Asterisk, with its ActionID rewritten."""
+        if action_id is None:
+            cdict['ActionID'] = '%sn%d' % (self.prefix, next(self._sequence))
+        else:
+            cdict['ActionID'] = '%sa%s' % (self.prefix, action_id)
+        try:
+            future = self.proxy.manager.send_action_async(cdict)
+        except Exception as err:
+            self.send(_response(action_id, Response='Error',
+                                Message='%s' % err))
+            return
+        future.add_done_callback(
+            lambda future: self._forward_response(future, action_id))
+
+    def _forward_response(self, future, action_id):
+        exception = future.exception()
+        if exception is not None:
+            self.send(_response(action_id, Response='Error',
+                                Message='%s' % exception))
+            self.close()
+            return
+        self.send(_replace_action_id(future.result().response, action_id))
+
+    def wants(self, event, text):
+        """Return whether the filters let `event` (of text `text`) through."""
+        if not self.events or self.username is None:
+            return False
+        included = None
+        for include, regex in self.filters:
+            if regex.search(text):
+                if not include:
+                    return False
+                included = True
+            elif include and included is None:
+                included = False
+        return included is not False
+
+
+class AMIProxy(object):
+
+    """Serve the connection of `manager` to clients on `host` and `port`.
+
+    :param users: dict mapping the usernames of the clients to their
+        secrets, ``None`` to accept any client
+    :param max_queue: events queued for a client, beyond which they are
+        dropped
+
+    See the module documentation.
+
+    """
+
+    def __init__(self, manager, host='127.0.0.1', port=5038, users=None,
+                 max_queue=10000):
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.users = users
+        self.max_queue = max_queue
+        self.clients = {}  # number -> _ProxyClient
+        self.address = None
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def start(self):
+        """Listen for clients, and pass them the events of the manager."""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(16)
+        self.address = self._sock.getsockname()
+        self.manager.register_event('*', self._dispatch)
+        t = threading.Thread(target=self._accept, name='AMIProxy')
+        t.setDaemon(True)
+        t.start()
+
+    def close(self):
+        """Stop listening and disconnect the clients."""
+        if self._sock is None:
+            return
+        self.manager.unregister_event('*', self._dispatch)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self._sock = None
+        with self._lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.close()
+
+    def _accept(self):
+        while self._sock is not None:
+            try:
+                sock, address = self._sock.accept()
+            except (socket.error, AttributeError):
+                # closed
+                break
+            with self._lock:
+                client = _ProxyClient(self, sock, address,
+                                      next(self._numbers))
+                self.clients[client.number] = client
+            logger.info("%r connected" % client)
+            client.start()
+
+    def _remove(self, client):
+        with self._lock:
+            self.clients.pop(client.number, None)
+
+    def _client_of(self, action_id):
+        """Return the client of a rewritten ActionID and its own one."""
+        if not action_id.startswith(_PREFIX):
+            return None, None
+        number, sep, rest = action_id[len(_PREFIX):].partition('-')
+        try:
+            client = self.clients.get(int(number))
+        except ValueError:
+            return None, None
+        return client, rest[1:] if rest.startswith('a') else None
+
+    def _dispatch(self, event, manager):
+        text = None
+        action_id = event.get_header('ActionID')
+        if action_id is not None:
+            # a result of an action, of a client or of someone else
+            client, action_id = self._client_of(action_id)
+            if client is not None:
+                client.send(_replace_action_id(event.message.response,
+                                               action_id))
+            return
+        with self._lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            if text is None:
+                text = _event_text(event)
+            if client.wants(event, text):
+                client.send(text + EOL, droppable=True)
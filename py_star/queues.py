@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Live state of the call queues
+
+A :class:`QueueState` loads the state of the queues once (``QueueStatus``)
+and then keeps it up to date from the queue events, so wallboards can read
+members, callers, waiting times and service levels without sending actions
+to Asterisk.
+
+   import py_star.queues
+
+   queues = py_star.queues.QueueState()
+   queues.attach(manager)
+   queues.seed(manager)
+
+   # every second
+   for queue in queues.queues.values():
+      print ("%s: %d calls, longest wait %.0f s, %d agents available, "
+             "service level %s" % (
+                 queue.name, len(queue.callers), queue.longest_wait(),
+                 queue.available, queue.service_level_perf()))
+
+The events used are those of Asterisk 12 and later (``QueueMemberStatus``,
+``QueueCallerJoin``...) and their older equivalents (``Join``, ``Leave``,
+``QueueMemberPaused``...). Agent events (``AgentConnect`` and
+``AgentComplete``) require ``eventwhencalled = yes`` in ``queues.conf``.
+
+Counters (answered and abandoned calls, hold and talk times) start from
+the statistics reported by Asterisk when seeding, and are reset with them
+(e.g. by ``QueueReset``) only when seeding again.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+from .calls import _event_time
+from .manager import ManagerException, ManagerTimeoutException
+
+logger = logging.getLogger(__name__)
+
+# member statuses (device states) in which members can take calls
+_AVAILABLE_STATUSES = frozenset(('1',))  # not in use
+
+# member statuses of the device states (as in DeviceStateChange events)
+_DEVICE_STATUSES = {
+    'UNKNOWN': '0',
+    'NOT_INUSE': '1',
+    'INUSE': '2',
+    'BUSY': '3',
+    'INVALID': '4',
+    'UNAVAILABLE': '5',
+    'RINGING': '6',
+    'RINGINUSE': '7',
+    'ONHOLD': '8',
+}
+
+
+def _int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class Member(object):
+
+    """A member (agent) of a queue, by interface."""
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.name = interface
+        self.state_interface = None
+        self.membership = None
+        self.penalty = 0
+        self.calls_taken = 0
+        self.last_call = 0
+        self.in_call = False
+        self.status = None
+        self.paused = False
+        self.paused_reason = None
+
+    def __repr__(self):
+        return '<Member %s>' % self.interface
+
+    @property
+    def available(self):
+        """Whether the member can take a call now."""
+        return not self.paused and self.status in _AVAILABLE_STATUSES
+
+
+class Caller(object):
+
+    """A call waiting in a queue."""
+
+    def __init__(self, uniqueid, channel, joined):
+        self.uniqueid = uniqueid
+        self.channel = channel
+        self.caller_id_num = None
+        self.caller_id_name = None
+        self.joined = joined
+        self.position = None
+
+    def __repr__(self):
+        return '<Caller %s %s>' % (self.uniqueid, self.channel)
+
+
+class Queue(object):
+
+    """The state and statistics of a queue.
+
+    :attr:`members` maps interfaces to :class:`Member` objects,
+    :attr:`callers` maps the ``Uniqueid`` of the calls waiting to
+    :class:`Caller` objects, the longest waiting first. :attr:`available`
+    is the number of members that can take a call.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.strategy = None
+        self.max = 0
+        self.service_level = 0  # seconds
+        self.members = {}
+        self.callers = collections.OrderedDict()
+        self.available = 0
+        self.completed = 0
+        self.completed_in_service_level = 0
+        self.abandoned = 0
+        self.hold_time = 0.0  # total, of the calls completed
+        self.talked = 0
+        self.talk_time = 0.0  # total
+
+    def __repr__(self):
+        return '<Queue %s>' % self.name
+
+    def longest_wait(self, now=None):
+        """Return the seconds the longest waiting caller has waited."""
+        for caller in self.callers.values():
+            return max(0, (now or time.time()) - caller.joined)
+        return 0
+
+    def service_level_perf(self):
+        """Return the ratio of calls answered within the service level.
+
+        Among the calls completed (answered), as Asterisk does, or
+        ``None`` if there are none.
+
+        """
+        if not self.completed:
+            return None
+        return float(self.completed_in_service_level) / self.completed
+
+    def abandon_rate(self):
+        """Return the ratio of calls abandoned (``None`` if no calls)."""
+        calls = self.completed + self.abandoned
+        if not calls:
+            return None
+        return float(self.abandoned) / calls
+
+    def average_hold_time(self):
+        """Return the average seconds waited by the calls answered."""
+        return self.hold_time / self.completed if self.completed else None
+
+    def average_talk_time(self):
+        """Return the average seconds of talk of the calls answered."""
+        return self.talk_time / self.talked if self.talked else None
+
+    def _update_member(self, member, event):
+        """Update `member` with the headers present in `event`."""
+        was_available = member.available
+        headers = event.headers
+        # `Name` in `QueueMember` events
+        name = event.get_header('MemberName') or event.get_header('Name')
+        if name:
+            member.name = name
+        if 'StateInterface' in headers:
+            member.state_interface = event['StateInterface']
+        if 'Membership' in headers:
+            member.membership = event['Membership']
+        if 'Penalty' in headers:
+            member.penalty = _int(event['Penalty'])
+        if 'CallsTaken' in headers:
+            member.calls_taken = _int(event['CallsTaken'])
+        if 'LastCall' in headers:
+            member.last_call = _int(event['LastCall'])
+        if 'InCall' in headers:
+            member.in_call = event['InCall'] == '1'
+        if 'Status' in headers:
+            member.status = event['Status']
+        if 'Paused' in headers:
+            member.paused = event['Paused'] == '1'
+        if 'PausedReason' in headers or 'Reason' in headers:
+            member.paused_reason = (event.get_header('PausedReason') or
+                                    event.get_header('Reason'))
+        self.available += member.available - was_available
+
+    def _remove_member(self, interface):
+        member = self.members.pop(interface, None)
+        if member is not None and member.available:
+            self.available -= 1
+
+
+# events of lists, without a Queue header
+_LIST_EVENTS = frozenset((
+    'QueueStatusComplete', 'DeviceStateChange', 'DeviceStateListComplete'))
+
+
+def _interface(event):
+    # `Location` in Asterisk < 12, and in `QueueMember` events
+    return event.get_header('Interface') or event.get_header('Location')
+
+
+class QueueState(object):
+
+    """The queues (:class:`Queue`) of an Asterisk, kept up to date.
+
+    See the module documentation.
+
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self._seeding = {}  # ActionID -> threading.Event
+        # ActionID -> device -> state, of the DeviceStateList being received
+        self._device_lists = {}
+        self.handlers = {
+            'QueueParams': self._params,
+            'QueueMember': self._member,
+            'QueueEntry': self._entry,
+            'QueueStatusComplete': self._status_complete,
+            'QueueMemberStatus': self._member,
+            'QueueMemberAdded': self._member,
+            'QueueMemberRemoved': self._member_removed,
+            'QueueMemberPause': self._member,
+            'QueueMemberPaused': self._member,
+            'QueueMemberPenalty': self._member,
+            'QueueCallerJoin': self._join,
+            'Join': self._join,
+            'QueueCallerLeave': self._leave,
+            'Leave': self._leave,
+            'QueueCallerAbandon': self._abandon,
+            'AgentConnect': self._agent_connect,
+            'AgentComplete': self._agent_complete,
+            'DeviceStateChange': self._device_state,
+            'DeviceStateListComplete': self._device_list_complete,
+        }
+
+    def attach(self, manager):
+        """Keep up to date with the events received by `manager`."""
+        for name in self.handlers:
+            manager.register_event(name, self.handle_event)
+
+    def detach(self, manager):
+        for name in self.handlers:
+            manager.unregister_event(name, self.handle_event)
+
+    def seed(self, manager, queue=None, timeout=10):
+        """Load the state of all the queues (or of `queue`) with QueueStatus.
+
+        The state must be attached to `manager` first, and this must not
+        be called from a callback, as the state is loaded from the events
+        received, by the dispatch thread.
+
+        :raises ManagerTimeoutException: if the status is not received in
+            `timeout` seconds
+
+        """
+        action_id = manager.next_action_id()
+        complete = self._seeding[action_id] = threading.Event()
+        cdict = {'Action': 'QueueStatus', 'ActionID': action_id}
+        if queue:
+            cdict['Queue'] = queue
+        try:
+            response = manager.send_action(cdict)
+            if response.get_header('Response') != 'Success':
+                raise ManagerException(response.get_header('Message'))
+            if not complete.wait(timeout):
+                raise ManagerTimeoutException(
+                    'QueueStatus not complete in %s seconds' % timeout)
+        finally:
+            self._seeding.pop(action_id, None)
+
+    def queue(self, name):
+        """Return the queue `name`, creating it if needed."""
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = Queue(name)
+        return queue
+
+    def get_state(self):
+        """Return the queues as plain data (see :mod:`py_star.snapshot`)."""
+        state = []
+        for queue in self.queues.values():
+            attributes = dict(queue.__dict__)
+            attributes['members'] = [dict(member.__dict__)
+                                     for member in queue.members.values()]
+            attributes['callers'] = [dict(caller.__dict__)
+                                     for caller in queue.callers.values()]
+            state.append(attributes)
+        return state
+
+    def set_state(self, state):
+        """Replace the queues by those of :meth:`get_state`."""
+        self.queues.clear()
+        for attributes in state:
+            queue = Queue.__new__(Queue)
+            queue.__dict__.update(attributes)
+            queue.members = {}
+            for member_attributes in attributes['members']:
+                member = Member.__new__(Member)
+                member.__dict__.update(member_attributes)
+                queue.members[member.interface] = member
+            queue.callers = collections.OrderedDict()
+            for caller_attributes in attributes['callers']:
+                caller = Caller.__new__(Caller)
+                caller.__dict__.update(caller_attributes)
+                queue.callers[caller.uniqueid] = caller
+            self.queues[queue.name] = queue
+
+    def reconcile(self, uniqueids):
+        """Remove the callers whose channels are not in `uniqueids`.
+
+        Those that left while the events were not received. The status of
+        the members is refreshed from the device states listed by
+        ``DeviceStateList`` (see :mod:`py_star.snapshot`), members added,
+        removed or paused meanwhile only by their next events or by
+        :meth:`seed`.
+
+        """
+        for queue in self.queues.values():
+            for uniqueid in list(queue.callers):
+                if uniqueid not in uniqueids:
+                    del queue.callers[uniqueid]
+            for position, caller in enumerate(queue.callers.values(), 1):
+                if caller.position is not None:
+                    caller.position = position
+
+    def handle_event(self, event, manager=None):
+        """Update the queues with an event (a manager callback)."""
+        handler = self.handlers.get(event.name)
+        if handler is None:
+            return
+        if event.name not in _LIST_EVENTS and not event.get_header('Queue'):
+            return
+        handler(event, _event_time(event))
+
+    def _params(self, event, now):
+        # the start of the status of a queue: forget what we knew
+        queue = self.queues[event['Queue']] = Queue(event['Queue'])
+        queue.strategy = event.get_header('Strategy')
+        queue.max = _int(event.get_header('Max'))
+        queue.service_level = _int(event.get_header('ServiceLevel'))
+        queue.completed = _int(event.get_header('Completed'))
+        queue.abandoned = _int(event.get_header('Abandoned'))
+        queue.completed_in_service_level = int(round(
+            _float(event.get_header('ServicelevelPerf')) *
+            queue.completed / 100))
+        # Asterisk only reports averages
+        queue.hold_time = _float(event.get_header('Holdtime')) * queue.completed
+        queue.talked = queue.completed
+        queue.talk_time = _float(event.get_header('TalkTime')) * queue.completed
+
+    def _member(self, event, now):
+        queue = self.queue(event['Queue'])
+        interface = _interface(event)
+        if not interface:
+            return
+        member = queue.members.get(interface)
+        if member is None:
+            member = queue.members[interface] = Member(interface)
+        queue._update_member(member, event)
+
+    def _member_removed(self, event, now):
+        self.queue(event['Queue'])._remove_member(_interface(event))
+
+    def _device_state(self, event, now):
+        # live changes of the device states are followed by
+        # QueueMemberStatus events, only those of a list are used
+        action_id = event.get_header('ActionID')
+        if action_id:
+            self._device_lists.setdefault(action_id, {})[
+                event.get_header('Device')] = event.get_header('State')
+
+    def _device_list_complete(self, event, now):
+        # the status of the members follows the state of their devices,
+        # which may have changed while the events were not received
+        states = self._device_lists.pop(event.get_header('ActionID'), {})
+        for queue in self.queues.values():
+            for member in queue.members.values():
+                status = _DEVICE_STATUSES.get(states.get(
+                    member.state_interface or member.interface))
+                if status is not None:
+                    was_available = member.available
+                    member.status = status
+                    queue.available += member.available - was_available
+
+    def _entry(self, event, now):
+        caller = self._add_caller(event, now - _int(event.get_header('Wait')))
+        caller.caller_id_name = event.get_header('CallerIDName')
+
+    def _status_complete(self, event, now):
+        complete = self._seeding.get(event.get_header('ActionID'))
+        if complete is not None:
+            complete.set()
+
+    def _add_caller(self, event, joined):
+        queue = self.queue(event['Queue'])
+        uniqueid = event.get_header('Uniqueid')
+        caller = queue.callers.get(uniqueid)
+        if caller is None:
+            caller = queue.callers[uniqueid] = Caller(
+                uniqueid, event.get_header('Channel'), joined)
+        caller.position = _int(event.get_header('Position'), None)
+        caller.caller_id_num = (event.get_header('CallerIDNum') or
+                                event.get_header('CallerID'))
+        return caller
+
+    def _join(self, event, now):
+        caller = self._add_caller(event, now)
+        caller.caller_id_name = event.get_header('CallerIDName')
+
+    def _leave(self, event, now):
+        queue = self.queue(event['Queue'])
+        caller = queue.callers.pop(event.get_header('Uniqueid'), None)
+        if caller is None or caller.position is None:
+            return
+        # those behind move up
+        for other in queue.callers.values():
+            if other.position is not None and other.position > caller.position:
+                other.position -= 1
+
+    def _abandon(self, event, now):
+        self.queue(event['Queue']).abandoned += 1
+
+    def _agent_connect(self, event, now):
+        queue = self.queue(event['Queue'])
+        hold_time = _int(event.get_header('HoldTime'))
+        queue.completed += 1
+        queue.hold_time += hold_time
+        if queue.service_level and hold_time <= queue.service_level:
+            queue.completed_in_service_level += 1
+
+    def _agent_complete(self, event, now):
+        queue = self.queue(event['Queue'])
+        queue.talked += 1
+        queue.talk_time += _int(event.get_header('TalkTime'))
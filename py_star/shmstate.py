@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Channel table shared by the processes of a host
+
+A :class:`ChannelTableWriter` keeps the channels of an Asterisk, from the
+events received by a :class:`~py_star.manager.Manager`, in a file of fixed
+size records mapped in memory (e.g. in ``/dev/shm``). Any number of local
+processes read it with a :class:`ChannelTableReader`, without talking to
+the writer nor to Asterisk.
+
+   # in the process connected to Asterisk
+   import py_star.shmstate
+
+   table = py_star.shmstate.ChannelTableWriter('/dev/shm/py-star-channels')
+   table.attach(manager)
+
+   # in any other process
+   reader = py_star.shmstate.ChannelTableReader('/dev/shm/py-star-channels')
+   for channel in reader.snapshot():
+       print ("%s %s" % (channel.channel, channel.state))
+
+Records are protected by a sequence lock: the writer makes the sequence
+number of a record odd while changing it, and even again afterwards;
+readers copy a record and check that its sequence number was even and did
+not change meanwhile, or copy it again. Readers never block the writer,
+and do not take any lock. Each record is consistent, while a snapshot of
+the table is not taken atomically as a whole.
+
+Channels that do not fit in the table (of `capacity` records) are left out
+and counted in :attr:`ChannelTableWriter.overflows`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import mmap
+import os
+import struct
+
+from .calls import _event_time
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'PYST'
+_VERSION = 1
+
+# magic, version, capacity, size of a record; padded to 64 bytes
+_HEADER = struct.Struct('<4sIII')
+_HEADER_SIZE = 64
+
+# sequence number, then the fields
+_SEQUENCE = struct.Struct('<Q')
+_FIELDS = struct.Struct('<BB6xd32s32s80s40s40s40s40s40s')
+_RECORD_SIZE = _SEQUENCE.size + _FIELDS.size
+
+# times a reader copies a record being changed before giving up on it
+_RETRIES = 1000
+
+ChannelRecord = collections.namedtuple('ChannelRecord', (
+    'uniqueid', 'linkedid', 'channel', 'state', 'caller_id_num',
+    'caller_id_name', 'connected_line_num', 'context', 'exten', 'created'))
+
+
+def _encode(value, size):
+    # truncated to the size of the field
+    return value.encode('utf-8')[:size]
+
+
+def _decode(value):
+    return value.rstrip(b'\0').decode('utf-8', 'ignore')
+
+
+# position in `_FIELDS` (after `used`) and encoder of the fields
+_FIELD_INDEX = {
+    'state': 0, 'created': 1, 'uniqueid': 2, 'linkedid': 3, 'channel': 4,
+    'caller_id_num': 5, 'caller_id_name': 6, 'connected_line_num': 7,
+    'context': 8, 'exten': 9,
+}
+_FIELD_ENCODERS = {
+    'state': lambda value: int(value) if value.isdigit() else 0,
+    'created': float,
+    'uniqueid': lambda value: _encode(value, 32),
+    'linkedid': lambda value: _encode(value, 32),
+    'channel': lambda value: _encode(value, 80),
+    'caller_id_num': lambda value: _encode(value, 40),
+    'caller_id_name': lambda value: _encode(value, 40),
+    'connected_line_num': lambda value: _encode(value, 40),
+    'context': lambda value: _encode(value, 40),
+    'exten': lambda value: _encode(value, 40),
+}
+
+
+class ChannelTableWriter(object):
+
+    """Writer of the channel table in the file `path`.
+
+    The file is created (replacing any previous one) with room for
+    `capacity` channels.
+    A table must have only one writer.
+
+    """
+
+    def __init__(self, path, capacity=4096):
+        self.path = path
+        self.capacity = capacity
+        self.overflows = 0
+        size = _HEADER_SIZE + capacity * _RECORD_SIZE
+        # replace the file, readers still using the old one notice it
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, capacity, _RECORD_SIZE))
+            f.truncate(size)
+        os.rename(tmp_path, path)
+        with open(path, 'r+b') as f:
+            self._map = mmap.mmap(f.fileno(), size)
+
+        self._slots = {}  # Uniqueid -> slot
+        self._free = list(range(capacity - 1, -1, -1))
+        self._sequences = [0] * capacity
+        self._records = {}  # Uniqueid -> the fields as a list
+        self.handlers = {
+            'Newchannel': self._newchannel,
+            'Newstate': self._newstate,
+            'NewCallerid': self._newstate,
+            'NewConnectedLine': self._newstate,
+            'Newexten': self._newexten,
+            'Rename': self._rename,
+            'Hangup': self._hangup,
+        }
+
+    def attach(self, manager):
+        """Keep the table up to date with the events received by `manager`."""
+        for name in self.handlers:
+            manager.register_event(name, self.handle_event)
+
+    def detach(self, manager):
+        for name in self.handlers:
+            manager.unregister_event(name, self.handle_event)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def handle_event(self, event, manager=None):
+        """Update the table with an event (a manager callback)."""
+        handler = self.handlers.get(event.name)
+        uniqueid = event.get_header('Uniqueid')
+        if handler is not None and uniqueid:
+            handler(uniqueid, event)
+
+    def _write(self, slot, used, fields):
+        """Write the record of `slot` under the sequence lock."""
+        offset = _HEADER_SIZE + slot * _RECORD_SIZE
+        sequence = self._sequences[slot]
+        _SEQUENCE.pack_into(self._map, offset, sequence + 1)
+        _FIELDS.pack_into(self._map, offset + _SEQUENCE.size, used, *fields)
+        _SEQUENCE.pack_into(self._map, offset, sequence + 2)
+        self._sequences[slot] = sequence + 2
+
+    def _update(self, key, **values):
+        """Change the fields given of the record of the channel `key`."""
+        fields = self._records.get(key)
+        if fields is None:
+            return
+        for name, value in values.items():
+            if value is not None:
+                fields[_FIELD_INDEX[name]] = _FIELD_ENCODERS[name](value)
+        self._write(self._slots[key], 1, fields)
+
+    def _newchannel(self, uniqueid, event):
+        if uniqueid in self._slots:
+            return
+        if not self._free:
+            if not self.overflows:
+                logger.warning("The channel table is full (%d channels)" %
+                               self.capacity)
+            self.overflows += 1
+            return
+        self._slots[uniqueid] = self._free.pop()
+        # state, created, then the strings
+        self._records[uniqueid] = [0, _event_time(event)] + [b''] * 8
+        self._update(
+            uniqueid, uniqueid=uniqueid,
+            linkedid=event.get_header('Linkedid'),
+            channel=event.get_header('Channel'),
+            state=event.get_header('ChannelState'),
+            caller_id_num=event.get_header('CallerIDNum'),
+            caller_id_name=event.get_header('CallerIDName'),
+            context=event.get_header('Context'),
+            exten=event.get_header('Exten'))
+
+    def _newstate(self, uniqueid, event):
+        self._update(
+            uniqueid, state=event.get_header('ChannelState'),
+            caller_id_num=event.get_header('CallerIDNum'),
+            caller_id_name=event.get_header('CallerIDName'),
+            connected_line_num=event.get_header('ConnectedLineNum'))
+
+    def _newexten(self, uniqueid, event):
+        self._update(uniqueid, context=event.get_header('Context'),
+                     exten=event.get_header('Extension') or
+                     event.get_header('Exten'))
+
+    def _rename(self, uniqueid, event):
+        self._update(uniqueid, channel=event.get_header('Newname'))
+
+    def _hangup(self, uniqueid, event):
+        slot = self._slots.pop(uniqueid, None)
+        if slot is None:
+            return
+        fields = self._records.pop(uniqueid)
+        self._write(slot, 0, fields)
+        self._free.append(slot)
+
+
+class ChannelTableReader(object):
+
+    """Reader of the channel table in the file `path`.
+
+    The file is mapped when first read, and again when the writer has
+    replaced it. Until the writer has created it the table is empty.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._inode = None
+        self.capacity = 0
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _open(self):
+        """Map the file if not done yet, or if it was replaced."""
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            self.close()
+            return False
+        if self._map is not None and inode == self._inode:
+            return True
+        self.close()
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, record_size = _HEADER.unpack_from(self._map)
+        if (magic, version, record_size) != (_MAGIC, _VERSION, _RECORD_SIZE):
+            self.close()
+            raise ValueError('%s is not a channel table' % self.path)
+        self._inode = inode
+        self.capacity = capacity
+        return True
+
+    def _read(self, slot):
+        """Return the fields of a record, ``None`` if unused."""
+        offset = _HEADER_SIZE + slot * _RECORD_SIZE
+        start = offset + _SEQUENCE.size
+        for attempt in range(_RETRIES):
+            before = _SEQUENCE.unpack_from(self._map, offset)[0]
+            if before & 1:
+                continue
+            data = self._map[start:start + _FIELDS.size]
+            if _SEQUENCE.unpack_from(self._map, offset)[0] == before:
+                break
+        else:
+            logger.warning("Record %d of %s is stuck being written" %
+                           (slot, self.path))
+            return None
+        fields = _FIELDS.unpack(data)
+        if not fields[0]:
+            return None
+        return fields[1:]
+
+    def snapshot(self):
+        """Return the channels, as :class:`ChannelRecord` objects."""
+        if not self._open():
+            return []
+        channels = []
+        for slot in range(self.capacity):
+            fields = self._read(slot)
+            if fields is None:
+                continue
+            state, created = fields[:2]
+            (uniqueid, linkedid, channel, caller_id_num, caller_id_name,
+             connected_line_num, context, exten) = [
+                 _decode(value) for value in fields[2:]]
+            channels.append(ChannelRecord(
+                uniqueid, linkedid, channel, state, caller_id_num,
+                caller_id_name, connected_line_num, context, exten, created))
+        return channels
+
+    def get(self, uniqueid):
+        """Return the channel `uniqueid`, or ``None``."""
+        for channel in self.snapshot():
+            if channel.uniqueid == uniqueid:
+                return channel
+        return None
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Warm start from snapshots of the state
+
+A :class:`Snapshotter` periodically saves the state derived from the
+manager events by components such as :class:`~py_star.calls.CallTracker`,
+:class:`~py_star.topology.ChannelGraph`, :class:`~py_star.queues.QueueState`
+and :class:`~py_star.hints.HintTable` to a file. When the program starts
+again, the state is loaded from the file, and what went away meanwhile is
+dropped after one ``CoreShowChannels`` action: the calls in progress,
+which Asterisk cannot list, are not lost. The state that changes without
+the channels changing, such as the status of the members of the queues
+and of the hints, follows the state of the devices: one
+``DeviceStateList`` action (Asterisk 13 and later) lists them, the
+members are updated from it, and only the hints of the devices that
+changed are asked for again. Nothing is listed in full as when seeding.
+
+Peers are not part of the snapshots: their state (``PeerStatus`` events)
+is not kept by a component, and is loaded with ``Sippeers`` as needed.
+
+   import py_star.snapshot
+
+   snapshotter = py_star.snapshot.Snapshotter(
+       '/var/lib/myapp/state', {'calls': calls, 'queues': queues},
+       interval=60)
+   if snapshotter.load(max_age=300):
+       for component in (calls, queues):
+           component.attach(manager)
+       snapshotter.reconcile(manager)
+   else:
+       for component in (calls, queues):
+           component.attach(manager)
+       queues.seed(manager)
+   snapshotter.attach(manager)
+   ...
+   snapshotter.detach(manager)
+   snapshotter.save()
+
+Components give their state with ``get_state()`` as plain data (dicts,
+lists, tuples, strings and numbers), take it back with ``set_state(state)``
+and may have a ``reconcile(uniqueids)`` method, called with the
+``Uniqueid`` of the channels that exist, to drop what went away while the
+events were not received, and a ``resync(manager, timeout)`` method, to
+load again what may have changed otherwise, called once the device states
+are listed (their ``DeviceStateChange`` events carry the ActionID of the
+list).
+
+Snapshots are taken by the dispatch thread, between two events, so they
+are consistent; they are compressed and written by another thread. They
+are marshalled, and can only be loaded by the same version of Python.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import marshal
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from .manager import ManagerException, ManagerTimeoutException
+
+logger = logging.getLogger(__name__)
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+_MAGIC = b'PYSS'
+_VERSION = 1
+
+# magic, version of the format, version of Python (for marshal)
+_HEADER = struct.Struct('>4sBBB')
+
+
+def _header():
+    return _HEADER.pack(_MAGIC, _VERSION, *sys.version_info[:2])
+
+
+class Snapshotter(object):
+
+    """Save and load the state of `components` to and from the file `path`.
+
+    :param components: dict mapping names to components (see the module
+        documentation)
+    :param interval: seconds between the snapshots taken while attached
+    :param compression: zlib compression level
+
+    """
+
+    def __init__(self, path, components, interval=60, compression=6):
+        self.path = path
+        self.components = components
+        self.interval = interval
+        self.compression = compression
+        self.saved = None  # time of the last snapshot written
+        self._last = _monotonic()
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def attach(self, manager):
+        """Take a snapshot every `interval` seconds of events of `manager`.
+
+        With no events the state does not change, and no snapshot is
+        taken.
+
+        """
+        self._last = _monotonic()
+        manager.register_event('*', self._tick)
+
+    def detach(self, manager):
+        manager.unregister_event('*', self._tick)
+
+    def _tick(self, event, manager):
+        now = _monotonic()
+        if now - self._last < self.interval:
+            return
+        self._last = now
+        if self._writer is not None and self._writer.is_alive():
+            logger.warning("Snapshot still being written, skipping one")
+            return
+        data = self._dumps()
+        self._writer = threading.Thread(target=self._write, args=(data,),
+                                        name='Snapshotter')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def save(self):
+        """Write a snapshot now.
+
+        Unless called from a callback of the manager, the components must
+        not be changing meanwhile (e.g. they are detached).
+
+        """
+        writer = self._writer
+        if writer is not None:
+            writer.join()
+        self._write(self._dumps())
+
+    def _dumps(self):
+        states = {}
+        for name, component in self.components.items():
+            states[name] = component.get_state()
+        return marshal.dumps({'time': time.time(), 'states': states}, 2)
+
+    def _write(self, data):
+        data = _header() + zlib.compress(data, self.compression)
+        with self._lock:
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # readers see the old snapshot or the new one, never a
+                # part of it
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as err:
+                logger.error("Could not write snapshot %s: %s" %
+                             (self.path, err))
+                return
+            self.saved = time.time()
+        logger.debug("Wrote snapshot %s (%d bytes)" % (self.path, len(data)))
+
+    def load(self, max_age=None):
+        """Load the state of the components from the last snapshot.
+
+        Components missing from the snapshot are left as they are.
+
+        :param max_age: seconds beyond which the snapshot is too old to be
+            used
+        :return: the time the snapshot was taken, or ``None`` if there is
+            no snapshot that can be used (the components are then left
+            as they are)
+
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as err:
+            logger.info("No snapshot loaded: %s" % err)
+            return None
+        if data[:_HEADER.size] != _header():
+            logger.warning("%s is not a snapshot of this version of Python" %
+                           self.path)
+            return None
+        try:
+            snapshot = marshal.loads(zlib.decompress(data[_HEADER.size:]))
+        except (zlib.error, ValueError, EOFError, TypeError) as err:
+            logger.warning("Snapshot %s is corrupt: %s" % (self.path, err))
+            return None
+        taken = snapshot['time']
+        if max_age is not None and time.time() - taken > max_age:
+            logger.info("Snapshot %s is too old" % self.path)
+            return None
+        for name, component in self.components.items():
+            if name in snapshot['states']:
+                component.set_state(snapshot['states'][name])
+        return taken
+
+    def reconcile(self, manager, timeout=10, resync=True):
+        """Drop from the components what went away since the snapshot.
+
+        The channels that exist are listed with ``CoreShowChannels``, and
+        the components reconciled by the dispatch thread, so that no event
+        is handled meanwhile. Unless not `resync`, the device states are
+        then listed, and the components resynchronized. The components
+        must be attached to `manager` first, and this must not be called
+        from a callback.
+
+        :raises ManagerTimeoutException: if a list is not received in
+            `timeout` seconds
+        :return: the ``Uniqueid`` of the channels that exist
+
+        """
+        action_id = manager.next_action_id()
+        uniqueids = set()
+        complete = threading.Event()
+
+        def collect(event, manager):
+            if event.name == 'Newchannel':
+                # created after the list was made, but before it arrived
+                uniqueids.add(event.get_header('Uniqueid'))
+            elif event.get_header('ActionID') != action_id:
+                return
+            elif event.name == 'CoreShowChannel':
+                uniqueids.add(event.get_header('Uniqueid') or
+                              event.get_header('UniqueID'))
+            elif not complete.is_set():
+                self._reconcile(uniqueids)
+                complete.set()
+
+        names = ('Newchannel', 'CoreShowChannel', 'CoreShowChannelsComplete')
+        for name in names:
+            manager.register_event(name, collect)
+        try:
+            response = manager.send_action(
+                {'Action': 'CoreShowChannels', 'ActionID': action_id})
+            if response.get_header('Response') != 'Success':
+                raise ManagerException(response.get_header('Message'))
+            if not complete.wait(timeout):
+                raise ManagerTimeoutException(
+                    'CoreShowChannels not complete in %s seconds' % timeout)
+        finally:
+            for name in names:
+                manager.unregister_event(name, collect)
+        if resync:
+            self._list_device_states(manager, timeout)
+            for component in self.components.values():
+                method = getattr(component, 'resync', None)
+                if method is not None:
+                    method(manager, timeout=timeout)
+        return uniqueids
+
+    def _list_device_states(self, manager, timeout):
+        """Send a DeviceStateList, and wait for the attached components to
+        receive it."""
+        action_id = manager.next_action_id()
+        complete = threading.Event()
+
+        def collect(event, manager):
+            if event.get_header('ActionID') == action_id:
+                complete.set()
+
+        manager.register_event('DeviceStateListComplete', collect)
+        try:
+            response = manager.send_action(
+                {'Action': 'DeviceStateList', 'ActionID': action_id})
+            if response.get_header('Response') != 'Success':
+                # Asterisk < 13: what changed is refreshed by the next
+                # events only
+                logger.warning("Device states not listed: %s" %
+                               response.get_header('Message'))
+                return
+            if not complete.wait(timeout):
+                raise ManagerTimeoutException(
+                    'DeviceStateList not complete in %s seconds' % timeout)
+        finally:
+            manager.unregister_event('DeviceStateListComplete', collect)
+
+    def _reconcile(self, uniqueids):
+        for name, component in self.components.items():
+            reconcile = getattr(component, 'reconcile', None)
+            if reconcile is None:
+                continue
+            try:
+                reconcile(uniqueids)
+            except Exception:
+                logger.exception("Exception reconciling %s" % name)
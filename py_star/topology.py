@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Graph of the channels and bridges
+
+A :class:`ChannelGraph` keeps track, from the manager events, of which
+channels are connected to which right now: the bridges and their channels,
+and the two halves of Local channels. It answers queries about transfers,
+conferences and Local channels without sending actions to Asterisk.
+
+   import py_star.topology
+
+   graph = py_star.topology.ChannelGraph()
+   graph.attach(manager)
+
+   # later
+   for uniqueid in graph.call_of(uniqueid):
+       print (graph.channels[uniqueid].name)
+   print (graph.far_end(local_uniqueid))
+
+Bridges are those of Asterisk 12 and later (``BridgeCreate``,
+``BridgeEnter``...), or the pairs of channels of the ``Bridge`` events of
+older versions. Only the channels and bridges created after the graph is
+attached are known. Channels whose ``Hangup`` was lost are forgotten
+`max_age` seconds after they were created, or at :meth:`reconcile`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# type of the bridges made of the two channels of `Bridge` events
+_LINK = 'link'
+
+# time source for measuring intervals (Python 2 has no monotonic clock)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _is_local(name):
+    return bool(name) and name.startswith('Local/')
+
+
+class Channel(object):
+
+    """A node of the graph.
+
+    :attr:`bridges` are the ``BridgeUniqueid`` of the bridges it is in,
+    :attr:`local_peer` is the ``Uniqueid`` of the other half of a Local
+    channel.
+
+    """
+
+    def __init__(self, uniqueid, name, linkedid=None):
+        self.uniqueid = uniqueid
+        self.name = name
+        self.linkedid = linkedid
+        self.bridges = set()
+        self.local_peer = None
+
+    def __repr__(self):
+        return '<Channel %s %s>' % (self.uniqueid, self.name)
+
+
+class Bridge(object):
+
+    """A bridge, with the ``Uniqueid`` of its channels."""
+
+    def __init__(self, uniqueid, bridge_type=None):
+        self.uniqueid = uniqueid
+        self.bridge_type = bridge_type
+        self.channels = set()
+
+    def __repr__(self):
+        return '<Bridge %s>' % self.uniqueid
+
+
+class ChannelGraph(object):
+
+    """Channels (:class:`Channel`) and bridges (:class:`Bridge`) by
+    ``Uniqueid``, kept up to date.
+
+    The graph can be queried from any thread. Channels are removed
+    `max_age` seconds after they were created (``None`` for never), in
+    case their ``Hangup`` event was lost.
+
+    """
+
+    def __init__(self, max_age=86400):
+        self.max_age = max_age
+        self.channels = {}
+        self.bridges = {}
+        self._names = {}  # channel name -> Uniqueid
+        # Uniqueid -> when the channel was created, oldest first
+        self._created = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.handlers = {
+            'Newchannel': self._newchannel,
+            'Rename': self._rename,
+            'Hangup': self._hangup,
+            'BridgeCreate': self._bridge_create,
+            'BridgeEnter': self._bridge_enter,
+            'BridgeLeave': self._bridge_leave,
+            'BridgeDestroy': self._bridge_destroy,
+            'LocalBridge': self._local_bridge,
+            'Bridge': self._bridge,
+        }
+
+    def attach(self, manager):
+        """Keep up to date with the events received by `manager`."""
+        for name in self.handlers:
+            manager.register_event(name, self.handle_event)
+
+    def detach(self, manager):
+        for name in self.handlers:
+            manager.unregister_event(name, self.handle_event)
+
+    def handle_event(self, event, manager=None):
+        """Update the graph with an event (a manager callback)."""
+        handler = self.handlers.get(event.name)
+        if handler is not None:
+            with self._lock:
+                handler(event)
+
+    def get_state(self):
+        """Return the graph as plain data (see :mod:`py_star.snapshot`)."""
+        with self._lock:
+            return {
+                'channels': [(c.uniqueid, c.name, c.linkedid,
+                              list(c.bridges), c.local_peer)
+                             for c in self.channels.values()],
+                'bridges': [(b.uniqueid, b.bridge_type, list(b.channels))
+                            for b in self.bridges.values()],
+            }
+
+    def set_state(self, state):
+        """Replace the graph by that of :meth:`get_state`."""
+        with self._lock:
+            self.channels.clear()
+            self.bridges.clear()
+            self._names.clear()
+            self._created.clear()
+            for uniqueid, name, linkedid, bridges, local_peer in state[
+                    'channels']:
+                channel = self._channel(uniqueid, name)
+                channel.linkedid = linkedid
+                channel.bridges = set(bridges)
+                channel.local_peer = local_peer
+            for uniqueid, bridge_type, channels in state['bridges']:
+                self._bridge_object(uniqueid, bridge_type).channels = set(
+                    channels)
+
+    def reconcile(self, uniqueids):
+        """Remove the channels that are not in `uniqueids`, and the
+        bridges left empty.
+
+        Those that hung up while the events were not received.
+
+        """
+        with self._lock:
+            for uniqueid in list(self.channels):
+                if uniqueid not in uniqueids:
+                    self._remove_channel(uniqueid)
+            for bridge_id, bridge in list(self.bridges.items()):
+                if not bridge.channels:
+                    del self.bridges[bridge_id]
+
+    def uniqueid_of(self, name):
+        """Return the ``Uniqueid`` of the channel called `name`, or None."""
+        return self._names.get(name)
+
+    def peers(self, uniqueid):
+        """Return the ``Uniqueid`` of the channels bridged with `uniqueid`."""
+        with self._lock:
+            channel = self.channels.get(uniqueid)
+            if channel is None:
+                return set()
+            peers = set()
+            for bridge_id in channel.bridges:
+                peers.update(self.bridges[bridge_id].channels)
+            peers.discard(uniqueid)
+            return peers
+
+    def call_of(self, uniqueid):
+        """Return the ``Uniqueid`` of the channels connected to `uniqueid`.
+
+        That is, those reachable through bridges and Local channels, in a
+        transfer or a conference, including `uniqueid` itself.
+
+        """
+        with self._lock:
+            if uniqueid not in self.channels:
+                return set()
+            seen = set([uniqueid])
+            pending = collections.deque([uniqueid])
+            while pending:
+                for other in self._neighbours(pending.popleft()):
+                    if other not in seen:
+                        seen.add(other)
+                        pending.append(other)
+            return seen
+
+    def _neighbours(self, uniqueid):
+        channel = self.channels[uniqueid]
+        for bridge_id in channel.bridges:
+            for other in self.bridges[bridge_id].channels:
+                yield other
+        peer = self._local_peer(channel)
+        if peer is not None:
+            yield peer
+
+    def local_peer(self, uniqueid):
+        """Return the ``Uniqueid`` of the other half of a Local channel."""
+        with self._lock:
+            channel = self.channels.get(uniqueid)
+            return None if channel is None else self._local_peer(channel)
+
+    def _local_peer(self, channel):
+        if channel.local_peer is not None:
+            return channel.local_peer
+        if not _is_local(channel.name):
+            return None
+        # Asterisk did not tell (no LocalBridge event), the halves are
+        # called alike, with ";1" and ";2"
+        base, sep, half = channel.name.rpartition(';')
+        other = {'1': '2', '2': '1'}.get(half)
+        if other is None:
+            return None
+        return self._names.get(base + sep + other)
+
+    def far_end(self, uniqueid):
+        """Return the ``Uniqueid`` of the channels at the far end of a
+        Local channel.
+
+        Those bridged with its other half, or, if they are Local channels
+        too, at their far end, and so on.
+
+        """
+        with self._lock:
+            channel = self.channels.get(uniqueid)
+            if channel is None:
+                return set()
+            seen = set([uniqueid])
+            result = set()
+            pending = collections.deque([channel])
+            while pending:
+                peer = self._local_peer(pending.popleft())
+                if peer is None or peer in seen:
+                    continue
+                seen.add(peer)
+                for bridge_id in self.channels[peer].bridges:
+                    for other in self.bridges[bridge_id].channels - seen:
+                        seen.add(other)
+                        other_channel = self.channels[other]
+                        if _is_local(other_channel.name):
+                            pending.append(other_channel)
+                        else:
+                            result.add(other)
+            return result
+
+    def _channel(self, uniqueid, name=None):
+        """Return the channel `uniqueid`, creating it if needed."""
+        channel = self.channels.get(uniqueid)
+        if channel is None:
+            channel = self.channels[uniqueid] = Channel(uniqueid, name)
+            self._created[uniqueid] = _monotonic()
+            if name:
+                self._names[name] = uniqueid
+        return channel
+
+    def _bridge_object(self, bridge_id, bridge_type=None):
+        bridge = self.bridges.get(bridge_id)
+        if bridge is None:
+            bridge = self.bridges[bridge_id] = Bridge(bridge_id, bridge_type)
+        return bridge
+
+    def _expire(self):
+        """Remove the channels older than :attr:`max_age`."""
+        if self.max_age is None:
+            return
+        since = _monotonic() - self.max_age
+        while self._created:
+            uniqueid, created = next(iter(self._created.items()))
+            if created >= since:
+                break
+            logger.warning('channel %s lost, removed', uniqueid)
+            self._remove_channel(uniqueid)
+
+    def _newchannel(self, event):
+        self._expire()
+        uniqueid = event.get_header('Uniqueid')
+        if uniqueid:
+            channel = self._channel(uniqueid, event.get_header('Channel'))
+            channel.linkedid = event.get_header('Linkedid')
+
+    def _rename(self, event):
+        uniqueid = event.get_header('Uniqueid')
+        channel = self.channels.get(uniqueid)
+        if channel is None or not event.get_header('Newname'):
+            return
+        if self._names.get(channel.name) == uniqueid:
+            del self._names[channel.name]
+        channel.name = event.get_header('Newname')
+        self._names[channel.name] = uniqueid
+
+    def _hangup(self, event):
+        self._remove_channel(event.get_header('Uniqueid'))
+
+    def _remove_channel(self, uniqueid):
+        channel = self.channels.pop(uniqueid, None)
+        if channel is None:
+            return
+        del self._created[uniqueid]
+        if self._names.get(channel.name) == channel.uniqueid:
+            del self._names[channel.name]
+        for bridge_id in channel.bridges:
+            bridge = self.bridges[bridge_id]
+            bridge.channels.discard(channel.uniqueid)
+            if not bridge.channels and bridge.bridge_type == _LINK:
+                # no Unlink event will come
+                del self.bridges[bridge_id]
+        peer = self.channels.get(channel.local_peer)
+        if peer is not None:
+            peer.local_peer = None
+
+    def _bridge_create(self, event):
+        bridge_id = event.get_header('BridgeUniqueid')
+        if bridge_id:
+            self._bridge_object(bridge_id, event.get_header('BridgeType'))
+
+    def _enter(self, bridge_id, uniqueid, name=None, bridge_type=None):
+        channel = self._channel(uniqueid, name)
+        channel.bridges.add(bridge_id)
+        self._bridge_object(bridge_id, bridge_type).channels.add(uniqueid)
+
+    def _leave(self, bridge_id, uniqueid):
+        channel = self.channels.get(uniqueid)
+        if channel is not None:
+            channel.bridges.discard(bridge_id)
+        bridge = self.bridges.get(bridge_id)
+        if bridge is not None:
+            bridge.channels.discard(uniqueid)
+
+    def _destroy(self, bridge_id):
+        bridge = self.bridges.pop(bridge_id, None)
+        if bridge is None:
+            return
+        for uniqueid in bridge.channels:
+            channel = self.channels.get(uniqueid)
+            if channel is not None:
+                channel.bridges.discard(bridge_id)
+
+    def _bridge_enter(self, event):
+        bridge_id = event.get_header('BridgeUniqueid')
+        uniqueid = event.get_header('Uniqueid')
+        if bridge_id and uniqueid:
+            self._enter(bridge_id, uniqueid, event.get_header('Channel'))
+
+    def _bridge_leave(self, event):
+        bridge_id = event.get_header('BridgeUniqueid')
+        uniqueid = event.get_header('Uniqueid')
+        if bridge_id and uniqueid:
+            self._leave(bridge_id, uniqueid)
+
+    def _bridge_destroy(self, event):
+        bridge_id = event.get_header('BridgeUniqueid')
+        if bridge_id:
+            self._destroy(bridge_id)
+
+    def _local_bridge(self, event):
+        # LocalOne/LocalTwo in Asterisk 12 and later
+        one = (event.get_header('LocalOneUniqueid') or
+               event.get_header('Uniqueid1'))
+        two = (event.get_header('LocalTwoUniqueid') or
+               event.get_header('Uniqueid2'))
+        if not one or not two:
+            return
+        self._channel(one, event.get_header('LocalOneChannel') or
+                      event.get_header('Channel1')).local_peer = two
+        self._channel(two, event.get_header('LocalTwoChannel') or
+                      event.get_header('Channel2')).local_peer = one
+
+    def _bridge(self, event):
+        # Asterisk < 12: two channels linked or unlinked
+        one = event.get_header('Uniqueid1')
+        two = event.get_header('Uniqueid2')
+        if not one or not two:
+            return
+        bridge_id = '%s+%s' % (one, two)
+        if event.get_header('Bridgestate') == 'Unlink':
+            self._destroy(bridge_id)
+        else:
+            self._enter(bridge_id, one, event.get_header('Channel1'), _LINK)
+            self._enter(bridge_id, two, event.get_header('Channel2'), _LINK)
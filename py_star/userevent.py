@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# vim: set expandtab shiftwidth=4:
+"""
+Publish and subscribe with user events
+
+A :class:`UserEventBus` sends ``UserEvent`` actions, which Asterisk sends
+back as ``UserEvent`` events to all the manager clients (and which the
+dialplan sends with the ``UserEvent`` application), to signal between
+services connected to the same Asterisk.
+
+   import py_star.userevent
+
+   def handle_routed(name, values, event):
+      print ("call %(uniqueid)s routed to %(queue)s" % values)
+
+   bus = py_star.userevent.UserEventBus(manager)
+   bus.define('CallRouted', uniqueid=str, queue=str, priority=int)
+   bus.subscribe('CallRouted', handle_routed)
+
+   bus.publish('CallRouted', uniqueid='1500000000.1', queue='sales',
+               priority=2)
+   ...
+   bus.close()
+
+Events defined with their headers and types are sent with precompiled
+actions (see :class:`~py_star.manager.ActionTemplate`), and their values
+are converted back to those types for subscribers; the values of other
+events are strings. Publishes are queued and sent together, in one write,
+every `max_latency` seconds or `batch_size` events. Subscribers are
+indexed by name, and called by the dispatch thread of the manager.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import logging
+import threading
+
+from .manager import ActionTemplate
+
+logger = logging.getLogger(__name__)
+
+# headers of the events that are not values
+_EVENT_HEADERS = frozenset(['Event', 'UserEvent', 'Privilege', 'Timestamp',
+                            'SequenceNumber', 'File', 'Line', 'Func'])
+
+
+def _encode(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return '%s' % value
+
+
+def _decode_bool(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+_DECODERS = {bool: _decode_bool}
+
+
+class UserEventType(object):
+
+    """A user event, with the names and types of its values.
+
+    Types are those that can be built from a string (``str``, ``int``,
+    ``float``...) or ``bool``.
+
+    """
+
+    def __init__(self, name, types):
+        self.name = name
+        self.types = dict(types)
+        self.fields = tuple(sorted(self.types))
+        self.template = ActionTemplate('UserEvent',
+                                       ('UserEvent',) + self.fields)
+        self._decoders = dict((field, _DECODERS.get(type_, type_))
+                              for field, type_ in self.types.items())
+
+    def __repr__(self):
+        return '<UserEventType %s>' % self.name
+
+    def encode(self, values):
+        """Return the values of the action, in the order of the template.
+
+        :raises ValueError: if values are missing or unknown
+
+        """
+        if set(values) != set(self.fields):
+            raise ValueError('%s takes the values %s, not %s' % (
+                self.name, ', '.join(self.fields), ', '.join(sorted(values))))
+        return (self.name,) + tuple(_encode(values[field])
+                                    for field in self.fields)
+
+    def decode(self, event):
+        """Return the values of an event, converted to their types."""
+        values = {}
+        for field, decode in self._decoders.items():
+            value = event.get_header(field)
+            if value is None:
+                continue
+            try:
+                values[field] = decode(value)
+            except ValueError:
+                logger.warning("Invalid %s of %s: %r" %
+                               (field, self.name, value))
+                values[field] = value
+        return values
+
+
+class UserEventBus(object):
+
+    """Publish and subscribe to user events through `manager`.
+
+    :param batch_size: events queued from which they are sent right away
+    :param max_latency: seconds events are queued at most
+
+    See the module documentation.
+
+    """
+
+    def __init__(self, manager, batch_size=100, max_latency=0.01):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.types = {}  # name -> UserEventType
+        self._templates = {}  # fields -> template, of undefined events
+        self._subscribers = {}  # name -> tuple of functions
+        self._lock = threading.Lock()
+        self._queued = []  # actions, as (template, values)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='UserEventBus')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        manager.register_event('UserEvent', self._dispatch)
+
+    def define(self, name, **types):
+        """Define the user event `name`, with the types of its values.
+
+        :return: the :class:`UserEventType`
+
+        """
+        user_event = self.types[name] = UserEventType(name, types)
+        return user_event
+
+    def publish(self, name, **values):
+        """Queue the user event `name` to be sent, with `values`.
+
+        :raises ValueError: if the values do not match the definition of
+            the event
+
+        """
+        user_event = self.types.get(name)
+        if user_event is None:
+            fields = tuple(sorted(values))
+            template = self._templates.get(fields)
+            if template is None:
+                template = self._templates[fields] = ActionTemplate(
+                    'UserEvent', ('UserEvent',) + fields)
+            action = (template, (name,) + tuple(_encode(values[field])
+                                                for field in fields))
+        else:
+            action = (user_event.template, user_event.encode(values))
+        with self._condition:
+            if self._closed:
+                raise ValueError('Bus closed')
+            self._queued.append(action)
+            if len(self._queued) == 1 or len(
+                    self._queued) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self):
+        """Send the events queued now."""
+        with self._condition:
+            actions, self._queued = self._queued, []
+        if not actions:
+            return
+        try:
+            futures = self.manager.send_actions(actions)
+        except Exception:
+            logger.exception("Could not publish %d user events" %
+                             len(actions))
+            return
+        for future in futures:
+            future.add_done_callback(self._check_response)
+
+    def _check_response(self, future):
+        exception = future.exception()
+        if exception is not None:
+            logger.error("Could not publish a user event: %s" % exception)
+        elif future.result().get_header('Response') != 'Success':
+            logger.error("Could not publish a user event: %s" %
+                         future.result().get_header('Message'))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queued and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._queued:
+                    return
+                if len(self._queued) < self.batch_size and not self._closed:
+                    # wait for more, a little
+                    self._condition.wait(self.max_latency)
+            self.flush()
+
+    def close(self):
+        """Send the events queued, and stop publishing and dispatching."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self.manager.unregister_event('UserEvent', self._dispatch)
+        self._thread.join()
+
+    def subscribe(self, name, function):
+        """Call ``function(name, values, event)`` for the user events
+        `name`.
+
+        `values` is a dict of the headers of the event, converted to their
+        types if the event is defined (see :meth:`define`).
+
+        """
+        with self._lock:
+            self._subscribers[name] = self._subscribers.get(name, ()) + (
+                function,)
+
+    def unsubscribe(self, name, function):
+        with self._lock:
+            functions = tuple(f for f in self._subscribers.get(name, ())
+                              if f != function)
+            if functions:
+                self._subscribers[name] = functions
+            else:
+                self._subscribers.pop(name, None)
+
+    def _dispatch(self, event, manager):
+        name = event.get_header('UserEvent')
+        # the tuples of subscribers are replaced, never changed
+        functions = self._subscribers.get(name)
+        if not functions:
+            return
+        user_event = self.types.get(name)
+        if user_event is None:
+            values = dict((header, value)
+                          for header, value in event.headers.items()
+                          if header not in _EVENT_HEADERS)
+        else:
+            values = user_event.decode(event)
+        for function in functions:
+            try:
+                function(name, values, event)
+            except Exception:
+                logger.exception("Exception in callback for %s" % name)
@@ -1,12 +1,19 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import logging
 import sys
 import socket
+import threading
+import time
 import unittest
 
 from py_star import compat_six as six
 from six.moves import queue
-from py_star.manager import Manager
+from py_star.manager import ActionTemplate, Manager, ManagerException
+from py_star.manager import ManagerMessage
+from py_star.manager import ManagerSocketException, ManagerTimeoutException
+from py_star.manager import HIGH, NORMAL, LOW
+from py_star.manager import _event_from_text
 from py_star.astemu import Event, AsteriskEmu
 
 class Test_Manager(unittest.TestCase):
@@ -19,10 +26,12 @@ class Test_Manager(unittest.TestCase):
         if self.manager:
             self.manager.close()
             self.manager = None
-        self.astemu.close()
+        if self.astemu:
+            self.astemu.close()
 
     def setUp(self):
         self.manager  = None
+        self.astemu   = None
         self.childpid = None
         self.events   = []
         self.evcount  = 0
@@ -61,6 +70,15 @@ class Test_Manager(unittest.TestCase):
         self.close()
         self.assertEqual(self.events, [])
 
+    def test_unexpected_response(self):
+        self.run_manager({})
+        # e.g. the late response to an action given up on
+        self.manager._response_received(ManagerMessage(
+            ['Response: Success\r\n', 'ActionID: nobody\r\n']))
+        self.assertTrue(self.manager._response_queue.empty())
+        r = self.manager.login('account', 'geheim')
+        self.compare_result(r, self.default_events['Login'][0])
+
     def test_command(self):
         d = dict
         events = dict \
@@ -530,6 +548,452 @@ lcr/556              s@attendoparse:9     Up Read(dtmf,,30,noanswer,,2)
             n = self.queue.get()
             self.compare_result(self.events[n], events['Login'][n+1])
 
+    def test_coalesce(self):
+        events = dict \
+            ( MailboxCount =
+                ( Event
+                    ( Response    = ('Success',)
+                    , Message     = ('Mailbox Message Count',)
+                    , Mailbox     = ('100@default',)
+                    , NewMessages = ('2',)
+                    , OldMessages = ('5',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        sent = []
+        release = threading.Event()
+        send_action = self.manager._send_action
+        def slow_send_action(cdict):
+            sent.append(cdict)
+            release.wait()
+            return send_action(cdict)
+        self.manager._send_action = slow_send_action
+
+        responses = []
+        def count():
+            responses.append(self.manager.mailbox_count('100@default'))
+        threads = [threading.Thread(target=count) for k in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(responses), 5)
+        for r in responses:
+            self.assertTrue(r is responses[0])
+        self.compare_result(r, events['MailboxCount'][0])
+
+    def test_cache(self):
+        events = dict \
+            ( ExtensionState =
+                ( Event
+                    ( Response = ('Success',)
+                    , Message  = ('Extension Status',)
+                    , Exten    = ('100',)
+                    , Context  = ('default',)
+                    , Hint     = ('SIP/100',)
+                    , Status   = ('0',)
+                    )
+                ,
+                )
+            , Ping =
+                ( Event
+                    ( Response = ('Success',)
+                    , Ping     = ('Pong',)
+                    )
+                , Event
+                    ( Event     = ('ExtensionStatus',)
+                    , Privilege = ('call,all',)
+                    , Exten     = ('100',)
+                    , Context   = ('default',)
+                    , Hint      = ('SIP/100',)
+                    , Status    = ('1',)
+                    )
+                )
+            )
+        self.run_manager(events)
+        sent = []
+        send_action = self.manager._send_action
+        def count_send_action(cdict):
+            sent.append(cdict['Action'])
+            return send_action(cdict)
+        self.manager._send_action = count_send_action
+        self.manager.enable_cache()
+
+        r = self.manager.extension_state('100', 'default')
+        self.compare_result(r, events['ExtensionState'][0])
+        self.assertTrue(self.manager.extension_state('100', 'default') is r)
+        self.manager.extension_state('101', 'default')
+        self.assertEqual(sent, ['ExtensionState', 'ExtensionState'])
+
+        # the state of the extension changes
+        self.manager.ping()
+        self.queue.get(timeout=5)
+        self.assertFalse(self.manager.extension_state('100', 'default') is r)
+        self.assertEqual(sent[-2:], ['Ping', 'ExtensionState'])
+        self.assertEqual(self.manager.cache_info()['hits'], 1)
+
+    def test_cache_error(self):
+        events = dict \
+            ( ExtensionState =
+                ( Event
+                    ( Response = ('Error',)
+                    , Message  = ('Extension not found',)
+                    )
+                ,
+                )
+            )
+        self.run_manager(events)
+        self.manager.enable_cache()
+        for n in range(2):
+            r = self.manager.extension_state('100', 'default')
+            self.assertEqual(r.get_header('Response'), 'Error')
+        # errors are not cached, nor left pending
+        info = self.manager.cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']),
+                         (0, 2, 0))
+        self.assertEqual(self.manager._cache._pending, {})
+
+    def test_wait_for_event(self):
+        events = dict \
+            ( Hangup =
+                ( Event
+                    ( Response = ('Success',)
+                    , Message  = ('Channel Hungup',)
+                    )
+                , Event
+                    ({ 'Event'     : ('Hangup',)
+                     , 'Privilege' : ('call,all',)
+                     , 'Channel'   : ('lcr/558',)
+                     , 'Uniqueid'  : ('1332366541.559',)
+                     , 'Cause'     : ('16',)
+                     , 'Cause-txt' : ('Normal Clearing',)
+                    })
+                )
+            )
+        self.run_manager(events)
+        waiter = self.manager.wait_for_event \
+            ('Hangup', 5, Uniqueid='1332366541.559', Cause='16')
+        other = self.manager.wait_for_event \
+            ('Hangup', 0.2, Uniqueid='1332366541.560')
+        self.manager.hangup('lcr/558')
+        self.compare_result(waiter.result(), events['Hangup'][1])
+        self.assertRaises(ManagerTimeoutException, other.result)
+        self.assertEqual(self.manager._waiters, {})
+        self.assertEqual(self.manager._waiter_headers, {})
+
+    def test_batch(self):
+        varset = lambda value: Event \
+            ( Event     = ('VarSet',)
+            , Privilege = ('dialplan,all',)
+            , Channel   = ('Local/102@from-queue-a8ca;2',)
+            , Variable  = ('ITER',)
+            , Value     = (value,)
+            )
+        events = dict \
+            ( Ping =
+                ( Event
+                    ( Response = ('Success',)
+                    , Ping     = ('Pong',)
+                    )
+                , varset('1')
+                , varset('2')
+                , varset('3')
+                , varset('4')
+                )
+            )
+        self.run_manager(events)
+        batches = queue.Queue()
+        def batch_handler(events, manager):
+            batches.put([e['Value'] for e in events])
+        self.manager.register_batch \
+            ('VarSet', batch_handler, max_size=3, max_latency=0.2)
+        self.manager.ping()
+        self.assertEqual(batches.get(timeout=5), ['1', '2', '3'])
+        start = time.time()
+        self.assertEqual(batches.get(timeout=5), ['4'])
+        self.assertTrue(time.time() - start < 1)
+        # events are still dispatched one by one
+        self.assertEqual(len(self.events), 4)
+
+    def test_separate_events(self):
+        events = dict \
+            ( Login =
+                ( Event
+                    ( Response = ('Success',)
+                    , Message  = ('Authentication accepted',)
+                    )
+                , Event
+                    ( Event     = ('FullyBooted',)
+                    , Privilege = ('system,all',)
+                    , Status    = ('Fully Booted',)
+                    )
+                )
+            )
+        self.astemu = AsteriskEmu (events)
+        self.port = self.astemu.port
+        self.manager = Manager()
+        self.manager.connect \
+            ('localhost', port = self.port, separate_events = True)
+        self.manager.register_event ('*', self.handler)
+        self.manager.login('account', 'geheim')
+        event_connection = self.manager._event_connection
+        self.close()
+        self.assertFalse(event_connection.is_running())
+        # the event is received once, by the event connection
+        self.assertEqual([e.name for e in self.events], ['FullyBooted'])
+
+    def test_event_connection_lost(self):
+        self.astemu = AsteriskEmu (dict())
+        self.manager = Manager()
+        self.manager.connect \
+            ('localhost', port = self.astemu.port, separate_events = True)
+        self.manager.login('account', 'geheim')
+        waiter = self.manager.wait_for_event('Hangup', 5)
+        # the event connection drops
+        event_connection = self.manager._event_connection
+        event_connection._sock._sock.shutdown(socket.SHUT_RDWR)
+        self.assertRaises(ManagerSocketException, waiter.result, 5)
+        # and so does the connection of the manager
+        self.manager.message_thread.join(5)
+        self.assertFalse(self.manager.is_connected())
+        self.assertRaises(ManagerException, self.manager.ping)
+        errors = []
+        while not self.manager.errors_in_threads.empty():
+            errors.append(self.manager.errors_in_threads.get())
+        self.assertTrue("Event connection lost" in errors)
+
+    def test_shedding(self):
+        # no connection needed, events are handed to the manager
+        manager = Manager()
+        manager.enable_shedding(soft_limit=2, hard_limit=6, sample=2)
+        def event(name, **headers):
+            text = 'Event: %s\r\n' % name
+            for k, v in headers.items():
+                text += '%s: %s\r\n' % (k, v)
+            manager._event_received(_event_from_text(text))
+        for n in range(4):
+            event('VarSet')
+        # over the soft limit one in two LOW events is kept
+        self.assertEqual(manager._event_queue.qsize(), 3)
+        for n in range(3):
+            event('Newstate')
+        # over the hard limit only HIGH events are kept, and those listing
+        # the results of an action
+        event('VarSet')
+        event('Newstate')
+        event('Hangup')
+        event('QueueMember', ActionID='1')
+        self.assertEqual(manager._event_queue.qsize(), 8)
+        self.assertEqual(manager.shedding_info(),
+            {'level': 2, 'shed': {'VarSet': 2, 'Newstate': 1}, 'total': 3})
+        manager.disable_shedding()
+        event('VarSet')
+        self.assertEqual(manager._event_queue.qsize(), 9)
+        self.assertEqual(manager.shedding_info(), None)
+
+    def test_window(self):
+        manager = Manager()
+        manager.enable_window(initial=2, max_size=4, tolerance=2.0)
+        window = manager._window
+        first = window.acquire()
+        second = window.acquire()
+        # interactive actions do not wait
+        third = window.acquire(wait=False)
+        self.assertEqual(manager.window_info()['inflight'], 3)
+        # the window grows while used and the latency stays low
+        for token in (first, second, third):
+            window.release(token, 0.01)
+        self.assertTrue(window.size > 2)
+        self.assertEqual(manager.window_info()['base_latency'], 0.01)
+        # and is halved once when actions get late
+        first = window.acquire()
+        second = window.acquire()
+        window.release(first, 0.1)
+        window.release(second, 0.1)
+        info = manager.window_info()
+        self.assertEqual((info['size'], info['decreases']), (1, 1))
+        # those beyond the window wait for a place
+        first = window.acquire()
+        acquired = []
+        t = threading.Thread(target=lambda: acquired.append(window.acquire()))
+        t.start()
+        t.join(0.1)
+        self.assertEqual(acquired, [])
+        window.release(first, 0.01)
+        t.join(1)
+        self.assertEqual(len(acquired), 1)
+        # or for the window to be disabled
+        t = threading.Thread(target=lambda: acquired.append(window.acquire()))
+        t.start()
+        manager.disable_window()
+        t.join(1)
+        self.assertEqual(len(acquired), 2)
+        self.assertEqual(manager.window_info(), None)
+
+    def test_window_recovers(self):
+        manager = Manager()
+        manager.enable_window(initial=4, min_size=1, max_size=4,
+                              tolerance=2.0)
+        window = manager._window
+        window.release(window.acquire(), 0.01)
+        # shrinks down to the minimum
+        for n in range(3):
+            window.release(window.acquire(), 0.1)
+        self.assertEqual(window.size, 1.0)
+        self.assertEqual(manager.window_info()['decreases'], 3)
+        # and grows back while used and the latency is low again
+        for n in range(10):
+            tokens = [window.acquire() for i in range(int(window.size))]
+            for token in tokens:
+                window.release(token, 0.01)
+        self.assertEqual(window.size, 4.0)
+        manager.disable_window()
+
+    def test_scheduler(self):
+        chatscript = dict(
+            Status=(Event(Response=('Success',), Message=('status',)),),
+            Hangup=(Event(Response=('Success',), Message=('hangup',)),),
+            Sippeers=(Event(Response=('Success',),
+                            Message=('Peer status list will follow',)),),
+        )
+        self.run_manager(chatscript)
+        self.manager.enable_scheduler(rates={LOW: (5, 1)})
+        done = []
+        futures = []
+        for action in ('Status', 'Status', 'Status', 'Hangup'):
+            future = self.manager.send_action_async({'Action': action})
+            future.add_done_callback(
+                lambda future: done.append(future.result()['Message']))
+            futures.append(future)
+            if len(futures) == 1:
+                # the burst of the status requests is used up
+                future.result(5)
+        for future in futures:
+            future.result(5)
+        # the hangup jumps ahead of the status requests held back
+        self.assertEqual(done, ['status', 'hangup', 'status', 'status'])
+        self.assertEqual(self.manager.scheduler_info(),
+            {'queued': {HIGH: 0, NORMAL: 0, LOW: 0},
+             'sent': {HIGH: 1, LOW: 3}})
+        # whatever the case of the action names
+        self.assertEqual(self.manager.sippeers()['Response'], 'Success')
+        self.assertEqual(self.manager.scheduler_info()['sent'],
+                         {HIGH: 1, LOW: 4})
+        self.manager.disable_scheduler()
+        self.assertEqual(self.manager.scheduler_info(), None)
+        r = self.manager.send_action({'Action': 'Hangup'})
+        self.assertEqual(r['Message'], 'hangup')
+
+    def test_send_actions(self):
+        originate = ActionTemplate('Originate', ['Channel', 'Exten'])
+        self.assertEqual(originate.render('1', ('SIP/100', '200')),
+            b'Action: Originate\r\nChannel: SIP/100\r\nExten: 200\r\n'
+            b'ActionID: 1\r\n\r\n')
+        self.assertRaises(ValueError, originate.render, '1', ('SIP/100',))
+        chatscript = dict(
+            Originate=(Event(Response=('Success',),
+                             Message=('Originate successfully queued',)),),
+        )
+        self.run_manager(chatscript)
+        futures = self.manager.send_actions(
+            [(originate, ('SIP/%d' % n, '200')) for n in range(10)] +
+            [{'Action': 'Login', 'Username': 'account', 'Secret': 'geheim'}])
+        responses = [future.result(5) for future in futures]
+        self.assertEqual(len(set(r['ActionID'] for r in responses)), 11)
+        self.assertEqual(responses[0]['Message'],
+                         'Originate successfully queued')
+        self.assertEqual(responses[-1]['Message'], 'Authentication accepted')
+        r = self.manager.send_template_async(originate, 'SIP/100', '200')
+        self.assertEqual(r.result(5)['Response'], 'Success')
+
+    def test_vars(self):
+        chatscript = dict(
+            Getvar=(Event(Response=('Success',), Variable=('COLOR',),
+                          Value=('blue',)),),
+            Setvar=(Event(Response=('Error',),
+                          Message=('No such channel',)),),
+        )
+        self.run_manager(chatscript)
+        self.assertEqual(
+            self.manager.get_vars('SIP/100-1', ['COLOR', 'SHADE'],
+                                  timeout=5),
+            {'COLOR': 'blue', 'SHADE': 'blue'})
+        self.assertRaises(ManagerException, self.manager.set_vars,
+                          'SIP/100-1', {'COLOR': 'red', 'SHADE': 'dark'}, 5)
+
+    def test_lag_stats(self):
+        chatscript = dict(
+            Status=(
+                Event(Response=('Success',),
+                      Message=('Channel status will follow',)),
+                Event(Event=('StatusComplete',), Items=('0',),
+                      Timestamp=('%.6f' % (time.time() - 1),),
+                      ActionID=('',)),
+            )
+        )
+        self.run_manager(chatscript)
+        self.assertEqual(self.manager.lag_stats(), None)
+        self.manager.enable_lag_stats()
+        self.manager.status()
+        self.queue.get(timeout=5)
+        # the callbacks are measured once they have all returned
+        time.sleep(0.1)
+        stats = self.manager.lag_stats()
+        self.assertEqual(sorted(stats),
+                         ['asterisk', 'callback', 'dispatch', 'parse'])
+        for stage in stats:
+            self.assertEqual(stats[stage]['count'], 1)
+        self.assertTrue(0.9 < stats['asterisk']['mean'] < 5)
+        self.assertEqual(stats['asterisk']['p50'], stats['asterisk']['max'])
+        self.assertTrue(stats['parse']['max'] < 1)
+        self.manager.disable_lag_stats()
+        self.assertEqual(self.manager.lag_stats(), None)
+
+    def test_profiling(self):
+        self.run_manager({})
+        warnings = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+        handler = Handler(logging.WARNING)
+        logger = logging.getLogger('py_star.manager')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        # whatever the level of the root logger (see run_tests.py)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.WARNING)
+        def slow_callback(event, manager):
+            time.sleep(0.3)
+        self.manager.register_event('Slow', slow_callback)
+        self.manager.enable_profiling(budget=0.1, profile=True)
+        for name in ('Slow', 'Fast', 'Fast'):
+            self.manager._event_received(
+                _event_from_text('Event: %s\r\n' % name))
+        for n in range(3):
+            self.queue.get(timeout=5)
+        time.sleep(0.1)
+        info = self.manager.profiling_info()
+        self.assertEqual(info['slow'], 1)
+        slowest = info['callbacks'][0]
+        self.assertEqual((slowest['event'], slowest['calls']), ('Slow', 1))
+        self.assertTrue(slowest['callback'].endswith('slow_callback'))
+        self.assertTrue(slowest['total'] >= 0.3)
+        self.assertEqual(
+            sorted((c['event'], c['calls']) for c in info['callbacks']),
+            [('Fast', 2), ('Slow', 1), ('Slow', 1)])
+        # the stack shows where the callback is stuck
+        self.assertTrue(any('slow_callback' in w and 'time.sleep' in w
+                            for w in warnings))
+        self.assertTrue(self.manager.profile_stats().total_calls > 0)
+        self.manager.disable_profiling()
+        self.assertEqual(self.manager.profiling_info(), None)
+        self.assertEqual(self.manager.profile_stats(), None)
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest (unittest.makeSuite (Test_Manager))
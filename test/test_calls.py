@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from py_star.calls import CallTracker
+from py_star.manager import _event_from_text
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_CallTracker(unittest.TestCase):
+    """ Test the correlation of events into calls.
+    """
+
+    def setUp(self):
+        self.tracker = CallTracker(max_calls=2, max_age=3600)
+        self.complete = []
+        self.evicted = []
+        self.tracker.register_complete(
+            lambda call, tracker: self.complete.append(call))
+        self.tracker.register_evicted(
+            lambda call, tracker: self.evicted.append(call))
+
+    def send(self, name, timestamp, **headers):
+        headers['Timestamp'] = '%.1f' % timestamp
+        self.tracker.handle_event(event(name, **headers))
+
+    def call(self, linkedid, start, answer=True):
+        caller = linkedid
+        callee = linkedid + '.1'
+        self.send('Newchannel', start, Uniqueid=caller, Linkedid=linkedid,
+                  Channel='SIP/100-1', ChannelState='4', Exten='200')
+        self.send('Newchannel', start + 1, Uniqueid=callee,
+                  Linkedid=linkedid, Channel='SIP/200-2', ChannelState='0')
+        self.send('DialBegin', start + 1, Uniqueid=caller,
+                  DestUniqueid=callee, DestChannel='SIP/200-2')
+        self.send('Newstate', start + 3, Uniqueid=callee, ChannelState='5')
+        if answer:
+            self.send('Newstate', start + 10, Uniqueid=callee,
+                      ChannelState='6')
+            self.send('DialEnd', start + 10, Uniqueid=caller,
+                      DestUniqueid=callee, DialStatus='ANSWER')
+        else:
+            self.send('DialEnd', start + 10, Uniqueid=caller,
+                      DestUniqueid=callee, DialStatus='BUSY')
+        return caller, callee
+
+    def test_calls(self):
+        caller, callee = self.call('1000.1', 1000)
+        self.send('Hangup', 1070, Uniqueid=callee, Cause='16')
+        self.assertEqual(self.complete, [])
+        self.assertEqual(self.tracker.call_of(caller).linkedid, '1000.1')
+        self.send('Hangup', 1070, Uniqueid=caller, Cause='16')
+
+        call = self.complete.pop()
+        self.assertTrue(call.complete)
+        self.assertEqual(list(call.legs), [caller, callee])
+        self.assertEqual(call.disposition, 'ANSWERED')
+        self.assertEqual(call.duration, 70)
+        self.assertEqual(call.billsec, 60)
+        self.assertEqual(call.post_dial_delay, 2)
+        self.assertEqual(self.tracker.call_of(caller), None)
+
+        caller, callee = self.call('2000.1', 2000, answer=False)
+        self.send('Hangup', 2011, Uniqueid=callee, Cause='17')
+        self.send('Hangup', 2011, Uniqueid=caller, Cause='17')
+        call = self.complete.pop()
+        self.assertEqual(call.disposition, 'BUSY')
+        self.assertEqual(call.billsec, 0)
+        self.assertEqual(self.tracker.calls, {})
+
+    def test_legacy_dial(self):
+        # Asterisk 1.8: no Linkedid, and UniqueID in Dial events
+        self.send('Newchannel', 1000, Uniqueid='1000.1',
+                  Channel='SIP/100-1', ChannelState='4', Exten='200')
+        self.send('Newchannel', 1001, Uniqueid='1000.2',
+                  Channel='SIP/200-2', ChannelState='0')
+        self.send('Dial', 1001, SubEvent='Begin', Channel='SIP/100-1',
+                  Destination='SIP/200-2', UniqueID='1000.1',
+                  DestUniqueID='1000.2', Dialstring='200')
+        self.send('Newstate', 1003, Uniqueid='1000.2', ChannelState='5')
+        self.send('Newstate', 1010, Uniqueid='1000.2', ChannelState='6')
+        self.send('Dial', 1010, SubEvent='End', Channel='SIP/100-1',
+                  UniqueID='1000.1', DialStatus='ANSWER')
+        call = self.tracker.call_of('1000.2')
+        self.assertTrue(call is self.tracker.call_of('1000.1'))
+        self.assertEqual(list(self.tracker.calls), ['1000.1'])
+        self.assertEqual(call.legs['1000.2'].channel, 'SIP/200-2')
+        self.send('Hangup', 1070, Uniqueid='1000.2', Cause='16')
+        self.send('Hangup', 1070, Uniqueid='1000.1', Cause='16')
+        call = self.complete.pop()
+        self.assertEqual(list(call.legs), ['1000.1', '1000.2'])
+        self.assertEqual(call.disposition, 'ANSWERED')
+        self.assertEqual(call.billsec, 60)
+        self.assertEqual(call.post_dial_delay, 2)
+
+    def test_eviction(self):
+        for n in range(3):
+            self.call('%d.1' % n, n)
+        self.assertEqual([c.linkedid for c in self.evicted], ['0.1'])
+        self.assertFalse(self.evicted[0].complete)
+        # calls without events for max_age are evicted too
+        self.send('Newchannel', 7200, Uniqueid='4.1', Linkedid='4.1')
+        self.assertEqual([c.linkedid for c in self.evicted],
+                         ['0.1', '1.1', '2.1'])
+        self.assertEqual(list(self.tracker.calls), ['4.1'])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_CallTracker))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from py_star.eventlog import EventLog, EventLogConsumer
+from py_star.manager import _event_from_text
+
+def varset(n):
+    return _event_from_text \
+        ( 'Event: VarSet\r\n'
+          'Privilege: dialplan,all\r\n'
+          'Channel: Local/102@from-queue-a8ca;2\r\n'
+          'Variable: ITER\r\n'
+          'Value: %d\r\n' % n
+        )
+
+class Test_EventLog(unittest.TestCase):
+    """ Test the durable event log.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def values(self, events):
+        return [int(e['Value']) for e in events]
+
+    def test_consumer(self):
+        log = EventLog(self.directory, segment_size=500, index_interval=200)
+        self.assertEqual(log.append_many([varset(n) for n in range(30)]), 0)
+        self.assertTrue(len(os.listdir(self.directory)) > 4)
+
+        consumer = EventLogConsumer(self.directory, 'test')
+        events = consumer.poll(max_events=12)
+        self.assertEqual(self.values(events), list(range(12)))
+        self.assertEqual([e.offset for e in events], list(range(12)))
+        consumer.commit()
+        self.assertEqual(self.values(consumer.poll(max_events=5)),
+                         list(range(12, 17)))
+        consumer.close()
+
+        # a new consumer resumes from the committed offset
+        consumer = EventLogConsumer(self.directory, 'test')
+        self.assertEqual(self.values(consumer.poll(max_events=100)),
+                         list(range(12, 30)))
+        self.assertEqual(consumer.poll(), [])
+        # and sees the events appended later
+        log.append(varset(30))
+        self.assertEqual(self.values(consumer.poll()), [30])
+        self.assertEqual(consumer.read(5, 2)[0].offset, 5)
+        consumer.close()
+        log.close()
+
+    def test_empty(self):
+        log = EventLog(self.directory)
+        consumer = EventLogConsumer(self.directory, 'test')
+        self.assertEqual(consumer.poll(), [])
+        log.append(varset(0))
+        self.assertEqual(self.values(consumer.poll()), [0])
+        self.assertEqual(consumer.poll(), [])
+        consumer.close()
+        log.close()
+
+    def test_recovery(self):
+        log = EventLog(self.directory)
+        log.append_many([varset(n) for n in range(10)])
+        log.close()
+        with open(os.path.join(self.directory, '%020d.log' % 0), 'ab') as f:
+            f.write(b'\x00\x00\x01\x00incomplete')
+
+        log = EventLog(self.directory)
+        self.assertEqual(log.append(varset(10)), 10)
+        log.close()
+        consumer = EventLogConsumer(self.directory, 'test')
+        self.assertEqual(self.values(consumer.poll()), list(range(11)))
+        consumer.close()
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_EventLog))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
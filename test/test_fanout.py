@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import multiprocessing
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.fanout import EventFanout
+from py_star.manager import Manager
+
+# where the workers put what they receive
+results = None
+
+def handler(event, worker):
+    results.put((worker.index, event['Linkedid'], event['Uniqueid']))
+
+def setup(worker):
+    worker.register_event('Newchannel', handler)
+
+class Test_EventFanout(unittest.TestCase):
+    """ Test the distribution of events to worker processes.
+    """
+
+    def setUp(self):
+        global results
+        results = multiprocessing.Queue()
+        self.manager = None
+        self.fanout = None
+
+    def tearDown(self):
+        if self.fanout:
+            self.fanout.close()
+        if self.manager:
+            self.manager.close()
+        self.astemu.close()
+
+    def run_fanout(self):
+        newchannel = lambda linkedid, uniqueid: Event \
+            ( Event    = ('Newchannel',)
+            , Channel  = ('SIP/%s' % uniqueid,)
+            , Uniqueid = (uniqueid,)
+            , Linkedid = (linkedid,)
+            )
+        events = dict \
+            ( Ping =
+                ( Event
+                    ( Response = ('Success',)
+                    , Ping     = ('Pong',)
+                    )
+                ,
+                ) + tuple(newchannel('call%d' % (n % 5), '%d' % n)
+                          for n in range(20))
+            )
+        self.astemu = AsteriskEmu(events)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.fanout = EventFanout(self.manager, setup, workers=3)
+        self.fanout.start()
+
+    def receive(self):
+        """Return the worker of each call, once all the events arrived."""
+        workers = {}
+        uniqueids = []
+        for k in range(20):
+            index, linkedid, uniqueid = results.get(timeout=5)
+            self.assertEqual(workers.setdefault(linkedid, index), index)
+            uniqueids.append(int(uniqueid))
+        self.assertEqual(sorted(uniqueids), list(range(20)))
+        return workers
+
+    def test_sharding(self):
+        self.run_fanout()
+        self.manager.ping()
+        self.receive()
+
+    def test_dead_worker(self):
+        self.run_fanout()
+        # killed before it puts anything in `results`, which a process
+        # killed while writing to it would leave locked
+        dead = self.fanout.processes[0]
+        dead.terminate()
+        dead.join()
+        # the events of the others still arrive, and the worker is
+        # restarted for its own
+        self.manager.ping()
+        workers = self.receive()
+        self.assertTrue(0 in workers.values())
+        self.assertEqual(self.fanout.restarts, 1)
+        self.assertTrue(self.fanout.processes[0] is not dead)
+        self.assertTrue(self.fanout.processes[0].is_alive())
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_EventFanout))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import socket
+import unittest
+
+from six.moves import queue
+from py_star.astemu import Event, AsteriskEmu
+from py_star.fleet import ManagerFleet
+from py_star.manager import ManagerException, ManagerSocketException
+from py_star.manager import ManagerTimeoutException
+
+class Test_ManagerFleet(unittest.TestCase):
+    """ Test many manager connections multiplexed by a fleet.
+    """
+
+    sippeers = dict \
+        ( Sippeers =
+            ( Event
+                ( Response  = ('Success',)
+                , EventList = ('start',)
+                , Message   = ('Peer status list will follow',)
+                )
+            , Event
+                ( Event      = ('PeerEntry',)
+                , ActionID   = ('',)
+                , ObjectName = ('100',)
+                )
+            , Event
+                ( Event      = ('PeerEntry',)
+                , ActionID   = ('',)
+                , ObjectName = ('101',)
+                )
+            , Event
+                ( Event     = ('PeerlistComplete',)
+                , ActionID  = ('',)
+                , EventList = ('Complete',)
+                , ListItems = ('2',)
+                )
+            )
+        )
+
+    def setUp(self):
+        self.emulators = []
+        self.fleet = ManagerFleet()
+        self.queue = queue.Queue()
+
+    def tearDown(self):
+        self.fleet.close()
+        for astemu in self.emulators:
+            astemu.close()
+
+    def handler(self, event, fleet):
+        self.queue.put(event)
+
+    def add_node(self, name, chatscript):
+        astemu = AsteriskEmu(chatscript)
+        self.emulators.append(astemu)
+        self.fleet.add_node(name, 'localhost', astemu.port,
+                            username='account', secret='geheim')
+
+    def test_fan_out(self):
+        self.add_node('pbx1', self.sippeers)
+        self.add_node('pbx2', self.sippeers)
+        self.fleet.register_event('PeerEntry', self.handler)
+        logins = self.fleet.connect()
+        self.assertEqual(sorted(logins), ['pbx1', 'pbx2'])
+        for response in logins.values():
+            self.assertEqual(response['Response'], 'Success')
+
+        results = self.fleet.sippeers(timeout=5)
+        self.assertEqual(sorted(results), ['pbx1', 'pbx2'])
+        for response in results.values():
+            self.assertEqual(response['Response'], 'Success')
+            self.assertEqual([e['ObjectName'] for e in response.events],
+                             ['100', '101'])
+
+        nodes = sorted(self.queue.get(timeout=5).node for k in range(4))
+        self.assertEqual(nodes, ['pbx1', 'pbx1', 'pbx2', 'pbx2'])
+
+    def test_connect_error(self):
+        self.add_node('pbx1', self.sippeers)
+        # a port nobody listens to
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        self.fleet.add_node('pbx2', 'localhost', sock.getsockname()[1],
+                            username='account', secret='geheim')
+        sock.close()
+        logins = self.fleet.connect(timeout=5)
+        self.assertEqual(logins['pbx1']['Response'], 'Success')
+        self.assertTrue(isinstance(logins['pbx2'], ManagerSocketException))
+        self.assertFalse(self.fleet.node('pbx2').is_connected())
+        results = self.fleet.sippeers(timeout=5)
+        self.assertEqual(results['pbx1']['Response'], 'Success')
+
+    def test_fan_out_timeout(self):
+        self.add_node('pbx1', self.sippeers)
+        self.add_node('pbx2', {})
+        self.fleet.connect()
+        results = self.fleet.sippeers(timeout=0.5)
+        self.assertEqual(results['pbx1']['Response'], 'Success')
+        self.assertTrue(isinstance(results['pbx2'], ManagerTimeoutException))
+
+    def test_node_error(self):
+        self.add_node('pbx1', self.sippeers)
+        self.add_node('pbx2', self.sippeers)
+        self.fleet.connect()
+        def read():
+            raise ValueError('garbage')
+        self.fleet.node('pbx2').read = read
+        results = self.fleet.sippeers(timeout=5)
+        self.assertEqual(results['pbx1']['Response'], 'Success')
+        self.assertTrue(isinstance(results['pbx2'], ManagerSocketException))
+        self.assertEqual(self.fleet.errors_in_threads.get(timeout=5),
+                         "Error handling the connection to pbx2")
+        # the other nodes are still served
+        results = self.fleet.sippeers(timeout=5)
+        self.assertEqual(results['pbx1']['Response'], 'Success')
+        self.assertTrue(isinstance(results['pbx2'], ManagerException))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ManagerFleet))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import json
+import socket
+import struct
+import time
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.gateway import EventGateway
+from py_star.manager import Manager
+
+class Test_EventGateway(unittest.TestCase):
+    """ Test the streaming of events over HTTP.
+    """
+
+    chatscript = dict \
+        ( Ping =
+            ( Event
+                ( Response = ('Success',)
+                , Ping     = ('Pong',)
+                )
+            , Event
+                ( Event    = ('VarSet',)
+                , Channel  = ('SIP/100-1',)
+                , Variable = ('ITER',)
+                , Value    = ('1',)
+                )
+            , Event
+                ( Event    = ('Hangup',)
+                , Channel  = ('SIP/100-1',)
+                , Uniqueid = ('1000.1',)
+                )
+            )
+        )
+
+    def setUp(self):
+        self.astemu = AsteriskEmu(self.chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.gateway = EventGateway(self.manager, port=0)
+        self.gateway.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.gateway.close()
+        self.manager.close()
+        self.astemu.close()
+
+    def get(self, path, *headers):
+        sock = socket.create_connection(self.gateway.address, timeout=5)
+        self.sockets.append(sock)
+        request = 'GET %s HTTP/1.1\r\nHost: localhost\r\n' % path
+        request += ''.join(h + '\r\n' for h in headers) + '\r\n'
+        sock.sendall(request.encode('ascii'))
+        f = sock.makefile('rb')
+        status = f.readline()
+        while f.readline().strip():
+            pass
+        return status, f
+
+    def test_sse(self):
+        status, f = self.get('/events?events=Hangup,Newchannel')
+        self.assertEqual(status, b'HTTP/1.1 200 OK\r\n')
+        self.manager.ping()
+        self.assertEqual(f.readline(), b'event: Hangup\n')
+        data = f.readline()
+        self.assertTrue(data.startswith(b'data: '))
+        headers = json.loads(data[6:].decode('utf-8'))
+        self.assertEqual(headers['Uniqueid'], '1000.1')
+        self.assertEqual(len(self.gateway.subscribers()), 1)
+
+    def websocket(self, path):
+        return self.get(path, 'Upgrade: websocket', 'Connection: Upgrade',
+                        'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==',
+                        'Sec-WebSocket-Version: 13')
+
+    def send_frame(self, opcode, payload):
+        # frames of clients are masked
+        mask = bytearray(b'\x01\x02\x03\x04')
+        masked = bytearray(b ^ mask[i % 4]
+                           for i, b in enumerate(bytearray(payload)))
+        frame = struct.pack('>BB', opcode, 0x80 | len(payload))
+        self.sockets[-1].sendall(frame + bytes(mask) + bytes(masked))
+
+    def test_websocket(self):
+        status, f = self.websocket('/events?Channel=SIP/100-1')
+        self.assertEqual(status, b'HTTP/1.1 101 Switching Protocols\r\n')
+        self.manager.ping()
+        names = []
+        for n in range(2):
+            opcode, length = struct.unpack('>BB', f.read(2))
+            self.assertEqual(opcode, 0x81)
+            names.append(json.loads(f.read(length).decode('utf-8'))['Event'])
+        self.assertEqual(names, ['VarSet', 'Hangup'])
+
+    def test_websocket_control(self):
+        status, f = self.websocket('/events')
+        self.assertEqual(status, b'HTTP/1.1 101 Switching Protocols\r\n')
+        self.send_frame(0x89, b'hello')
+        self.assertEqual(f.read(7), b'\x8a\x05hello')
+        self.send_frame(0x88, b'\x03\xe8')
+        self.assertEqual(f.read(4), b'\x88\x02\x03\xe8')
+        # and the connection is closed
+        self.assertEqual(f.read(1), b'')
+        self.assertEqual(self.gateway.subscribers(), [])
+
+    def test_websocket_gone(self):
+        self.websocket('/events')
+        self.assertEqual(len(self.gateway.subscribers()), 1)
+        self.sockets.pop().close()
+        for n in range(50):
+            if not self.gateway.subscribers():
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.gateway.subscribers(), [])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_EventGateway))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
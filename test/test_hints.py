@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.hints import HintTable
+from py_star.manager import Manager, _event_from_text
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_HintTable(unittest.TestCase):
+    """ Test the table of the states of the hints.
+    """
+
+    def setUp(self):
+        self.table = HintTable()
+        self.changes = []
+        self.manager = None
+        self.astemu = None
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def send(self, name, **headers):
+        self.table.handle_event(event(name, **headers))
+
+    def handle_change(self, hint, table):
+        self.changes.append((hint.exten, hint.status, hint.presence))
+
+    def test_seed(self):
+        chatscript = dict(
+            ExtensionStateList=(
+                Event(Response=('Success',),
+                      Message=('Extension Statuses will follow',)),
+                Event(Event=('ExtensionStatus',), Exten=('100',),
+                      Context=('default',), Hint=('SIP/100',),
+                      Status=('0',), StatusText=('Idle',),
+                      ActionID=('',)),
+                Event(Event=('ExtensionStatus',), Exten=('101',),
+                      Context=('default',), Hint=('SIP/101&SIP/102',),
+                      Status=('1',), StatusText=('InUse',),
+                      ActionID=('',)),
+                Event(Event=('ExtensionStateListComplete',),
+                      ActionID=('',)),
+            )
+        )
+        self.astemu = AsteriskEmu(chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.table.attach(self.manager)
+        self.table.seed(self.manager, timeout=5)
+
+        self.assertEqual(self.table.state('100', 'default').status, 0)
+        hint = self.table.state('101', 'default')
+        self.assertEqual(hint.status_text, 'InUse')
+        self.assertEqual(hint.devices, ('SIP/101', 'SIP/102'))
+        self.assertEqual(sorted(h['exten'] for h in self.table.snapshot()),
+                         ['100', '101'])
+
+    def test_events(self):
+        send = self.send
+        send('ExtensionStatus', Exten='100', Context='default',
+             Hint='SIP/100,CustomPresence:100', Status='0',
+             StatusText='Idle')
+        send('ExtensionStatus', Exten='101', Context='default',
+             Hint='SIP/101', Status='0', StatusText='Idle')
+        subscription = self.table.subscribe([('100', 'default')],
+                                            self.handle_change)
+
+        send('DeviceStateChange', Device='SIP/100', State='INUSE')
+        send('ExtensionStatus', Exten='100', Context='default',
+             Hint='SIP/100,CustomPresence:100', Status='1',
+             StatusText='InUse')
+        send('ExtensionStatus', Exten='101', Context='default',
+             Hint='SIP/101', Status='8', StatusText='Ringing')
+        send('PresenceStateChange', Presentity='CustomPresence:100',
+             Status='dnd', Subtype='', Message='In a meeting')
+        self.assertEqual(self.changes, [('100', 1, None), ('100', 1, 'dnd')])
+        self.assertEqual(self.table.device_states['SIP/100'], 'INUSE')
+        self.assertEqual(self.table.state('100', 'default').presence_message,
+                         'In a meeting')
+
+        self.table.unsubscribe(subscription)
+        send('ExtensionStatus', Exten='100', Context='default',
+             Hint='SIP/100,CustomPresence:100', Status='-2',
+             StatusText='Removed')
+        self.assertEqual(len(self.changes), 2)
+        self.assertEqual(self.table.state('100', 'default'), None)
+        self.assertEqual(self.table.state('101', 'default').status, 8)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_HintTable))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
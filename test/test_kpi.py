@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import math
+import unittest
+
+from py_star.kpi import CallStats
+
+class Test_CallStats(unittest.TestCase):
+    """ Test the rolling call KPIs.
+    """
+
+    def setUp(self):
+        self.stats = CallStats(window=100, dimensions=('trunk',), bucket=10)
+        add = self.stats.add
+        add(10, True, 30.0, 2.0, trunk='a')
+        add(20, False, pdd=4.0, trunk='a')
+        add(30, True, 60.0, 1.0, trunk='b')
+        add(40, True, 90.0, trunk='b')
+
+    def test_kpis(self):
+        stats = self.stats
+        self.assertEqual(stats.count(now=50), 4)
+        self.assertEqual(stats.asr(now=50), 0.75)
+        self.assertEqual(stats.acd(now=50), 60.0)
+        self.assertAlmostEqual(stats.pdd(now=50), 7.0 / 3)
+        self.assertEqual(stats.percentile('duration', 50, now=50), 60.0)
+        self.assertEqual(stats.percentile('duration', 75, now=50), 75.0)
+        self.assertEqual(stats.summary(now=50, trunk='a'),
+                         {'calls': 2, 'asr': 0.5, 'acd': 30.0, 'pdd': 3.0})
+        self.assertEqual(stats.count(now=50, trunk='c'), 0)
+        self.assertEqual(stats.asr(now=50, trunk='c'), None)
+
+    def test_window(self):
+        stats = self.stats
+        self.assertEqual(stats.count(window=25, now=50), 2)
+        self.assertEqual(stats.acd(window=25, now=50), 75.0)
+        # calls older than the window of the store are expired
+        stats.add(125, False, trunk='a')
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(stats.summary(now=125, trunk='a'),
+                         {'calls': 1, 'asr': 0.0, 'acd': None, 'pdd': None})
+
+    def test_buckets(self):
+        stats = CallStats(window=100, dimensions=('trunk', 'queue'),
+                          bucket=10)
+        calls = []
+        for n in range(300):
+            call = (n * 0.7, n % 3 != 0, float(n % 50), float(n % 7),
+                    'abc'[n % 3], 'xy'[n % 2])
+            calls.append(call)
+            stats.add(call[0], call[1], call[2], call[3], trunk=call[4],
+                      queue=call[5])
+        now = calls[-1][0]
+        # the KPIs of the buckets of the window are those of their calls
+        for window in (100, 55, 33.3, 5):
+            first = math.ceil((now - window) / 10)
+            for groups in ({}, {'trunk': 'b'}, {'trunk': 'a', 'queue': 'x'}):
+                selected = [c for c in calls if c[0] // 10 >= first and
+                            all(c[('trunk', 'queue').index(d) + 4] == v
+                                for d, v in groups.items())]
+                answered = [c for c in selected if c[1]]
+                self.assertEqual(stats.count(window, now, **groups),
+                                 len(selected))
+                self.assertAlmostEqual(stats.acd(window, now, **groups),
+                    sum(c[2] for c in answered) / len(answered)
+                    if answered else None)
+                self.assertAlmostEqual(stats.pdd(window, now, **groups),
+                    sum(c[3] for c in selected) / len(selected)
+                    if selected else None)
+        self.assertEqual(len(stats._buckets), 10)
+        # the window stops at now
+        self.assertEqual(stats.count(window=10, now=now - 10),
+                         len([c for c in calls if c[0] // 10 == 19]))
+
+    def test_order(self):
+        stats = CallStats(window=100, bucket=10)
+        for when in (50, 20, 150, 70, 140):
+            self.assertTrue(stats.add(when, True, when))
+        # too late for the window of the store
+        self.assertFalse(stats.add(45, True, 45))
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(stats.count(window=20, now=150), 2)
+        self.assertEqual(stats.acd(window=20, now=150), 145.0)
+        self.assertEqual(stats.count(window=100, now=100), 2)
+
+    def test_percentiles(self):
+        stats = CallStats(window=1000, bucket=10)
+        pdds = [(n * 7919 % 1000) / 100.0 for n in range(1000)]
+        for n, pdd in enumerate(pdds):
+            stats.add(n, False, pdd=pdd)
+        pdds.sort()
+        for q in (0, 10, 50, 95, 99, 100):
+            rank = 999 * q // 100
+            self.assertAlmostEqual(stats.percentile('pdd', q, now=999),
+                                   pdds[rank], delta=pdds[rank] * 0.01)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_CallStats))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from six.moves import queue
+from py_star.astemu import Event, AsteriskEmu
+from py_star.manager import Manager, ManagerAuthException
+from py_star.proxy import AMIProxy, _constant_time_compare
+
+class Test_AMIProxy(unittest.TestCase):
+    """ Test the sharing of a manager connection by the proxy.
+    """
+
+    chatscript = dict \
+        ( Sippeers =
+            ( Event
+                ( Response  = ('Success',)
+                , EventList = ('start',)
+                , Message   = ('Peer status list will follow',)
+                )
+            , Event
+                ( Event      = ('PeerEntry',)
+                , ActionID   = ('',)
+                , ObjectName = ('100',)
+                )
+            , Event
+                ( Event     = ('PeerlistComplete',)
+                , ActionID  = ('',)
+                , EventList = ('Complete',)
+                )
+            )
+        , Ping =
+            ( Event
+                ( Response = ('Success',)
+                , Ping     = ('Pong',)
+                )
+            , Event
+                ( Event    = ('VarSet',)
+                , Channel  = ('SIP/100-1',)
+                , Variable = ('ITER',)
+                , Value    = ('1',)
+                )
+            , Event
+                ( Event    = ('Hangup',)
+                , Channel  = ('SIP/100-1',)
+                , Uniqueid = ('1000.1',)
+                )
+            )
+        )
+
+    def setUp(self):
+        self.astemu = AsteriskEmu(self.chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.manager.login('account', 'geheim')
+        self.proxy = AMIProxy(self.manager, port=0,
+                              users={'tool': 'secret'})
+        self.proxy.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.proxy.close()
+        self.manager.close()
+        self.astemu.close()
+
+    def client(self):
+        client = Manager()
+        client.connect('localhost', port=self.proxy.address[1])
+        self.clients.append(client)
+        events = queue.Queue()
+        client.register_event('*', lambda event, manager: events.put(event))
+        return client, events
+
+    def test_proxy(self):
+        a, a_events = self.client()
+        b, b_events = self.client()
+        self.assertRaises(ManagerAuthException, b.login, 'tool', 'wrong')
+        a.login('tool', 'secret')
+        b.login('tool', 'secret')
+        r = a.send_action(Action='Filter', Operation='Add',
+                          Filter='!Event: VarSet')
+        self.assertEqual(r['Response'], 'Success')
+
+        # responses, and the events listing results, go to their client,
+        # with the ActionID it gave
+        r = a.send_action(Action='Sippeers', ActionID='mine')
+        self.assertEqual(r['ActionID'], 'mine')
+        self.assertEqual(r['Message'], 'Peer status list will follow')
+        event = a_events.get(timeout=5)
+        self.assertEqual(event.name, 'PeerEntry')
+        self.assertEqual(event['ActionID'], 'mine')
+        self.assertEqual(a_events.get(timeout=5).name, 'PeerlistComplete')
+
+        # other events go to all, as filtered by each
+        self.assertEqual(b.ping()['Ping'], 'Pong')
+        self.assertEqual(b_events.get(timeout=5).name, 'VarSet')
+        self.assertEqual(b_events.get(timeout=5).name, 'Hangup')
+        self.assertEqual(a_events.get(timeout=5).name, 'Hangup')
+        self.assertTrue(a_events.empty())
+        self.assertEqual(len(self.proxy.clients), 2)
+
+    def test_login(self):
+        client, events = self.client()
+        # unknown user without a secret
+        r = client.send_action(Action='Login', Username='nobody')
+        self.assertEqual(r['Response'], 'Error')
+        r = client.send_action(Action='Sippeers')
+        self.assertEqual(r['Message'], 'Permission denied')
+        # known user with a wrong secret, or none
+        r = client.send_action(Action='Login', Username='tool',
+                               Secret='wrong')
+        self.assertEqual(r['Response'], 'Error')
+        r = client.send_action(Action='Login', Username='tool')
+        self.assertEqual(r['Response'], 'Error')
+        r = client.send_action(Action='Sippeers')
+        self.assertEqual(r['Message'], 'Permission denied')
+        self.assertEqual(client.login('tool', 'secret')['Response'],
+                         'Success')
+
+    def test_compare(self):
+        # without hmac.compare_digest (Python < 2.7.7)
+        self.assertTrue(_constant_time_compare(b'secret', b'secret'))
+        self.assertFalse(_constant_time_compare(b'secret', b'secreT'))
+        self.assertFalse(_constant_time_compare(b'secret', b'secret2'))
+        self.assertTrue(_constant_time_compare(b'', b''))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_AMIProxy))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
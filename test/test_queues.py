@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.manager import Manager, _event_from_text
+from py_star.queues import QueueState
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_QueueState(unittest.TestCase):
+    """ Test the live state of the queues.
+    """
+
+    def setUp(self):
+        self.state = QueueState()
+        self.manager = None
+        self.astemu = None
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+
+    def send(self, name, timestamp, **headers):
+        headers['Timestamp'] = '%.1f' % timestamp
+        self.state.handle_event(event(name, **headers))
+
+    def test_seed(self):
+        chatscript = dict(
+            QueueStatus=(
+                Event(Response=('Success',),
+                      Message=('Queue status will follow',)),
+                Event(Event=('QueueParams',), Queue=('support',),
+                      ServiceLevel=('20',), Completed=('10',),
+                      Abandoned=('2',), ServicelevelPerf=('80.0',),
+                      Holdtime=('15',), TalkTime=('120',),
+                      ActionID=('',)),
+                Event(Event=('QueueMember',), Queue=('support',),
+                      Name=('Alice',), Location=('SIP/100',),
+                      Status=('1',), Paused=('0',), ActionID=('',)),
+                Event(Event=('QueueMember',), Queue=('support',),
+                      Name=('Bob',), Location=('SIP/101',),
+                      Status=('1',), Paused=('1',), ActionID=('',)),
+                Event(Event=('QueueEntry',), Queue=('support',),
+                      Position=('1',), Channel=('SIP/200-1',),
+                      Uniqueid=('1000.1',), Wait=('30',),
+                      ActionID=('',)),
+                Event(Event=('QueueStatusComplete',), ActionID=('',)),
+            )
+        )
+        self.astemu = AsteriskEmu(chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.state.attach(self.manager)
+        self.state.seed(self.manager, timeout=5)
+
+        queue = self.state.queues['support']
+        self.assertEqual(queue.service_level, 20)
+        self.assertEqual(queue.completed_in_service_level, 8)
+        self.assertEqual(queue.service_level_perf(), 0.8)
+        self.assertEqual(queue.average_hold_time(), 15)
+        self.assertEqual(sorted(queue.members), ['SIP/100', 'SIP/101'])
+        self.assertEqual(queue.members['SIP/100'].name, 'Alice')
+        self.assertEqual(queue.available, 1)
+        self.assertEqual(list(queue.callers), ['1000.1'])
+        self.assertTrue(29 <= queue.longest_wait() < 60)
+
+    def test_events(self):
+        send = self.send
+        send('QueueParams', 0, Queue='sales', ServiceLevel='30')
+        send('QueueMemberAdded', 0, Queue='sales', Interface='SIP/100',
+             MemberName='Alice', Status='1', Paused='0')
+        queue = self.state.queues['sales']
+        self.assertEqual(queue.available, 1)
+        send('QueueCallerJoin', 100, Queue='sales', Uniqueid='1',
+             Channel='SIP/200-1', Position='1')
+        send('QueueCallerJoin', 110, Queue='sales', Uniqueid='2',
+             Channel='SIP/201-1', Position='2')
+        self.assertEqual(queue.longest_wait(now=120), 20)
+        send('QueueCallerAbandon', 115, Queue='sales', Uniqueid='1')
+        send('QueueCallerLeave', 115, Queue='sales', Uniqueid='1',
+             Position='1')
+        self.assertEqual(queue.callers['2'].position, 1)
+        self.assertEqual(queue.longest_wait(now=120), 10)
+
+        send('QueueMemberStatus', 140, Queue='sales', Interface='SIP/100',
+             Status='2', InCall='1')
+        self.assertEqual(queue.available, 0)
+        send('AgentConnect', 140, Queue='sales', Interface='SIP/100',
+             HoldTime='30', Uniqueid='2')
+        send('QueueCallerLeave', 140, Queue='sales', Uniqueid='2')
+        send('AgentComplete', 200, Queue='sales', Interface='SIP/100',
+             HoldTime='30', TalkTime='60', Reason='caller')
+        self.assertEqual(queue.callers, {})
+        self.assertEqual(queue.longest_wait(now=200), 0)
+        self.assertEqual(queue.service_level_perf(), 1.0)
+        self.assertEqual(queue.abandon_rate(), 0.5)
+        self.assertEqual(queue.average_talk_time(), 60)
+
+        send('QueueMemberStatus', 200, Queue='sales', Interface='SIP/100',
+             Status='1', InCall='0')
+        send('QueueMemberPause', 210, Queue='sales', Interface='SIP/100',
+             Paused='1', Reason='lunch')
+        self.assertEqual(queue.available, 0)
+        self.assertEqual(queue.members['SIP/100'].paused_reason, 'lunch')
+        send('QueueMemberRemoved', 220, Queue='sales', Interface='SIP/100')
+        self.assertEqual(queue.members, {})
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_QueueState))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from py_star.manager import _event_from_text
+from py_star.shmstate import ChannelTableReader, ChannelTableWriter
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_ChannelTable(unittest.TestCase):
+    """ Test the channel table shared through memory.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'channels')
+        self.writer = ChannelTableWriter(self.path, capacity=2)
+        self.reader = ChannelTableReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def send(self, name, **headers):
+        self.writer.handle_event(event(name, **headers))
+
+    def test_table(self):
+        self.send('Newchannel', Uniqueid='1', Linkedid='1',
+                  Channel='SIP/100-1', ChannelState='4',
+                  CallerIDNum='100', Context='default', Exten='200',
+                  Timestamp='1000.5')
+        self.send('Newchannel', Uniqueid='2', Linkedid='1',
+                  Channel='SIP/200-2', ChannelState='0')
+        self.send('Newchannel', Uniqueid='3', Channel='SIP/300-3')
+        self.assertEqual(self.writer.overflows, 1)
+        self.send('Newstate', Uniqueid='2', ChannelState='6',
+                  ConnectedLineNum='100')
+        self.send('Rename', Uniqueid='1', Newname='SIP/100-1<MASQ>')
+
+        channels = sorted(self.reader.snapshot())
+        self.assertEqual([c.uniqueid for c in channels], ['1', '2'])
+        self.assertEqual(channels[0].channel, 'SIP/100-1<MASQ>')
+        self.assertEqual(channels[0].created, 1000.5)
+        self.assertEqual(channels[0].exten, '200')
+        self.assertEqual(channels[1].state, 6)
+        self.assertEqual(channels[1].connected_line_num, '100')
+
+        self.send('Hangup', Uniqueid='1')
+        self.send('Newchannel', Uniqueid='4', Channel='SIP/400-4')
+        self.assertEqual(sorted(c.uniqueid for c in self.reader.snapshot()),
+                         ['2', '4'])
+        self.assertEqual(self.reader.get('4').channel, 'SIP/400-4')
+
+        # a new writer replaces the table, readers follow
+        self.writer.close()
+        self.writer = ChannelTableWriter(self.path, capacity=4)
+        self.assertEqual(self.reader.snapshot(), [])
+        self.assertEqual(self.reader.capacity, 4)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ChannelTable))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
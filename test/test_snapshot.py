@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.calls import CallTracker
+from py_star.hints import HintTable
+from py_star.manager import Manager, _event_from_text
+from py_star.queues import QueueState
+from py_star.snapshot import Snapshotter
+from py_star.topology import ChannelGraph
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_Snapshotter(unittest.TestCase):
+    """ Test the snapshots of the state and warm starts from them.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state')
+        self.manager = None
+        self.astemu = None
+
+    def tearDown(self):
+        if self.manager:
+            self.manager.close()
+        if self.astemu:
+            self.astemu.close()
+        shutil.rmtree(self.directory)
+
+    def components(self):
+        return dict(calls=CallTracker(), graph=ChannelGraph(),
+                    queues=QueueState(), hints=HintTable())
+
+    def feed(self, components):
+        events = [
+            event('Newchannel', Uniqueid='1', Linkedid='1',
+                  Channel='SIP/100-1', ChannelState='4', Exten='200'),
+            event('Newchannel', Uniqueid='2', Linkedid='1',
+                  Channel='SIP/200-2', ChannelState='0'),
+            event('BridgeCreate', BridgeUniqueid='b1', BridgeType='basic'),
+            event('BridgeEnter', BridgeUniqueid='b1', Uniqueid='1',
+                  Channel='SIP/100-1'),
+            event('BridgeEnter', BridgeUniqueid='b1', Uniqueid='2',
+                  Channel='SIP/200-2'),
+            event('QueueMemberAdded', Queue='sales', Interface='SIP/300',
+                  MemberName='Alice', Status='1', Paused='0'),
+            event('QueueCallerJoin', Queue='sales', Uniqueid='1',
+                  Channel='SIP/100-1', Position='1'),
+            event('QueueCallerJoin', Queue='sales', Uniqueid='3',
+                  Channel='SIP/400-3', Position='2'),
+            event('ExtensionStatus', Exten='100', Context='default',
+                  Hint='SIP/100,CustomPresence:100', Status='1',
+                  StatusText='InUse'),
+            event('QueueMemberAdded', Queue='support', Interface='SIP/500',
+                  MemberName='Bob', Status='1', Paused='0'),
+            event('ExtensionStatus', Exten='101', Context='default',
+                  Hint='SIP/101', Status='0', StatusText='Idle'),
+            event('DeviceStateChange', Device='SIP/100', State='INUSE'),
+            event('DeviceStateChange', Device='SIP/101', State='NOT_INUSE'),
+            event('DeviceStateChange', Device='SIP/300', State='NOT_INUSE'),
+        ]
+        for component in components.values():
+            for e in events:
+                component.handle_event(e)
+
+    def test_save_load(self):
+        components = self.components()
+        self.feed(components)
+        Snapshotter(self.path, components).save()
+
+        loaded = self.components()
+        snapshotter = Snapshotter(self.path, loaded)
+        self.assertTrue(snapshotter.load(max_age=60))
+        call = loaded['calls'].call_of('2')
+        self.assertEqual(list(call.legs), ['1', '2'])
+        self.assertEqual(call.legs['1'].exten, '200')
+        self.assertEqual(loaded['graph'].call_of('1'), set(['1', '2']))
+        self.assertEqual(loaded['graph'].uniqueid_of('SIP/200-2'), '2')
+        queue = loaded['queues'].queues['sales']
+        self.assertEqual(queue.available, 1)
+        self.assertEqual(list(queue.callers), ['1', '3'])
+        hint = loaded['hints'].state('100', 'default')
+        self.assertEqual(hint.devices, ('SIP/100',))
+        self.assertEqual(hint.status, 1)
+
+        # the loaded state is kept up to date
+        loaded['hints'].handle_event(event(
+            'PresenceStateChange', Presentity='CustomPresence:100',
+            Status='away'))
+        self.assertEqual(hint.presence, 'away')
+
+    def test_load_missing_or_corrupt(self):
+        components = self.components()
+        snapshotter = Snapshotter(self.path, components)
+        self.assertEqual(snapshotter.load(), None)
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(snapshotter.load(), None)
+        snapshotter.save()
+        self.assertEqual(snapshotter.load(max_age=-1), None)
+        self.assertTrue(snapshotter.load())
+
+    def test_reconcile(self):
+        chatscript = dict(
+            CoreShowChannels=(
+                Event(Response=('Success',),
+                      Message=('Channels will follow',)),
+                Event(Event=('CoreShowChannel',), Uniqueid=('1',),
+                      Channel=('SIP/100-1',), ActionID=('',)),
+                Event(Event=('CoreShowChannelsComplete',),
+                      ListItems=('1',), ActionID=('',)),
+            ),
+            DeviceStateList=(
+                Event(Response=('Success',),
+                      Message=('Device State Changes will follow',)),
+                Event(Event=('DeviceStateChange',), Device=('SIP/100',),
+                      State=('NOT_INUSE',), ActionID=('',)),
+                Event(Event=('DeviceStateChange',), Device=('SIP/101',),
+                      State=('NOT_INUSE',), ActionID=('',)),
+                Event(Event=('DeviceStateChange',), Device=('SIP/300',),
+                      State=('INUSE',), ActionID=('',)),
+                Event(Event=('DeviceStateListComplete',),
+                      ListItems=('3',), ActionID=('',)),
+            ),
+            # only for the hint whose device changed
+            ExtensionState=(
+                Event(Response=('Success',), Message=('Extension Status',),
+                      Exten=('100',), Context=('default',),
+                      Hint=('SIP/100,CustomPresence:100',),
+                      Status=('0',), StatusText=('Idle',)),
+            ),
+        )
+        components = self.components()
+        self.feed(components)
+        Snapshotter(self.path, components).save()
+
+        self.astemu = AsteriskEmu(chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        loaded = self.components()
+        snapshotter = Snapshotter(self.path, loaded)
+        self.assertTrue(snapshotter.load())
+        for component in loaded.values():
+            component.attach(self.manager)
+        uniqueids = snapshotter.reconcile(self.manager, timeout=5)
+        self.assertEqual(uniqueids, set(['1']))
+
+        # channel 2 and caller 3 went away meanwhile
+        self.assertEqual(sorted(loaded['graph'].channels), ['1'])
+        self.assertEqual(loaded['graph'].peers('1'), set())
+        call = loaded['calls'].call_of('1')
+        self.assertTrue(call.legs['2'].hungup is not None)
+        self.assertTrue(loaded['calls'].call_of('2') is call)
+        queue = loaded['queues'].queues['sales']
+        self.assertEqual(list(queue.callers), ['1'])
+        self.assertEqual(queue.callers['1'].position, 1)
+
+        # and the members and the hints whose devices changed state are
+        # resynchronized
+        self.assertEqual(queue.members['SIP/300'].status, '2')
+        self.assertEqual(queue.available, 0)
+        self.assertEqual(
+            loaded['queues'].queues['support'].members['SIP/500'].status, '1')
+        hints = loaded['hints']
+        self.assertEqual(hints.state('100', 'default').status, 0)
+        self.assertEqual(hints.state('100', 'default').status_text, 'Idle')
+        self.assertEqual(hints.state('101', 'default').status, 0)
+        self.assertEqual(hints.device_states['SIP/100'], 'NOT_INUSE')
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_Snapshotter))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from py_star import topology
+from py_star.manager import _event_from_text
+from py_star.topology import ChannelGraph
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_ChannelGraph(unittest.TestCase):
+    """ Test the graph of channels and bridges.
+    """
+
+    def setUp(self):
+        self.graph = ChannelGraph()
+
+    def send(self, name, **headers):
+        self.graph.handle_event(event(name, **headers))
+
+    def newchannel(self, uniqueid, name):
+        self.send('Newchannel', Uniqueid=uniqueid, Channel=name,
+                  Linkedid='1')
+
+    def enter(self, bridge, uniqueid):
+        self.send('BridgeEnter', BridgeUniqueid=bridge, Uniqueid=uniqueid)
+
+    def test_local_transfer(self):
+        # SIP/100 -> Local/200@ctx;1 ... Local/200@ctx;2 -> SIP/200
+        self.newchannel('1', 'SIP/100-1')
+        self.newchannel('2', 'Local/200@ctx-0001;1')
+        self.newchannel('3', 'Local/200@ctx-0001;2')
+        self.newchannel('4', 'SIP/200-2')
+        self.send('LocalBridge', LocalOneUniqueid='2', LocalTwoUniqueid='3',
+                  LocalOneChannel='Local/200@ctx-0001;1',
+                  LocalTwoChannel='Local/200@ctx-0001;2')
+        self.send('BridgeCreate', BridgeUniqueid='a', BridgeType='basic')
+        self.enter('a', '1')
+        self.enter('a', '2')
+        self.send('BridgeCreate', BridgeUniqueid='b', BridgeType='basic')
+        self.enter('b', '3')
+        self.enter('b', '4')
+
+        graph = self.graph
+        self.assertEqual(graph.peers('1'), set(['2']))
+        self.assertEqual(graph.local_peer('2'), '3')
+        self.assertEqual(graph.far_end('2'), set(['4']))
+        self.assertEqual(graph.far_end('3'), set(['1']))
+        self.assertEqual(graph.call_of('4'), set(['1', '2', '3', '4']))
+
+        # SIP/100 is transferred to a conference
+        self.send('BridgeLeave', BridgeUniqueid='a', Uniqueid='1')
+        self.send('Hangup', Uniqueid='2')
+        self.send('BridgeDestroy', BridgeUniqueid='a')
+        self.send('Rename', Uniqueid='1', Channel='SIP/100-1',
+                  Newname='SIP/100-1<MASQ>')
+        self.enter('c', '1')
+        self.newchannel('5', 'SIP/300-3')
+        self.enter('c', '5')
+        self.assertEqual(graph.call_of('1'), set(['1', '5']))
+        self.assertEqual(graph.call_of('4'), set(['3', '4']))
+        self.assertEqual(graph.local_peer('3'), None)
+        self.assertEqual(graph.uniqueid_of('SIP/100-1<MASQ>'), '1')
+        self.assertEqual(sorted(graph.bridges), ['b', 'c'])
+
+    def test_old_events(self):
+        # Asterisk < 12, Local halves found by name
+        self.newchannel('1', 'SIP/100-1')
+        self.newchannel('2', 'Local/200@ctx-0001;1')
+        self.newchannel('3', 'Local/200@ctx-0001;2')
+        self.newchannel('4', 'SIP/200-2')
+        self.send('Bridge', Bridgestate='Link', Uniqueid1='1',
+                  Uniqueid2='2')
+        self.send('Bridge', Bridgestate='Link', Uniqueid1='3',
+                  Uniqueid2='4')
+        self.assertEqual(self.graph.far_end('2'), set(['4']))
+        self.assertEqual(self.graph.call_of('1'), set(['1', '2', '3', '4']))
+        self.send('Bridge', Bridgestate='Unlink', Uniqueid1='1',
+                  Uniqueid2='2')
+        self.send('Hangup', Uniqueid='3')
+        self.send('Hangup', Uniqueid='4')
+        self.assertEqual(self.graph.call_of('1'), set(['1']))
+        self.assertEqual(self.graph.bridges, {})
+
+    def test_missing_headers(self):
+        self.newchannel('1', 'SIP/100-1')
+        self.send('BridgeCreate', BridgeType='basic')
+        self.send('BridgeEnter', Uniqueid='1')
+        self.send('BridgeEnter', BridgeUniqueid='a')
+        self.send('BridgeLeave', BridgeUniqueid='a')
+        self.send('BridgeDestroy')
+        self.assertEqual(self.graph.bridges, {})
+        self.assertEqual(self.graph.channels['1'].bridges, set())
+
+    def test_lost_hangup(self):
+        now = [1000.0]
+        self.addCleanup(setattr, topology, '_monotonic', topology._monotonic)
+        topology._monotonic = lambda: now[0]
+        self.graph.max_age = 60
+        self.newchannel('1', 'SIP/100-1')
+        now[0] += 30
+        self.newchannel('2', 'SIP/200-2')
+        self.enter('a', '1')
+        self.enter('a', '2')
+        now[0] += 31
+        self.newchannel('3', 'SIP/300-3')
+        self.assertEqual(sorted(self.graph.channels), ['2', '3'])
+        self.assertEqual(self.graph.peers('2'), set())
+        self.assertEqual(self.graph.uniqueid_of('SIP/100-1'), None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_ChannelGraph))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import threading
+import unittest
+
+from py_star.astemu import Event, AsteriskEmu
+from py_star.manager import Manager, _event_from_text
+from py_star.userevent import UserEventBus
+
+def event(name, **headers):
+    text = 'Event: %s\r\n' % name
+    for k, v in sorted(headers.items()):
+        text += '%s: %s\r\n' % (k, v)
+    return _event_from_text(text)
+
+class Test_UserEventBus(unittest.TestCase):
+    """ Test publishing and subscribing with user events.
+    """
+
+    def setUp(self):
+        chatscript = dict(
+            UserEvent=(Event(Response=('Success',),
+                             Message=('Event Sent',)),),
+        )
+        self.astemu = AsteriskEmu(chatscript)
+        self.manager = Manager()
+        self.manager.connect('localhost', port=self.astemu.port)
+        self.bus = UserEventBus(self.manager, batch_size=3,
+                                max_latency=0.05)
+
+    def tearDown(self):
+        self.bus.close()
+        self.manager.close()
+        self.astemu.close()
+
+    def test_publish(self):
+        batches = []
+        futures = []
+        send_actions = self.manager.send_actions
+        def record(actions):
+            batches.append(actions)
+            futures.extend(send_actions(actions))
+            return futures[-len(actions):]
+        self.manager.send_actions = record
+        self.bus.define('CallRouted', queue=str, priority=int, vip=bool)
+        for n in range(4):
+            self.bus.publish('CallRouted', queue='sales', priority=n,
+                             vip=False)
+        self.bus.publish('Other', text='hello')
+        self.assertRaises(ValueError, self.bus.publish, 'CallRouted',
+                          queue='sales')
+        self.bus.close()
+        # sent together, not one by one
+        self.assertTrue(len(batches) <= 2)
+        self.assertEqual(sum(len(b) for b in batches), 5)
+        template, values = batches[0][0]
+        self.assertEqual(template.render('1', values),
+            b'Action: UserEvent\r\nUserEvent: CallRouted\r\n'
+            b'priority: 0\r\nqueue: sales\r\nvip: 0\r\nActionID: 1\r\n\r\n')
+        self.assertEqual([f.result(5)['Response'] for f in futures],
+                         ['Success'] * 5)
+
+    def test_subscribe(self):
+        received = []
+        done = threading.Event()
+        def handler(name, values, event):
+            received.append((name, values))
+            if name == 'Done':
+                done.set()
+        self.bus.define('CallRouted', queue=str, priority=int, vip=bool)
+        self.bus.subscribe('CallRouted', handler)
+        self.bus.subscribe('Done', handler)
+        self.bus.subscribe('Ignored', handler)
+        self.bus.unsubscribe('Ignored', handler)
+        for e in (
+                event('UserEvent', UserEvent='CallRouted', queue='sales',
+                      priority='2', vip='1', Privilege='user,all'),
+                event('UserEvent', UserEvent='Ignored'),
+                event('UserEvent', UserEvent='Done', text='bye')):
+            self.manager._event_received(e)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [
+            ('CallRouted', {'queue': 'sales', 'priority': 2, 'vip': True}),
+            ('Done', {'text': 'bye'})])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest (unittest.makeSuite (Test_UserEventBus))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()